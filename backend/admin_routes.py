@@ -5,6 +5,14 @@ from datetime import datetime
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+from query_monitor import get_route_totals
+from payload import get_route_bytes
+from coherence import bus
+from admission import get_admission_stats
+from singleflight import flight
+from geocluster import venue_grid
+from autocomplete import autocomplete
+import archive
 
 admin_router = APIRouter(prefix="/admin")
 
@@ -97,6 +105,7 @@ async def create_category(category: Category, password: str):
     category_dict["created_at"] = datetime.utcnow()
     
     result = await db.categories.insert_one(category_dict)
+    await bus.publish("categories")
     category_dict["id"] = str(result.inserted_id)
     return Category(**category_dict)
 
@@ -115,6 +124,7 @@ async def update_category(category_id: str, category: Category, password: str):
         {"_id": ObjectId(category_id)},
         {"$set": category_dict}
     )
+    await bus.publish("categories")
     return {"success": True}
 
 @admin_router.delete("/categories/{category_id}")
@@ -126,6 +136,7 @@ async def delete_category(category_id: str, password: str):
     db = client[os.environ['DB_NAME']]
     
     await db.categories.delete_one({"_id": ObjectId(category_id)})
+    await bus.publish("categories")
     return {"success": True}
 
 # ==================== CONTENT MANAGEMENT ====================
@@ -150,6 +161,54 @@ async def get_stats(password: str):
     }
     return stats
 
+@admin_router.get("/query-stats")
+async def get_query_stats(password: str):
+    """Mongo round trips per route since this worker started"""
+    verify_admin(password)
+    return get_route_totals()
+
+@admin_router.get("/payload-stats")
+async def get_payload_stats(password: str):
+    """Response bytes before and after MessagePack/compression per route since this worker started"""
+    verify_admin(password)
+    return get_route_bytes()
+
+@admin_router.get("/cache-bus")
+async def get_cache_bus_metrics(password: str):
+    """Invalidation bus health and propagation lag as seen by this worker"""
+    verify_admin(password)
+    return bus.metrics()
+
+@admin_router.get("/admission")
+async def get_admission(password: str):
+    """Admitted, rate-limited and shed requests per route class on this worker"""
+    verify_admin(password)
+    return get_admission_stats()
+
+@admin_router.get("/single-flight")
+async def get_single_flight_stats(password: str):
+    """How many read requests were served by sharing another request's query"""
+    verify_admin(password)
+    return flight.stats()
+
+@admin_router.get("/map-grid")
+async def get_map_grid_stats(password: str):
+    """Size and freshness of the map clustering grid and its tile cache hit rate"""
+    verify_admin(password)
+    return venue_grid.stats()
+
+@admin_router.get("/autocomplete")
+async def get_autocomplete_stats(password: str):
+    """Size and freshness of the search suggestion index"""
+    verify_admin(password)
+    return autocomplete.stats()
+
+@admin_router.get("/archive")
+async def get_archive_stats(password: str):
+    """Archive horizons and what this worker's archive runs have moved"""
+    verify_admin(password)
+    return archive.stats()
+
 @admin_router.get("/venues/all")
 async def get_all_venues_admin(password: str):
     verify_admin(password)
@@ -170,6 +229,7 @@ async def delete_venue(venue_id: str, password: str):
     db = client[os.environ['DB_NAME']]
     
     await db.venues.delete_one({"_id": ObjectId(venue_id)})
+    await bus.publish("venues", venue_id)
     return {"success": True}
 
 @admin_router.get("/events/all")
@@ -192,6 +252,7 @@ async def delete_event(event_id: str, password: str):
     db = client[os.environ['DB_NAME']]
     
     await db.events.delete_one({"_id": ObjectId(event_id)})
+    await bus.publish("events", event_id)
     return {"success": True}
 
 @admin_router.get("/posts/all")
@@ -214,6 +275,7 @@ async def delete_post(post_id: str, password: str):
     db = client[os.environ['DB_NAME']]
     
     await db.posts.delete_one({"_id": ObjectId(post_id)})
+    await bus.publish("posts", post_id)
     return {"success": True}
 
 @admin_router.put("/posts/{post_id}/hide")
@@ -228,4 +290,5 @@ async def hide_post(post_id: str, password: str):
         {"_id": ObjectId(post_id)},
         {"$set": {"is_public": False, "moderated": True}}
     )
+    await bus.publish("posts", post_id)
     return {"success": True}
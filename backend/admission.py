@@ -0,0 +1,182 @@
+import asyncio
+import math
+import os
+import time
+from urllib.parse import parse_qs
+
+import orjson
+from cachetools import TTLCache
+
+
+class RouteClass:
+    def __init__(self, name: str, rate: float, burst: int, max_concurrency: int = None,
+                 max_queue: int = 0, queue_budget_seconds: float = 0.0):
+        self.name = name
+        self.rate = rate  # tokens per second per client
+        self.burst = burst
+        self.max_queue = max_queue
+        self.queue_budget_seconds = queue_budget_seconds
+        self.semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self.waiting = 0
+        self.admitted = 0
+        self.rate_limited = 0
+        self.shed = 0
+
+    def stats(self):
+        return {
+            "admitted": self.admitted,
+            "rate_limited": self.rate_limited,
+            "shed": self.shed,
+            "waiting": self.waiting,
+            "in_flight_slots_free": self.semaphore._value if self.semaphore else None,
+        }
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+# Expensive routes get both a per-client rate and a per-worker concurrency cap
+ROUTE_CLASSES = {
+    "llm": RouteClass("llm", rate=env_float("LLM_RATE_PER_SEC", 0.2), burst=3,
+                      max_concurrency=int(env_float("LLM_CONCURRENCY", 4)), max_queue=8, queue_budget_seconds=2.0),
+    "admin_export": RouteClass("admin_export", rate=0.5, burst=5,
+                               max_concurrency=2, max_queue=4, queue_budget_seconds=1.0),
+    "nearby": RouteClass("nearby", rate=5, burst=20,
+                         max_concurrency=16, max_queue=32, queue_budget_seconds=0.5),
+    "feed": RouteClass("feed", rate=10, burst=40),
+    # Each upload holds a request body stream and process-pool transcodes
+    "upload": RouteClass("upload", rate=1, burst=10,
+                         max_concurrency=int(env_float("UPLOAD_CONCURRENCY", 8)), max_queue=16, queue_budget_seconds=2.0),
+    "default": RouteClass("default", rate=env_float("DEFAULT_RATE_PER_SEC", 20), burst=60),
+}
+
+
+# Addresses of our own load balancers; only they may set X-Forwarded-For
+TRUSTED_PROXIES = {p.strip() for p in os.getenv("TRUSTED_PROXIES", "").split(",") if p.strip()}
+
+NEARBY_PATHS = ("/api/venues/nearby/search", "/api/events/nearby", "/api/venues/map/clusters")
+
+
+def classify(method: str, path: str, query_string: bytes = b"") -> str:
+    if path == "/api/recommendations":
+        return "llm"
+    if path.startswith("/admin/") and path.endswith("/all"):
+        return "admin_export"
+    if path in NEARBY_PATHS:
+        return "nearby"
+    if path == "/api/venues" and b"distance" in query_string \
+            and parse_qs(query_string.decode("latin-1")).get("sort") == ["distance"]:
+        return "nearby"
+    if path == "/api/uploads":
+        return "upload"
+    if path.startswith("/api/feed") or (method == "GET" and path.startswith("/api/posts")):
+        return "feed"
+    return "default"
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: int):
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self, rate: float, burst: int) -> float:
+        """Returns 0 when admitted, otherwise seconds until a token is available"""
+        now = time.monotonic()
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+def client_key(scope, headers: dict) -> str:
+    """
+    Clients are limited by address. x-user-id isn't authenticated, so keying on
+    it would hand out a fresh bucket per made-up id. X-Forwarded-For is only
+    read behind a trusted proxy, taking the nearest hop the proxies didn't add.
+    """
+    client = scope.get("client")
+    address = client[0] if client else "unknown"
+    forwarded = headers.get("x-forwarded-for")
+    if forwarded and address in TRUSTED_PROXIES:
+        for hop in reversed([h.strip() for h in forwarded.split(",")]):
+            address = hop
+            if hop not in TRUSTED_PROXIES:
+                break
+    return f"ip:{address}"
+
+
+class AdmissionMiddleware:
+    """
+    Rejects over-limit clients with 429 and sheds load with 503 once an
+    expensive route's queue is full or a request would wait past the route's
+    latency budget. Both carry Retry-After, so work is refused early instead of
+    timing out late.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        # Idle clients age out so the table stays bounded
+        self._buckets = TTLCache(maxsize=200000, ttl=600)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        route_class = ROUTE_CLASSES[classify(scope["method"], scope["path"], scope.get("query_string", b""))]
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]}
+        key = (client_key(scope, headers), route_class.name)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(route_class.burst)
+        retry_after = bucket.take(route_class.rate, route_class.burst)
+        if retry_after:
+            route_class.rate_limited += 1
+            await self._reject(send, 429, "Too many requests", retry_after)
+            return
+
+        if route_class.semaphore is None:
+            route_class.admitted += 1
+            await self.app(scope, receive, send)
+            return
+
+        if route_class.semaphore.locked() and route_class.waiting >= route_class.max_queue:
+            route_class.shed += 1
+            await self._reject(send, 503, "Server busy", route_class.queue_budget_seconds)
+            return
+        route_class.waiting += 1
+        try:
+            await asyncio.wait_for(route_class.semaphore.acquire(), timeout=route_class.queue_budget_seconds)
+        except asyncio.TimeoutError:
+            route_class.shed += 1
+            await self._reject(send, 503, "Server busy", route_class.queue_budget_seconds)
+            return
+        finally:
+            route_class.waiting -= 1
+        try:
+            route_class.admitted += 1
+            await self.app(scope, receive, send)
+        finally:
+            route_class.semaphore.release()
+
+    async def _reject(self, send, status: int, detail: str, retry_after: float):
+        body = orjson.dumps({"detail": detail})
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def get_admission_stats():
+    return {name: route_class.stats() for name, route_class in ROUTE_CLASSES.items()}
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ReplaceOne
+
+import outbox
+from coherence import bus
+from popularity import claim_run
+
+logger = logging.getLogger("famigo.archive")
+
+# Events move once they ended this long ago; posts once they are this old
+EVENT_HORIZON_DAYS = int(os.getenv("ARCHIVE_EVENT_DAYS", "180"))
+POST_HORIZON_DAYS = int(os.getenv("ARCHIVE_POST_DAYS", "365"))
+INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", "86400"))
+BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "200"))
+# Pause between batches so a backlog never saturates the primary
+BATCH_PAUSE_SECONDS = float(os.getenv("ARCHIVE_BATCH_PAUSE", "0.5"))
+JOB_ID = "archive"
+# Renewed after every batch, so a long backlog run keeps it
+LEASE_SECONDS = 300
+
+HOT = "hot"
+ARCHIVED = "archived"
+
+# Hot collection -> age field, horizon and child collections keyed by their parent-id field
+TIERS = {
+    "events": {"age_field": "date", "days": EVENT_HORIZON_DAYS, "children": {"rsvps": "event_id"}},
+    "posts": {"age_field": "created_at", "days": POST_HORIZON_DAYS,
+              "children": {"comments": "post_id", "reactions": "post_id"}},
+}
+
+archived_totals = {collection: 0 for collection in TIERS}
+last_run = {}
+
+
+def archive_of(collection: str) -> str:
+    return f"{collection}_archive"
+
+
+async def ensure_archive_indexes(db):
+    # Batches are picked oldest first
+    await db.events.create_index([("date", 1)])
+    await db.posts.create_index([("created_at", 1)])
+    # Archive reads mirror the hot read paths
+    await db[archive_of("rsvps")].create_index([("event_id", 1), ("status", 1), ("created_at", 1)])
+    await db[archive_of("rsvps")].create_index([("event_id", 1), ("user_id", 1)])
+    await db[archive_of("comments")].create_index([("post_id", 1), ("created_at", -1)])
+    await db[archive_of("reactions")].create_index([("post_id", 1), ("user_id", 1)])
+
+
+async def archive_batch(client, db, collection: str, cutoff: datetime) -> list:
+    """
+    Copies one batch of parents and their children into the archive and
+    deletes them from the hot collections, in a transaction when the
+    deployment supports one. Copies are upserts by _id, so a batch
+    interrupted without a transaction is simply redone by the next run.
+    Returns the archived parent ids.
+    """
+    tier = TIERS[collection]
+    now = datetime.utcnow()
+
+    async def move(session):
+        parents = await db[collection].find({tier["age_field"]: {"$lt": cutoff}}, session=session) \
+            .sort(tier["age_field"], 1).limit(BATCH_SIZE).to_list(BATCH_SIZE)
+        if not parents:
+            return []
+        parent_keys = [str(p["_id"]) for p in parents]
+        moving = [(collection, parents)]
+        for child, parent_field in tier["children"].items():
+            docs = await db[child].find({parent_field: {"$in": parent_keys}}, session=session).to_list(None)
+            moving.append((child, docs))
+        for name, docs in moving:
+            if docs:
+                await db[archive_of(name)].bulk_write([
+                    ReplaceOne({"_id": d["_id"]}, {**d, "archived_at": now}, upsert=True) for d in docs
+                ], ordered=False, session=session)
+        # Children first, so an interrupted batch never leaves them without a parent to find them by
+        for name, docs in reversed(moving):
+            if docs:
+                await db[name].delete_many({"_id": {"$in": [d["_id"] for d in docs]}}, session=session)
+        return parent_keys
+
+    return await outbox.run_transaction(client, move)
+
+
+async def renew_lease(db, owner: str) -> bool:
+    result = await db.job_runs.update_one(
+        {"_id": JOB_ID, "lease_owner": owner},
+        {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)}},
+    )
+    return result.matched_count == 1
+
+
+async def archive_tier(client, db, collection: str, owner: str) -> int:
+    cutoff = datetime.utcnow() - timedelta(days=TIERS[collection]["days"])
+    archived = 0
+    while True:
+        if not await renew_lease(db, owner):
+            logger.warning("Archive lease was taken over; stopping this run")
+            return archived
+        keys = await archive_batch(client, db, collection, cutoff)
+        if not keys:
+            return archived
+        archived += len(keys)
+        archived_totals[collection] += len(keys)
+        if collection == "events":
+            # Drops them from the search index and event caches on every worker
+            for key in keys:
+                await bus.publish("events", key)
+        await asyncio.sleep(BATCH_PAUSE_SECONDS)
+
+
+async def run_archive_job(client, db):
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        try:
+            if await claim_run(db, owner, JOB_ID, INTERVAL_SECONDS, LEASE_SECONDS):
+                started = datetime.utcnow()
+                moved = {collection: await archive_tier(client, db, collection, owner) for collection in TIERS}
+                last_run.update({"started_at": started, "archived": moved,
+                                 "duration_seconds": (datetime.utcnow() - started).total_seconds()})
+                await db.job_runs.update_one(
+                    {"_id": JOB_ID, "lease_owner": owner},
+                    {"$set": {"last_run_at": started, "lease_until": None, **{f"archived_{k}": v for k, v in moved.items()},
+                              "duration_seconds": last_run["duration_seconds"]}},
+                )
+                logger.info("Archived %s", ", ".join(f"{n} {c}" for c, n in moved.items()))
+        except Exception:
+            logger.exception("Archive job failed")
+        await asyncio.sleep(60)
+
+
+async def find_one(db, collection: str, query: dict, projection: dict = None):
+    """(doc, archived): hot collection first; old ids fall back to the archive"""
+    doc = await db[collection].find_one(query, projection)
+    if doc is not None:
+        return doc, False
+    return await db[archive_of(collection)].find_one(query, projection), True
+
+
+async def locate(db, collection: str, doc_id: ObjectId):
+    """HOT, ARCHIVED, or None when the document doesn't exist"""
+    doc, archived = await find_one(db, collection, {"_id": doc_id}, {"_id": 1})
+    if doc is None:
+        return None
+    return ARCHIVED if archived else HOT
+
+
+def stats():
+    return {
+        "horizons_days": {collection: tier["days"] for collection, tier in TIERS.items()},
+        "archived_by_this_worker": dict(archived_totals),
+        "last_run_here": last_run or None,
+    }
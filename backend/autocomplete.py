@@ -0,0 +1,447 @@
+import asyncio
+import bisect
+import logging
+import math
+import os
+import re
+import time
+import unicodedata
+from collections import Counter, defaultdict
+
+from bson import ObjectId
+from cachetools import LRUCache
+
+logger = logging.getLogger("famigo.autocomplete")
+
+# Full rebuilds pick up popularity drift that incremental updates don't see
+REBUILD_SECONDS = int(os.getenv("AUTOCOMPLETE_REBUILD_SECONDS", "600"))
+MIN_REBUILD_SECONDS = 30
+# Suggestions kept per trie node; the largest k a request may ask for
+TOP_PER_NODE = 20
+# Typo matching starts at this many characters
+FUZZY_MIN_LENGTH = 3
+
+_token_re = re.compile(r"[a-z0-9]+")
+
+
+def normalize(text: str) -> str:
+    """Lowercase and strip accents, so 'Café' matches 'cafe'"""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+
+def tokenize(text: str):
+    return _token_re.findall(normalize(text))
+
+
+class Entry:
+    __slots__ = ("key", "kind", "ref", "text", "popularity", "tokens")
+
+    def __init__(self, kind: str, ref: str, text: str, popularity: float):
+        self.key = (kind, ref)
+        self.kind = kind
+        self.ref = ref
+        self.text = text
+        self.popularity = popularity
+        self.tokens = tuple(dict.fromkeys(tokenize(text)))
+
+    def to_suggestion(self):
+        suggestion = {"text": self.text, "kind": self.kind}
+        if self.kind in ("venue", "event"):
+            suggestion["id"] = self.ref
+        return suggestion
+
+
+class Node:
+    __slots__ = ("children", "terminal", "top", "stale")
+
+    def __init__(self):
+        self.children = {}
+        self.terminal = set()  # keys of entries with a token ending here
+        self.top = []  # (-popularity, key), best first, at most TOP_PER_NODE
+        self.stale = False  # top lost a member and may be missing one from the subtree
+
+
+class AutocompleteIndex:
+    """
+    Suggestions for venue names, event titles, categories and cities, served
+    from memory. Every trie node keeps its own top entries by popularity, so
+    a prefix lookup is a walk down the trie plus a copy of that list. When a
+    prefix matches too little, near misses are found by an edit-distance walk
+    of the same trie, so 'fram' still finds 'farm'.
+    """
+
+    def __init__(self):
+        self.root = Node()
+        self.entries = {}
+        self.postings = defaultdict(set)  # token -> entry keys
+        self.category_counts = Counter()
+        self.city_counts = Counter()
+        self._venue_groups = {}  # venue id -> (category, city), for count upkeep
+
+    # ---- mutation ----
+
+    def upsert(self, entry: Entry):
+        self.remove(entry.key)
+        self.entries[entry.key] = entry
+        rank = (-entry.popularity, entry.key)
+        visited = set()  # tokens of one entry often share prefixes
+        for token in entry.tokens:
+            node = self.root
+            for ch in token:
+                child = node.children.get(ch)
+                if child is None:
+                    child = node.children[ch] = Node()
+                node = child
+                if id(node) in visited:
+                    continue
+                visited.add(id(node))
+                if len(node.top) < TOP_PER_NODE or rank < node.top[-1]:
+                    bisect.insort(node.top, rank)
+                    del node.top[TOP_PER_NODE:]
+            node.terminal.add(entry.key)
+            self.postings[token].add(entry.key)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        rank = (-entry.popularity, entry.key)
+        for token in entry.tokens:
+            node = self.root
+            for ch in token:
+                node = node.children[ch]
+                if rank in node.top:
+                    # A full list may have crowded out an entry that belongs here now
+                    node.stale = node.stale or len(node.top) == TOP_PER_NODE
+                    node.top.remove(rank)
+            node.terminal.discard(key)
+            self.postings[token].discard(key)
+            if not self.postings[token]:
+                del self.postings[token]
+
+    def _refresh_top(self, node: Node):
+        keys = set()
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            keys.update(n.terminal)
+            stack.extend(n.children.values())
+        ranks = sorted((-self.entries[k].popularity, k) for k in keys)
+        node.top = ranks[:TOP_PER_NODE]
+        node.stale = False
+
+    def put_venue(self, venue: dict):
+        venue_id = str(venue["_id"])
+        self._forget_venue_groups(venue_id)
+        category = venue.get("category")
+        city = (venue.get("location") or {}).get("city")
+        self._venue_groups[venue_id] = (category, city)
+        self.upsert(Entry("venue", venue_id, venue.get("name", ""), venue_popularity(venue)))
+        if category:
+            self.category_counts[category] += 1
+            self.upsert(Entry("category", category, category, self.category_counts[category]))
+        if city:
+            self.city_counts[city] += 1
+            self.upsert(Entry("city", city, city, self.city_counts[city]))
+
+    def drop_venue(self, venue_id: str):
+        self._forget_venue_groups(venue_id)
+        self.remove(("venue", venue_id))
+
+    def _forget_venue_groups(self, venue_id: str):
+        category, city = self._venue_groups.pop(venue_id, (None, None))
+        for kind, name, counts in (("category", category, self.category_counts), ("city", city, self.city_counts)):
+            if not name:
+                continue
+            counts[name] -= 1
+            if counts[name] <= 0:
+                del counts[name]
+                self.remove((kind, name))
+            else:
+                self.upsert(Entry(kind, name, name, counts[name]))
+
+    def put_event(self, event: dict):
+        self.upsert(Entry("event", str(event["_id"]), event.get("title", ""), event_popularity(event)))
+
+    def drop_event(self, event_id: str):
+        self.remove(("event", event_id))
+
+    # ---- lookup ----
+
+    def _node(self, prefix: str):
+        node = self.root
+        for ch in prefix:
+            node = node.children.get(ch)
+            if node is None:
+                return None
+        return node
+
+    def _prefix_matches(self, token: str):
+        node = self._node(token)
+        if node is None:
+            return []
+        if node.stale:
+            self._refresh_top(node)
+        return node.top
+
+    def _fuzzy(self, token: str, as_prefix: bool):
+        """
+        Trie paths within the typo budget of token, as {path: (node, distance)}.
+        Walks the trie carrying one edit-distance row per node, computing only
+        the diagonal band the budget allows, and prunes a branch once its whole
+        band is over the budget. Adjacent swaps
+        count as one edit. The first letter is taken as typed, which keeps the
+        walk to one subtree and is rarely where people slip.
+        """
+        first = self.root.children.get(token[:1])
+        if len(token) < FUZZY_MIN_LENGTH or first is None:
+            return {}
+        limit = 1 if len(token) <= 5 else 2
+        n = len(token)
+        over = limit + 1
+        matches = {}
+        # Distance row after matching the first letter
+        first_row = [min(v, over) for v in [1] + list(range(n))]
+        stack = [(first, token[0], first_row, None, over)]
+        while stack:
+            node, path, row, prev_row, matched = stack.pop()
+            depth = len(path) + 1
+            low, high = max(1, depth - limit), min(n, depth + limit)
+            if low > high:
+                continue
+            for ch, child in node.children.items():
+                new_row = [over] * (n + 1)
+                new_row[0] = min(depth, over)
+                for j in range(low, high + 1):
+                    best = min(new_row[j - 1] + 1, row[j] + 1, row[j - 1] + (token[j - 1] != ch))
+                    if prev_row is not None and j > 1 and token[j - 1] == path[-1] and token[j - 2] == ch:
+                        best = min(best, prev_row[j - 2] + 1)
+                    new_row[j] = min(best, over)
+                child_path = path + ch
+                distance = new_row[n]
+                # A prefix match already covers its subtree unless a deeper node matches closer
+                if distance < matched and (as_prefix or child.terminal):
+                    matches[child_path] = (child, distance)
+                if min(new_row[low:high + 1]) <= limit:
+                    stack.append((child, child_path, new_row, row, min(distance, matched) if as_prefix else matched))
+        return matches
+
+    def suggest(self, query: str, limit: int = 8, kinds=None):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        limit = min(limit, TOP_PER_NODE)
+        *complete, last = tokens
+        # Earlier words are whole words, possibly misspelled: token -> typo distance
+        accepted = []
+        for token in complete:
+            options = {path: distance for path, (_, distance) in self._fuzzy(token, as_prefix=False).items()}
+            if token in self.postings:
+                options[token] = 0
+            if not options:
+                return []
+            accepted.append(options)
+        scored = {}
+
+        def consider(entry, penalty):
+            if kinds and entry.kind not in kinds:
+                return
+            for options in accepted:
+                distances = [options[t] for t in entry.tokens if t in options]
+                if not distances:
+                    return
+                penalty += min(distances)
+            score = entry.popularity / (1 + penalty)
+            if score > scored.get(entry.key, (-1,))[0]:
+                scored[entry.key] = (score, entry)
+
+        if not accepted:
+            for _, key in self._prefix_matches(last):
+                consider(self.entries[key], 0)
+            if len(scored) < limit:
+                for node, distance in self._fuzzy(last, as_prefix=True).values():
+                    if node.stale:
+                        self._refresh_top(node)
+                    for _, key in node.top:
+                        consider(self.entries[key], distance)
+        else:
+            # Entries containing every earlier word, intersected as sets
+            survivors = None
+            for options in accepted:
+                matched = set().union(*(self.postings[t] for t in options))
+                survivors = matched if survivors is None else survivors & matched
+            fuzzy_last = None
+            for key in survivors:
+                entry = self.entries[key]
+                if any(t.startswith(last) for t in entry.tokens):
+                    consider(entry, 0)
+                    continue
+                if fuzzy_last is None:
+                    fuzzy_last = {path: distance for path, (_, distance) in self._fuzzy(last, as_prefix=True).items()}
+                distances = [d for t in entry.tokens for path, d in fuzzy_last.items() if t.startswith(path)]
+                if distances:
+                    consider(entry, min(distances))
+
+        ranked = sorted(scored.values(), key=lambda s: (-s[0], s[1].text))
+        return [entry.to_suggestion() for _, entry in ranked[:limit]]
+
+
+def venue_popularity(venue: dict) -> float:
+    # The materialized score once the popularity job has run, else ratings alone
+    if venue.get("popularity_score") is not None:
+        return 1 + venue["popularity_score"]
+    return 1 + (venue.get("rating") or 0) * math.log1p(venue.get("total_reviews") or 0)
+
+
+def event_popularity(event: dict) -> float:
+    return 1 + (event.get("current_participants") or 0)
+
+
+VENUE_FIELDS = {"name": 1, "category": 1, "location.city": 1, "rating": 1, "total_reviews": 1, "popularity_score": 1}
+EVENT_FIELDS = {"title": 1, "current_participants": 1, "is_public": 1}
+
+
+def build_index(venues, events) -> AutocompleteIndex:
+    index = AutocompleteIndex()
+    for venue in venues:
+        index.put_venue(venue)
+    for event in events:
+        index.put_event(event)
+    return index
+
+
+class IndexWatcher:
+    """Looks like a cache to the bus: an invalidated id is queued for re-indexing"""
+
+    def __init__(self, owner, namespace: str):
+        self.owner = owner
+        self.namespace = namespace
+
+    def pop(self, key, default=None):
+        self.owner._pending[self.namespace].add(key)
+        return default
+
+    def clear(self):
+        self.owner._full_rebuild = True
+
+
+class Autocomplete:
+    """
+    Owns the live index. Registered on the cache bus as the "venues" and
+    "events" caches, so a write on any worker queues that document for
+    re-indexing here. Queued ids are applied every second and the whole index
+    is rebuilt every REBUILD_SECONDS. Lookups never touch Mongo; their results
+    are cached until the index next changes.
+    """
+
+    def __init__(self):
+        self.index = AutocompleteIndex()
+        self.db = None
+        self.built_at = None
+        self.build_ms = None
+        self.updates = 0
+        self._results = LRUCache(maxsize=int(os.getenv("AUTOCOMPLETE_RESULT_CACHE_SIZE", "20000")))
+        self._pending = {"venues": set(), "events": set()}
+        self._full_rebuild = False
+        self._task = None
+
+    def watcher(self, namespace: str):
+        return IndexWatcher(self, namespace)
+
+    def suggest(self, query: str, limit: int = 8, kinds=None):
+        # Typo lookups cost a few ms; the same keystrokes come from many users
+        key = (" ".join(tokenize(query)), limit, tuple(sorted(kinds)) if kinds else None)
+        results = self._results.get(key)
+        if results is None:
+            results = self._results[key] = self.index.suggest(query, limit, kinds)
+        return results
+
+    async def rebuild(self):
+        started = time.perf_counter()
+        venues = await self.db.venues.find({}, VENUE_FIELDS).to_list(None)
+        events = await self.db.events.find({"is_public": True}, EVENT_FIELDS).to_list(None)
+        self.index = await asyncio.to_thread(build_index, venues, events)
+        self._results.clear()
+        self.built_at = time.time()
+        self.build_ms = round((time.perf_counter() - started) * 1000, 1)
+        logger.info("Built autocomplete index (%d entries) in %.0fms", len(self.index.entries), self.build_ms)
+
+    async def start(self, db):
+        self.db = db
+        try:
+            await self.rebuild()
+        except Exception:
+            logger.exception("Initial autocomplete build failed; retrying in the background")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(1)
+            try:
+                age = time.time() - self.built_at if self.built_at else None
+                # Bus resets ask for rebuilds; at most one per MIN_REBUILD_SECONDS
+                if age is None or age > REBUILD_SECONDS or (self._full_rebuild and age > MIN_REBUILD_SECONDS):
+                    self._full_rebuild = False
+                    for ids in self._pending.values():
+                        ids.clear()
+                    await self.rebuild()
+                else:
+                    await self._apply_pending()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Autocomplete update failed")
+
+    async def _apply_pending(self):
+        venue_ids, self._pending["venues"] = self._pending["venues"], set()
+        event_ids, self._pending["events"] = self._pending["events"], set()
+        if not venue_ids and not event_ids:
+            return
+        try:
+            await self._reindex(venue_ids, event_ids)
+        except Exception:
+            # Retried on the next tick
+            self._pending["venues"] |= venue_ids
+            self._pending["events"] |= event_ids
+            raise
+        self._results.clear()
+        self.updates += len(venue_ids) + len(event_ids)
+
+    async def _reindex(self, venue_ids, event_ids):
+        index = self.index
+        if venue_ids:
+            object_ids = [ObjectId(v) for v in venue_ids if ObjectId.is_valid(v)]
+            found = await self.db.venues.find({"_id": {"$in": object_ids}}, VENUE_FIELDS).to_list(None)
+            for venue in found:
+                index.put_venue(venue)
+            for venue_id in venue_ids - {str(v["_id"]) for v in found}:
+                index.drop_venue(venue_id)
+        if event_ids:
+            object_ids = [ObjectId(e) for e in event_ids if ObjectId.is_valid(e)]
+            found = await self.db.events.find({"_id": {"$in": object_ids}}, EVENT_FIELDS).to_list(None)
+            live = set()
+            for event in found:
+                if event.get("is_public"):
+                    index.put_event(event)
+                    live.add(str(event["_id"]))
+            for event_id in event_ids - live:
+                index.drop_event(event_id)
+
+    def stats(self):
+        return {
+            "entries": len(self.index.entries),
+            "tokens": len(self.index.postings),
+            "built_at": self.built_at,
+            "build_ms": self.build_ms,
+            "incremental_updates": self.updates,
+            "pending": sum(len(ids) for ids in self._pending.values()),
+        }
+
+
+autocomplete = Autocomplete()
@@ -0,0 +1,146 @@
+import logging
+import os
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+import inventory
+import outbox
+
+logger = logging.getLogger("famigo.bookings")
+
+
+class PaymentDeclined(Exception):
+    pass
+
+
+class LocalPaymentProcessor:
+    """
+    Stand-in for the real processor. Captures are recorded in the payments
+    collection keyed by idempotency key, so a retried capture never charges twice.
+    Amounts listed in LOCAL_PAYMENT_DECLINE_AMOUNTS are declined, for testing.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.decline_amounts = {
+            float(a) for a in os.getenv("LOCAL_PAYMENT_DECLINE_AMOUNTS", "").split(",") if a.strip()
+        }
+
+    async def capture(self, amount: float, reference: str, idempotency_key: str) -> str:
+        if amount in self.decline_amounts:
+            raise PaymentDeclined(f"Card declined for {amount}")
+        try:
+            await self.db.payments.insert_one({
+                "_id": idempotency_key,
+                "type": "capture",
+                "reference": reference,
+                "amount": amount,
+                "created_at": datetime.utcnow(),
+            })
+        except DuplicateKeyError:
+            pass
+        return idempotency_key
+
+    async def captured(self, idempotency_key: str) -> bool:
+        return await self.db.payments.find_one({"_id": idempotency_key, "type": "capture"}, {"_id": 1}) is not None
+
+    async def refund(self, amount: float, reference: str, idempotency_key: str) -> str:
+        try:
+            await self.db.payments.insert_one({
+                "_id": idempotency_key,
+                "type": "refund",
+                "reference": reference,
+                "amount": amount,
+                "created_at": datetime.utcnow(),
+            })
+        except DuplicateKeyError:
+            pass
+        return idempotency_key
+
+
+payment_processor = None
+
+
+async def refund_cancelled_capture(db, booking: dict, idempotency_key: str):
+    """
+    A booking cancelled while its capture was in flight was charged after the
+    cancel decided no refund was due. Shares the cancellation's refund key,
+    so the money goes back at most once.
+    """
+    if booking.get("payment_status") == "refunded":
+        return
+    if not await payment_processor.captured(idempotency_key):
+        return
+    await payment_processor.refund(booking["amount"], str(booking["_id"]), f"refund:{booking['_id']}")
+    await db.bookings.update_one({"_id": booking["_id"]}, {"$set": {"payment_status": "refunded"}})
+
+
+async def capture_payment(db, payload: dict, idempotency_key: str):
+    booking = await db.bookings.find_one({"_id": ObjectId(payload["booking_id"])})
+    if booking is None:
+        return
+    if booking["status"] != "confirmed":
+        # Also covers a retry after capturing but before recording it below
+        await refund_cancelled_capture(db, booking, idempotency_key)
+        return
+    if booking.get("payment_status") == "paid":
+        return
+    try:
+        payment_id = await payment_processor.capture(booking["amount"], str(booking["_id"]), idempotency_key)
+    except PaymentDeclined as e:
+        # Give the tickets back; the booking can't be honoured
+        result = await db.bookings.update_one(
+            {"_id": booking["_id"], "status": "confirmed"},
+            {"$set": {"status": "cancelled", "payment_status": "failed", "updated_at": datetime.utcnow()}}
+        )
+        if result.modified_count:
+            await inventory.release_booking(db, booking)
+        raise outbox.PermanentFailure(str(e))
+
+    # Recorded only while the booking is still confirmed; a cancel in between gets its money back
+    recorded = await db.bookings.find_one_and_update(
+        {"_id": booking["_id"], "status": "confirmed"},
+        {"$set": {"payment_status": "paid", "payment_id": payment_id, "updated_at": datetime.utcnow()}}
+    )
+    if recorded is None:
+        await refund_cancelled_capture(db, booking, idempotency_key)
+        return
+    await outbox.enqueue(db, "ticket.email", {"booking_id": payload["booking_id"]},
+                         f"ticket-email:{payload['booking_id']}")
+
+
+async def send_ticket_email(db, payload: dict, idempotency_key: str):
+    booking = await db.bookings.find_one({"_id": ObjectId(payload["booking_id"])})
+    if booking is None or booking.get("ticket_emailed_at"):
+        return
+    # No mail provider is configured yet; log what would be sent
+    logger.info("Ticket %s for booking %s sent to %s",
+                booking["ticket_code"], payload["booking_id"], booking["user_id"])
+    await db.bookings.update_one({"_id": booking["_id"]}, {"$set": {"ticket_emailed_at": datetime.utcnow()}})
+
+
+async def handle_cancellation(db, payload: dict, idempotency_key: str):
+    booking = await db.bookings.find_one({"_id": ObjectId(payload["booking_id"])})
+    if booking is None:
+        return
+    if payload.get("release_slot"):
+        # Marked with the release, so a retried message can't release twice
+        await inventory.release_booking(db, booking)
+    if payload.get("refund"):
+        await payment_processor.refund(booking["amount"], str(booking["_id"]), f"refund:{payload['booking_id']}")
+        await db.bookings.update_one({"_id": booking["_id"]}, {"$set": {"payment_status": "refunded"}})
+
+
+HANDLERS = {
+    "payment.capture": capture_payment,
+    "ticket.email": send_ticket_email,
+    "booking.cancelled": handle_cancellation,
+}
+
+
+def create_worker_pool(db):
+    global payment_processor
+    payment_processor = LocalPaymentProcessor(db)
+    return outbox.OutboxWorkerPool(db, HANDLERS)
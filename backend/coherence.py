@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+
+from pymongo import CursorType, ReturnDocument
+from pymongo.errors import CollectionInvalid
+
+logger = logging.getLogger("famigo.coherence")
+
+HEARTBEAT_SECONDS = float(os.getenv("CACHE_BUS_HEARTBEAT", "2"))
+# Local caches are bypassed once the bus has been silent this long
+MAX_STALENESS_SECONDS = float(os.getenv("CACHE_BUS_MAX_STALENESS", "10"))
+CAPPED_BYTES = 16 * 1024 * 1024
+CAPPED_DOCS = 100000
+ALL_KEYS = "*"
+HEARTBEAT_NS = "_heartbeat"
+# A reconnect resumes this many sequence numbers early; see _tail
+RESUME_OVERLAP = 1000
+
+
+class InvalidationBus:
+    """
+    Broadcasts cache invalidations to every worker on every host through a
+    capped collection. Each worker tails it with a tailable cursor in insertion
+    order, so messages arrive in order. Every message carries a sequence number,
+    and a reconnect resumes from the last one this worker saw with an indexed
+    query. If the messages after it have been overwritten, local caches are
+    cleared instead of risking a gap. Every
+    worker sends heartbeats too. If a worker hears nothing for
+    MAX_STALENESS_SECONDS, its caches are cleared and bypassed until the bus
+    recovers, so a cached value is never staler than that bound.
+    """
+
+    def __init__(self):
+        self.db = None
+        self.origin = f"{socket.gethostname()}:{os.getpid()}"
+        self._caches = defaultdict(list)
+        self._tasks = []
+        self._last_seq = 0
+        self._last_message_at = 0.0
+        self._lags_ms = deque(maxlen=1000)
+        self.received = 0
+        self.published = 0
+        self.resets = 0
+
+    def register(self, namespace: str, cache, per_key: bool = True):
+        """
+        cache needs pop(key, default) and clear(), e.g. a cachetools TTLCache or
+        a dict. Caches whose keys aren't document ids (say, query results) pass
+        per_key=False and are cleared on any change in the namespace.
+        """
+        self._caches[namespace].append((cache, per_key))
+
+    def cache_allowed(self) -> bool:
+        return self.db is not None and time.monotonic() - self._last_message_at <= MAX_STALENESS_SECONDS
+
+    def _apply(self, namespace: str, key: str):
+        for cache, per_key in self._caches.get(namespace, ()):
+            if key == ALL_KEYS or not per_key:
+                cache.clear()
+            else:
+                cache.pop(key, None)
+
+    def _clear_all(self):
+        self.resets += 1
+        for caches in self._caches.values():
+            for cache, _ in caches:
+                cache.clear()
+
+    async def publish(self, namespace: str, key: str = ALL_KEYS):
+        # Our own caches don't wait for the round trip
+        self._apply(namespace, str(key))
+        if self.db is None:
+            return
+        await self._insert(namespace, str(key))
+        self.published += 1
+
+    async def _insert(self, namespace: str, key: str):
+        counter = await self.db.counters.find_one_and_update(
+            {"_id": "cache_invalidations"}, {"$inc": {"seq": 1}},
+            upsert=True, return_document=ReturnDocument.AFTER,
+        )
+        await self.db.cache_invalidations.insert_one({
+            "seq": counter["seq"], "ns": namespace, "key": key, "origin": self.origin,
+            "published_at": datetime.utcnow(),
+        })
+
+    async def start(self, db):
+        try:
+            await db.create_collection("cache_invalidations", capped=True, size=CAPPED_BYTES, max=CAPPED_DOCS)
+        except CollectionInvalid:
+            pass
+        await db.cache_invalidations.create_index([("seq", 1)])
+        self.db = db
+        # A tailable cursor whose query matches nothing dies immediately
+        await self._heartbeat_once()
+        latest = await db.cache_invalidations.find_one({}, {"seq": 1}, sort=[("seq", -1)])
+        self._last_seq = latest.get("seq", 0) if latest else 0
+        self._last_message_at = time.monotonic()
+        self._tasks = [asyncio.create_task(self._tail()), asyncio.create_task(self._heartbeat())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _heartbeat_once(self):
+        await self._insert(HEARTBEAT_NS, "")
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            try:
+                await self._heartbeat_once()
+            except Exception:
+                logger.exception("Cache bus heartbeat failed")
+
+    async def _tail(self):
+        while True:
+            try:
+                # Publishers take a sequence number before inserting, so a message can land
+                # just after one numbered higher. Resuming RESUME_OVERLAP early re-applies a
+                # few invalidations, which is harmless, rather than skipping a late one.
+                oldest = await self.db.cache_invalidations.find_one(
+                    {"seq": {"$gt": 0}}, {"seq": 1}, sort=[("seq", 1)])
+                if oldest is not None and self._last_seq and oldest["seq"] > self._last_seq + 1:
+                    # Our position has been overwritten: invalidations may have been missed
+                    logger.warning("Cache bus fell behind the capped collection; clearing local caches")
+                    self._clear_all()
+                cursor = self.db.cache_invalidations.find(
+                    {"seq": {"$gt": self._last_seq - RESUME_OVERLAP}}, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    async for message in cursor:
+                        self._receive(message)
+                    if not self.cache_allowed():
+                        self._clear_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Cache bus tail failed; clearing local caches")
+                self._clear_all()
+            await asyncio.sleep(0.5)
+
+    def _receive(self, message: dict):
+        self._last_seq = max(self._last_seq, message["seq"])
+        self._last_message_at = time.monotonic()
+        self.received += 1
+        lag_ms = (datetime.utcnow() - message["published_at"]).total_seconds() * 1000
+        self._lags_ms.append(lag_ms)
+        if message["ns"] != HEARTBEAT_NS and message["origin"] != self.origin:
+            self._apply(message["ns"], message["key"])
+
+    def metrics(self) -> dict:
+        lags = sorted(self._lags_ms)
+        def pct(p):
+            return round(lags[min(len(lags) - 1, int(len(lags) * p))], 1) if lags else None
+        return {
+            "origin": self.origin,
+            "healthy": self.cache_allowed(),
+            "seconds_since_last_message": round(time.monotonic() - self._last_message_at, 2),
+            "published": self.published,
+            "received": self.received,
+            "resets": self.resets,
+            "propagation_lag_ms": {"p50": pct(0.5), "p99": pct(0.99), "max": round(lags[-1], 1) if lags else None},
+            "namespaces": sorted(self._caches),
+        }
+
+
+bus = InvalidationBus()
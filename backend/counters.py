@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import os
+import random
+from collections import defaultdict
+from functools import partial
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, ServerSelectionTimeoutError
+
+import outbox
+
+logger = logging.getLogger("famigo.counters")
+
+FLUSH_INTERVAL_SECONDS = float(os.getenv("COUNTER_FLUSH_INTERVAL", "1.0"))
+# Flush early once this many documents have pending deltas
+FLUSH_THRESHOLD = int(os.getenv("COUNTER_FLUSH_THRESHOLD", "500"))
+# 0 writes deltas straight to the document; N > 0 spreads them over N shard documents
+# that are folded back into the document every COMPACT_EVERY flushes
+SHARDS = int(os.getenv("COUNTER_SHARDS", "0"))
+COMPACT_EVERY = 10
+
+
+class CounterBuffer:
+    """
+    Write-behind counters for hot documents. Increments are coalesced in memory
+    per (collection, document) and flushed with one bulk_write per collection,
+    so a burst of likes on one post becomes a single $inc.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._pending = defaultdict(lambda: defaultdict(int))  # (collection, doc_id) -> {field: delta}
+        self._flushing = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._flushes = 0
+
+    def incr(self, collection: str, doc_id: str, field: str, delta: int = 1):
+        self._pending[(collection, doc_id)][field] += delta
+        if len(self._pending) >= FLUSH_THRESHOLD:
+            self._wakeup.set()
+
+    def pending_delta(self, collection: str, doc_id: str, field: str) -> int:
+        key = (collection, doc_id)
+        delta = self._pending.get(key, {}).get(field, 0)
+        return delta + self._flushing.get(key, {}).get(field, 0)
+
+    def merge_pending(self, collection: str, doc: dict, fields) -> dict:
+        """Apply not-yet-flushed deltas to a document read from Mongo (read-your-writes)"""
+        doc_id = str(doc.get("_id", doc.get("id")))
+        for field in fields:
+            delta = self.pending_delta(collection, doc_id, field)
+            if delta:
+                doc[field] = doc.get(field, 0) + delta
+        return doc
+
+    async def merge_shards(self, collection: str, docs, fields):
+        """Add shard values that haven't been compacted yet. One query for the whole page."""
+        if not SHARDS or not docs:
+            return docs
+        ids = [str(d.get("_id", d.get("id"))) for d in docs]
+        totals = defaultdict(lambda: defaultdict(int))
+        async for shard in self.db.counter_shards.find({"collection": collection, "doc_id": {"$in": ids}}):
+            for field in fields:
+                totals[shard["doc_id"]][field] += shard.get(field, 0)
+        for doc_id, doc in zip(ids, docs):
+            for field, value in totals.get(doc_id, {}).items():
+                doc[field] = doc.get(field, 0) + value
+        return docs
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.flush()
+        if SHARDS:
+            await self.compact()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=FLUSH_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                self._flushes += 1
+                if SHARDS and self._flushes % COMPACT_EVERY == 0:
+                    await self.compact()
+            except Exception:
+                logger.exception("Counter flush failed")
+
+    async def flush(self):
+        if not self._pending:
+            return
+        self._flushing, self._pending = self._pending, defaultdict(lambda: defaultdict(int))
+        writes = defaultdict(list)
+        keys = defaultdict(list)
+        for (collection, doc_id), deltas in self._flushing.items():
+            inc = {field: delta for field, delta in deltas.items() if delta}
+            if not inc:
+                continue
+            if SHARDS:
+                shard_id = f"{collection}:{doc_id}:{random.randrange(SHARDS)}"
+                target = "counter_shards"
+                write = UpdateOne(
+                    {"_id": shard_id},
+                    {"$inc": inc, "$setOnInsert": {"collection": collection, "doc_id": doc_id}},
+                    upsert=True,
+                )
+            elif ObjectId.is_valid(doc_id):
+                target = collection
+                write = UpdateOne({"_id": ObjectId(doc_id)}, {"$inc": inc})
+            else:
+                continue
+            writes[target].append(write)
+            keys[target].append((collection, doc_id))
+        failed = None
+        for target, target_writes in writes.items():
+            try:
+                await self.db[target].bulk_write(target_writes, ordered=False)
+            except BulkWriteError as e:
+                # Writes not listed in writeErrors were applied; only the listed ones are retried
+                failed = e
+                for error in e.details.get("writeErrors", []):
+                    self._requeue(keys[target][error["index"]])
+            except ServerSelectionTimeoutError as e:
+                # Nothing reached a server, so every delta is safe to retry
+                failed = e
+                for key in keys[target]:
+                    self._requeue(key)
+            except Exception as e:
+                # The driver already retried once; whether the $inc landed is unknown now, and
+                # applying it again could double count, so these deltas are dropped instead
+                failed = e
+                logger.warning("Dropped counter deltas for %d %s documents after an ambiguous write error",
+                               len(keys[target]), target)
+        self._flushing = {}
+        if failed is not None:
+            raise failed
+
+    def _requeue(self, key):
+        for field, delta in self._flushing[key].items():
+            self._pending[key][field] += delta
+
+    async def compact(self):
+        """
+        Fold shard values into their documents and subtract what was folded.
+        Both writes happen in one transaction; without transactions a crash
+        between them would count the values twice, so compaction is skipped
+        and reads keep adding the shards through merge_shards.
+        """
+        if not outbox.supports_transactions:
+            return
+        async for shard in self.db.counter_shards.find({}, {"_id": 1, "collection": 1, "doc_id": 1}):
+            if ObjectId.is_valid(shard["doc_id"]):
+                await outbox.run_transaction(self.db.client, partial(self._fold, shard))
+
+    async def _fold(self, shard, session):
+        # Read inside the transaction, so a concurrent flush into this shard is a write conflict and a rerun
+        current = await self.db.counter_shards.find_one({"_id": shard["_id"]}, session=session)
+        inc = {k: v for k, v in (current or {}).items()
+               if k not in ("_id", "collection", "doc_id") and isinstance(v, int) and v}
+        if not inc:
+            return
+        await self.db[shard["collection"]].update_one(
+            {"_id": ObjectId(shard["doc_id"])}, {"$inc": inc}, session=session)
+        await self.db.counter_shards.update_one(
+            {"_id": shard["_id"]}, {"$inc": {k: -v for k, v in inc.items()}}, session=session)
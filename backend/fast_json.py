@@ -0,0 +1,48 @@
+import orjson
+from bson import ObjectId
+from fastapi.responses import Response
+
+
+def _default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class DocumentResponse(Response):
+    """
+    Serializes documents we wrote ourselves straight to JSON bytes. Returning a
+    Response skips FastAPI's response_model validation, so the model is only
+    used for the OpenAPI schema. datetimes are encoded natively by orjson.
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class DocumentView:
+    """
+    Shapes raw Mongo documents like a response model without validating them:
+    the projection fetches only the model's fields and missing ones get the
+    model's defaults.
+    """
+
+    def __init__(self, model):
+        self.fields = [name for name in model.model_fields if name != "id"]
+        self.projection = {name: 1 for name in self.fields}
+        self._defaults = {
+            name: field for name, field in model.model_fields.items()
+            if name != "id" and not field.is_required()
+        }
+
+    def __call__(self, doc: dict) -> dict:
+        if "_id" in doc:
+            doc["id"] = str(doc.pop("_id"))
+        for name, field in self._defaults.items():
+            if name not in doc:
+                doc[name] = field.get_default(call_default_factory=True)
+        return doc
+
+    def many(self, docs) -> list:
+        return [self(d) for d in docs]
@@ -0,0 +1,245 @@
+import logging
+import os
+import re
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+logger = logging.getLogger("famigo.feed")
+
+# Timelines keep only the newest N post ids; older pages are read from the posts collection
+TIMELINE_SIZE = int(os.getenv("FEED_TIMELINE_SIZE", "500"))
+# Followers are fanned out to in batches so a popular author doesn't build one huge bulk write
+FANOUT_BATCH_SIZE = 1000
+
+PUBLIC_TIMELINE = "public"
+
+
+def city_timeline(city: str) -> str:
+    return f"city:{city.strip().lower()}"
+
+
+def home_timeline(user_id: str) -> str:
+    return f"user:{user_id}"
+
+
+async def ensure_feed_indexes(db):
+    await db.follows.create_index([("follower_id", ASCENDING), ("followee_id", ASCENDING)], unique=True)
+    await db.follows.create_index([("followee_id", ASCENDING)])
+    # Used by rebuild_timeline and backfills
+    await db.posts.create_index([("is_public", ASCENDING), ("created_at", DESCENDING)])
+    await db.posts.create_index([("user_id", ASCENDING), ("created_at", DESCENDING)])
+    # Used by comment previews and reaction lookups
+    await db.comments.create_index([("post_id", ASCENDING), ("created_at", DESCENDING)])
+    await db.reactions.create_index([("post_id", ASCENDING), ("user_id", ASCENDING)])
+    # Empty timelines stored by earlier rebuilds for cities and users without posts
+    await db.timelines.delete_many({"post_ids": {"$size": 0}})
+
+
+async def resolve_post_city(db, post: dict) -> str:
+    """Posts carry an optional city; otherwise use the linked venue or event's city"""
+    if post.get("city"):
+        return post["city"]
+    for collection, field in (("venues", "related_venue_id"), ("events", "related_event_id")):
+        related_id = post.get(field)
+        if related_id and ObjectId.is_valid(related_id):
+            doc = await db[collection].find_one({"_id": ObjectId(related_id)}, {"location.city": 1})
+            if doc and doc.get("location", {}).get("city"):
+                return doc["location"]["city"]
+    return None
+
+
+def _push_update(post_id: ObjectId):
+    return {
+        "$push": {"post_ids": {"$each": [post_id], "$position": 0, "$slice": TIMELINE_SIZE}},
+        "$set": {"updated_at": datetime.utcnow()},
+    }
+
+
+async def push_to_timelines(db, timeline_ids, post_id: ObjectId):
+    timeline_ids = list(timeline_ids)
+    for i in range(0, len(timeline_ids), FANOUT_BATCH_SIZE):
+        batch = timeline_ids[i:i + FANOUT_BATCH_SIZE]
+        await db.timelines.bulk_write(
+            # No upsert: a missing timeline is rebuilt with its history on first read
+            [UpdateOne({"_id": t}, _push_update(post_id)) for t in batch],
+            ordered=False,
+        )
+
+
+async def fan_out_post(db, post: dict):
+    """Materialize a new post into every timeline that should show it. Runs after the response is sent."""
+    post_id = post["_id"]
+    try:
+        timelines = [home_timeline(post["user_id"])]
+        if post.get("is_public", True):
+            timelines.append(PUBLIC_TIMELINE)
+            city = await resolve_post_city(db, post)
+            if city:
+                timelines.append(city_timeline(city))
+                if not post.get("city"):
+                    # Store the resolved city so rebuild_timeline can find the post
+                    await db.posts.update_one({"_id": post_id}, {"$set": {"city": city}})
+        await push_to_timelines(db, timelines, post_id)
+
+        # Followers see public and followers-only posts alike
+        cursor = db.follows.find({"followee_id": post["user_id"]}, {"follower_id": 1, "_id": 0})
+        batch = []
+        async for f in cursor:
+            batch.append(home_timeline(f["follower_id"]))
+            if len(batch) >= FANOUT_BATCH_SIZE:
+                await push_to_timelines(db, batch, post_id)
+                batch = []
+        if batch:
+            await push_to_timelines(db, batch, post_id)
+    except Exception:
+        # The post itself is stored; a missed fan-out is repaired by rebuild_timeline
+        logger.exception("Feed fan-out failed for post %s", post_id)
+
+
+async def timeline_query(db, timeline_id: str):
+    """The posts query a timeline materializes, or None for an unknown timeline"""
+    if timeline_id == PUBLIC_TIMELINE:
+        return {"is_public": True}
+    if timeline_id.startswith("city:"):
+        city = timeline_id[len("city:"):]
+        return {"is_public": True, "city": {"$regex": f"^{re.escape(city)}$", "$options": "i"}}
+    if timeline_id.startswith("user:"):
+        user_id = timeline_id[len("user:"):]
+        followees = await db.follows.find({"follower_id": user_id}, {"followee_id": 1, "_id": 0}).to_list(10000)
+        return {"user_id": {"$in": [user_id] + [f["followee_id"] for f in followees]}}
+    return None
+
+
+async def rebuild_timeline(db, timeline_id: str):
+    """
+    Recompute a timeline from the posts collection (cold start, new city, new
+    follower). Timeline ids come from request parameters, so an empty result
+    (a city or user nobody has posted for) is not stored; the next read
+    rebuilds it again with the same cheap indexed query.
+    """
+    query = await timeline_query(db, timeline_id)
+    if query is None:
+        return []
+
+    posts = await db.posts.find(query, {"_id": 1}).sort("created_at", -1).limit(TIMELINE_SIZE).to_list(TIMELINE_SIZE)
+    post_ids = [p["_id"] for p in posts]
+    if not post_ids:
+        # An unfollow can empty a stored home timeline; a missing one reads the same
+        await db.timelines.delete_one({"_id": timeline_id})
+        return post_ids
+    await db.timelines.update_one(
+        {"_id": timeline_id},
+        {"$set": {"post_ids": post_ids, "updated_at": datetime.utcnow()}},
+        upsert=True,
+    )
+    return post_ids
+
+
+async def read_timeline_ids(db, timeline_id: str, offset: int, limit: int):
+    """
+    Only the requested slice of post ids is read, so cost is O(page size).
+    Pages past the TIMELINE_SIZE ids a timeline keeps come from the posts collection.
+    """
+    timeline = await db.timelines.find_one({"_id": timeline_id}, {"post_ids": {"$slice": [offset, limit]}})
+    if timeline is None:
+        post_ids = (await rebuild_timeline(db, timeline_id))[offset:offset + limit]
+    else:
+        post_ids = timeline.get("post_ids", [])
+    if len(post_ids) < limit and offset + len(post_ids) >= TIMELINE_SIZE:
+        post_ids += await read_older_ids(db, timeline_id, offset + len(post_ids), limit - len(post_ids))
+    return post_ids
+
+
+async def read_older_ids(db, timeline_id: str, offset: int, limit: int):
+    query = await timeline_query(db, timeline_id)
+    if query is None:
+        return []
+    posts = await db.posts.find(query, {"_id": 1}).sort("created_at", -1).skip(offset).limit(limit).to_list(limit)
+    return [p["_id"] for p in posts]
+
+
+async def hydrate_posts(db, post_ids, public_only: bool, projection: dict = None):
+    """Fetch posts for a page of ids in one $in query, preserving timeline order"""
+    if not post_ids:
+        return []
+    query = {"_id": {"$in": post_ids}}
+    if public_only:
+        # Posts hidden by moderation after fan-out drop out here
+        query["is_public"] = True
+    posts = await db.posts.find(query, projection).to_list(len(post_ids))
+    by_id = {p["_id"]: p for p in posts}
+    return [by_id[pid] for pid in post_ids if pid in by_id]
+
+
+async def backfill_home_timeline(db, follower_id: str, followee_id: str):
+    """Merge a newly followed user's recent posts into the follower's timeline"""
+    recent = await db.posts.find({"user_id": followee_id}, {"_id": 1, "created_at": 1}) \
+        .sort("created_at", -1).limit(50).to_list(50)
+    if not recent:
+        return
+    timeline_id = home_timeline(follower_id)
+    timeline = await db.timelines.find_one({"_id": timeline_id}, {"post_ids": 1})
+    if timeline is None:
+        await rebuild_timeline(db, timeline_id)
+        return
+    existing = await db.posts.find(
+        {"_id": {"$in": timeline.get("post_ids", [])}}, {"_id": 1, "created_at": 1}
+    ).to_list(TIMELINE_SIZE)
+    merged = {p["_id"]: p["created_at"] for p in existing + recent}
+    post_ids = sorted(merged, key=merged.get, reverse=True)[:TIMELINE_SIZE]
+    await db.timelines.update_one({"_id": timeline_id}, {"$set": {"post_ids": post_ids, "updated_at": datetime.utcnow()}})
+
+
+async def attach_comment_previews(db, posts, per_post: int):
+    """Latest comments for a whole page of posts in one aggregation"""
+    post_ids = [str(p["_id"]) for p in posts]
+    previews = {pid: [] for pid in post_ids}
+    if not post_ids or per_post <= 0:
+        return previews
+    # One indexed (post_id, created_at) range read of per_post comments for each post,
+    # rather than grouping every comment of every post on the page
+    pipeline = [
+        {"$match": {"_id": {"$in": [p["_id"] for p in posts]}}},
+        {"$project": {"_id": {"$toString": "$_id"}}},
+        {"$lookup": {
+            "from": "comments",
+            "let": {"post_id": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$post_id", "$$post_id"]}}},
+                {"$sort": {"created_at": -1}},
+                {"$limit": per_post},
+            ],
+            "as": "comments",
+        }},
+    ]
+    async for group in db.posts.aggregate(pipeline):
+        # Oldest first within the preview, matching get_post_comments
+        previews[group["_id"]] = list(reversed(group["comments"]))
+    return previews
+
+
+async def attach_reactions(db, posts, viewer_id: str = None):
+    """Reaction counts per type and the viewer's own reaction, in one aggregation"""
+    post_ids = [str(p["_id"]) for p in posts]
+    counts = {pid: {} for pid in post_ids}
+    viewer_reactions = {}
+    if not post_ids:
+        return counts, viewer_reactions
+    facets = {
+        "counts": [{"$group": {"_id": {"post_id": "$post_id", "type": "$reaction_type"}, "n": {"$sum": 1}}}],
+    }
+    if viewer_id:
+        facets["viewer"] = [
+            {"$match": {"user_id": viewer_id}},
+            {"$project": {"_id": 0, "post_id": 1, "reaction_type": 1}},
+        ]
+    pipeline = [{"$match": {"post_id": {"$in": post_ids}}}, {"$facet": facets}]
+    result = await db.reactions.aggregate(pipeline).to_list(1)
+    if result:
+        for row in result[0]["counts"]:
+            counts[row["_id"]["post_id"]][row["_id"]["type"] or "like"] = row["n"]
+        for row in result[0].get("viewer", []):
+            viewer_reactions[row["post_id"]] = row.get("reaction_type", "like")
+    return counts, viewer_reactions
@@ -0,0 +1,60 @@
+import logging
+import math
+
+logger = logging.getLogger("famigo.geo")
+
+EARTH_RADIUS_METERS = 6378100
+
+
+class InvalidLocation(ValueError):
+    pass
+
+
+def geo_point(location: dict):
+    """GeoJSON point for a {coordinates: {lat, lng}} location, or None when it has none"""
+    coords = (location or {}).get("coordinates") or {}
+    lat, lng = coords.get("lat"), coords.get("lng")
+    if lat is None or lng is None:
+        return None
+    for name, value, limit in (("lat", lat, 90), ("lng", lng, 180)):
+        # bool is an int subclass, and a 2dsphere index rejects NaN and anything off the globe
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise InvalidLocation(f"{name} must be a number")
+        if not -limit <= value <= limit:
+            raise InvalidLocation(f"{name} must be between -{limit} and {limit}")
+    return {"type": "Point", "coordinates": [float(lng), float(lat)]}
+
+
+def with_geo(doc: dict) -> dict:
+    """
+    Adds the top-level 'geo' field that 2dsphere indexes need. Coordinates
+    stay in location as well since that's the shape the API returns, and
+    'geo' isn't a model field so views never project it. Raises
+    InvalidLocation for coordinates that aren't a point on the globe.
+    """
+    point = geo_point(doc.get("location"))
+    if point:
+        doc["geo"] = point
+    return doc
+
+
+def distance_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance on the same sphere MongoDB uses"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi, dlmb = phi2 - phi1, math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS / 1000 * math.asin(math.sqrt(a))
+
+
+async def backfill_geo(collection):
+    """Derive 'geo' for documents written before it existed"""
+    result = await collection.update_many(
+        {"geo": {"$exists": False},
+         "location.coordinates.lat": {"$type": "number"},
+         "location.coordinates.lng": {"$type": "number"}},
+        [{"$set": {"geo": {"type": "Point", "coordinates": [
+            "$location.coordinates.lng", "$location.coordinates.lat"
+        ]}}}],
+    )
+    if result.modified_count:
+        logger.info("Backfilled geo points on %d %s", result.modified_count, collection.name)
@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import Counter
+
+from cachetools import LRUCache
+
+logger = logging.getLogger("famigo.geocluster")
+
+# At this zoom and beyond the map shows individual venues
+CLUSTER_MAX_ZOOM = int(os.getenv("MAP_CLUSTER_MAX_ZOOM", "15"))
+# Each tile is split into 2**CELL_BITS x 2**CELL_BITS cells (4x4 -> ~64px clusters on 256px tiles)
+CELL_BITS = 2
+POINT_LEVEL = CLUSTER_MAX_ZOOM + CELL_BITS
+MAX_TILES_PER_QUERY = 64
+MAX_LAT = 85.05112878
+
+
+def tile_xy(lat: float, lng: float, level: int):
+    """Web Mercator tile coordinates of a point at a zoom level"""
+    n = 1 << level
+    lat = max(-MAX_LAT, min(MAX_LAT, lat))
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+class Cell:
+    __slots__ = ("count", "lat_sum", "lng_sum", "categories", "point")
+
+    def __init__(self):
+        self.count = 0
+        self.lat_sum = 0.0
+        self.lng_sum = 0.0
+        self.categories = Counter()
+        self.point = None  # the venue itself while the cell holds exactly one
+
+    def add_point(self, point: dict):
+        self.count += 1
+        self.lat_sum += point["lat"]
+        self.lng_sum += point["lng"]
+        self.categories[point["category"]] += 1
+        self.point = point if self.count == 1 else None
+
+    def merge(self, other: "Cell"):
+        self.point = other.point if self.count == 0 else None
+        self.count += other.count
+        self.lat_sum += other.lat_sum
+        self.lng_sum += other.lng_sum
+        self.categories.update(other.categories)
+
+    def to_marker(self):
+        if self.count == 1:
+            return {"type": "venue", **self.point}
+        return {
+            "type": "cluster",
+            "lat": round(self.lat_sum / self.count, 6),
+            "lng": round(self.lng_sum / self.count, 6),
+            "count": self.count,
+            "categories": dict(self.categories),
+        }
+
+
+def build_levels(venues):
+    points = {}
+    finest = {}
+    for v in venues:
+        coords = v["location"]["coordinates"]
+        point = {
+            "id": str(v["_id"]),
+            "name": v.get("name"),
+            "category": v.get("category"),
+            "lat": coords["lat"],
+            "lng": coords["lng"],
+        }
+        key = tile_xy(point["lat"], point["lng"], POINT_LEVEL)
+        points.setdefault(key, []).append(point)
+        cell = finest.get(key)
+        if cell is None:
+            cell = finest[key] = Cell()
+        cell.add_point(point)
+
+    levels = [None] * (POINT_LEVEL + 1)
+    levels[POINT_LEVEL] = finest
+    for level in range(POINT_LEVEL - 1, -1, -1):
+        parents = {}
+        for (x, y), child in levels[level + 1].items():
+            parent = parents.get((x >> 1, y >> 1))
+            if parent is None:
+                parent = parents[(x >> 1, y >> 1)] = Cell()
+            parent.merge(child)
+        levels[level] = parents
+    return levels, points
+
+
+class VenueGrid:
+    """
+    Venues bucketed into a Web Mercator quadtree: one dict of cells per level,
+    built bottom-up by merging each cell into its parent. Answering a tile is
+    a lookup of its 16 cells, and whole tiles are cached, so panning mostly
+    reuses tiles it has already seen. Any venue write marks the grid dirty
+    (it is registered on the cache bus as a cache), and the next read rebuilds
+    it from a lean projection.
+    """
+
+    def __init__(self):
+        self.levels = []  # levels[z] = {(x, y): Cell} for z in 0..POINT_LEVEL
+        self.points = {}  # (x, y) at POINT_LEVEL -> [venue points]
+        self.tiles = LRUCache(maxsize=int(os.getenv("MAP_TILE_CACHE_SIZE", "20000")))
+        self.dirty = True
+        self.built_at = None
+        self.build_ms = None
+        self.venue_count = 0
+        self.tile_hits = 0
+        self.tile_misses = 0
+        self._lock = asyncio.Lock()
+
+    # Cache-bus interface: any venue change invalidates the whole grid
+    def pop(self, key, default=None):
+        self.dirty = True
+        return default
+
+    def clear(self):
+        self.dirty = True
+
+    async def ensure_built(self, db, max_age: float = None):
+        """max_age bounds staleness while invalidations can't be trusted"""
+        if max_age is not None and self.built_at and time.time() - self.built_at > max_age:
+            self.dirty = True
+        if not self.dirty:
+            return
+        async with self._lock:
+            if self.dirty:
+                # Cleared before the read so a write during the rebuild dirties it again
+                self.dirty = False
+                try:
+                    await self.rebuild(db)
+                except Exception:
+                    self.dirty = True
+                    raise
+
+    async def rebuild(self, db):
+        started = time.perf_counter()
+        venues = await db.venues.find(
+            {"location.coordinates.lat": {"$type": "number"}, "location.coordinates.lng": {"$type": "number"}},
+            {"name": 1, "category": 1, "location.coordinates": 1}
+        ).to_list(None)
+
+        # CPU-bound bucketing runs off the event loop
+        levels, points = await asyncio.to_thread(build_levels, venues)
+
+        self.levels, self.points = levels, points
+        self.tiles.clear()
+        self.venue_count = len(venues)
+        self.built_at = time.time()
+        self.build_ms = round((time.perf_counter() - started) * 1000, 1)
+        logger.info("Built map grid for %d venues in %.0fms", len(venues), self.build_ms)
+
+    def tile(self, z: int, x: int, y: int):
+        key = (z, x, y)
+        markers = self.tiles.get(key)
+        if markers is not None:
+            self.tile_hits += 1
+            return markers
+        self.tile_misses += 1
+        if z >= CLUSTER_MAX_ZOOM:
+            markers = self._tile_points(z, x, y)
+        else:
+            cells = self.levels[z + CELL_BITS]
+            side = 1 << CELL_BITS
+            markers = []
+            for cx in range(x * side, (x + 1) * side):
+                for cy in range(y * side, (y + 1) * side):
+                    cell = cells.get((cx, cy))
+                    if cell is not None:
+                        markers.append(cell.to_marker())
+        self.tiles[key] = markers
+        return markers
+
+    def _tile_points(self, z: int, x: int, y: int):
+        if z <= POINT_LEVEL:
+            shift = POINT_LEVEL - z
+            return [
+                {"type": "venue", **p}
+                for cx in range(x << shift, (x + 1) << shift)
+                for cy in range(y << shift, (y + 1) << shift)
+                for p in self.points.get((cx, cy), ())
+            ]
+        # Tiles finer than the point buckets filter their parent bucket
+        shift = z - POINT_LEVEL
+        return [
+            {"type": "venue", **p} for p in self.points.get((x >> shift, y >> shift), ())
+            if tile_xy(p["lat"], p["lng"], z) == (x, y)
+        ]
+
+    def query(self, south: float, west: float, north: float, east: float, zoom: int):
+        zoom = max(0, min(zoom, 22))
+        n = 1 << zoom
+        x0, y0 = tile_xy(north, west, zoom)
+        x1, y1 = tile_xy(south, east, zoom)
+        # Viewports across the antimeridian wrap around
+        xs = list(range(x0, x1 + 1)) if x0 <= x1 else list(range(x0, n)) + list(range(0, x1 + 1))
+        ys = range(y0, y1 + 1)
+        if len(xs) * len(ys) > MAX_TILES_PER_QUERY:
+            raise ValueError("Viewport too large for this zoom")
+        markers = []
+        for x in xs:
+            for y in ys:
+                markers.extend(self.tile(zoom, x, y))
+        return markers
+
+    def stats(self):
+        total = self.tile_hits + self.tile_misses
+        return {
+            "venues": self.venue_count,
+            "built_at": self.built_at,
+            "build_ms": self.build_ms,
+            "dirty": self.dirty,
+            "cached_tiles": len(self.tiles),
+            "tile_hit_pct": round(100 * self.tile_hits / total, 1) if total else 0,
+        }
+
+
+venue_grid = VenueGrid()
@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import os
+import secrets
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import outbox
+
+logger = logging.getLogger("famigo.inventory")
+
+# Venues without a daily_capacity get this many tickets per day
+DEFAULT_VENUE_DAILY_CAPACITY = int(os.getenv("DEFAULT_VENUE_DAILY_CAPACITY", "200"))
+# Pending bookings hold their tickets this long before they are released
+HOLD_MINUTES = int(os.getenv("BOOKING_HOLD_MINUTES", "15"))
+REAPER_INTERVAL_SECONDS = 30
+# Bookings that hold or use tickets; cancelled and expired ones don't
+ACTIVE_STATUSES = ("pending", "confirmed")
+
+# No 0/O/1/I so codes survive being read out at the gate
+TICKET_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+TICKET_CODE_LENGTH = 10
+
+
+class SoldOut(Exception):
+    pass
+
+
+class UnknownListing(Exception):
+    pass
+
+
+def new_ticket_code() -> str:
+    return "".join(secrets.choice(TICKET_ALPHABET) for _ in range(TICKET_CODE_LENGTH))
+
+
+def slot_id(venue_id, event_id, date: datetime) -> str:
+    """
+    One counter document per slot, so concurrent bookings only contend per slot.
+    An event has a single slot: its capacity doesn't depend on the client's date.
+    Venues get one slot per day.
+    """
+    if event_id:
+        return f"event:{event_id}"
+    return f"venue:{venue_id}:{date.date().isoformat()}"
+
+
+async def assign_missing_ticket_codes(db) -> int:
+    """Give bookings without a code, or sharing one, a fresh code so the unique index can build"""
+    duplicates = await db.bookings.aggregate([
+        {"$group": {"_id": "$ticket_code", "ids": {"$push": "$_id"}, "n": {"$sum": 1}}},
+        {"$match": {"$or": [{"n": {"$gt": 1}}, {"_id": None}]}},
+    ]).to_list(None)
+    fixed = 0
+    for group in duplicates:
+        # The first booking keeps a real code it already has
+        ids = group["ids"] if group["_id"] is None else group["ids"][1:]
+        for booking_id in ids:
+            await db.bookings.update_one({"_id": booking_id}, {"$set": {"ticket_code": new_ticket_code()}})
+            fixed += 1
+    return fixed
+
+
+async def ensure_inventory_indexes(db):
+    fixed = await assign_missing_ticket_codes(db)
+    if fixed:
+        logger.warning("Assigned new ticket codes to %d bookings with missing or duplicate codes", fixed)
+    try:
+        await db.bookings.create_index([("ticket_code", ASCENDING)], unique=True)
+    except DuplicateKeyError:
+        logger.error("Duplicate ticket codes exist; the unique ticket_code index could not be built")
+    await db.bookings.create_index([("status", ASCENDING), ("hold_expires_at", ASCENDING)])
+    await db.bookings.create_index([("event_id", ASCENDING), ("status", ASCENDING)])
+    # Expired bookings whose tickets the reaper still has to give back
+    await db.bookings.create_index([("status", ASCENDING), ("slot_released_at", ASCENDING)])
+
+
+async def slot_capacity(db, venue_id, event_id) -> int:
+    if event_id:
+        if not ObjectId.is_valid(event_id):
+            raise UnknownListing(event_id)
+        event = await db.events.find_one({"_id": ObjectId(event_id)}, {"max_participants": 1})
+        if not event:
+            raise UnknownListing(event_id)
+        return int(event.get("max_participants") or 0)
+    if not venue_id or not ObjectId.is_valid(venue_id):
+        raise UnknownListing(venue_id)
+    venue = await db.venues.find_one({"_id": ObjectId(venue_id)}, {"daily_capacity": 1})
+    if not venue:
+        raise UnknownListing(venue_id)
+    return int(venue.get("daily_capacity") or DEFAULT_VENUE_DAILY_CAPACITY)
+
+
+async def booked_quantity(db, venue_id, event_id, date: datetime) -> int:
+    """Tickets already held or sold for a slot whose counter doesn't exist yet"""
+    query = {"status": {"$in": list(ACTIVE_STATUSES)}}
+    if event_id:
+        query["event_id"] = event_id
+    else:
+        day = datetime(date.year, date.month, date.day)
+        query.update({"venue_id": venue_id, "event_id": None,
+                      "date": {"$gte": day, "$lt": day + timedelta(days=1)}})
+    rows = await db.bookings.aggregate([
+        {"$match": query},
+        {"$group": {"_id": None, "n": {"$sum": {"$ifNull": ["$quantity", 1]}}}},
+    ]).to_list(1)
+    return rows[0]["n"] if rows else 0
+
+
+async def ensure_slot(db, venue_id, event_id, date: datetime) -> str:
+    """
+    The slot's counter id, creating the counter on the first booking for it.
+    A concurrent creator makes the insert fail, which is fine.
+    """
+    sid = slot_id(venue_id, event_id, date)
+    if await db.inventory.find_one({"_id": sid}, {"_id": 1}) is not None:
+        return sid
+    capacity = await slot_capacity(db, venue_id, event_id)
+    available = max(0, capacity - await booked_quantity(db, venue_id, event_id, date))
+    try:
+        await db.inventory.insert_one({"_id": sid, "capacity": capacity, "available": available})
+    except DuplicateKeyError:
+        pass
+    return sid
+
+
+async def take(db, sid: str, quantity: int, session=None):
+    """
+    Atomically take `quantity` tickets from the slot, or raise SoldOut.
+    The decrement only matches while enough tickets remain, so bursts never oversell.
+    """
+    slot = await db.inventory.find_one_and_update(
+        {"_id": sid, "available": {"$gte": quantity}},
+        {"$inc": {"available": -quantity}},
+        session=session,
+    )
+    if slot is None:
+        raise SoldOut(sid)
+
+
+async def release(db, sid: str, quantity: int, session=None):
+    await db.inventory.update_one({"_id": sid}, {"$inc": {"available": quantity}}, session=session)
+
+
+async def release_booking(db, booking: dict) -> bool:
+    """
+    Give a booking's tickets back exactly once. slot_released_at is set in the
+    same transaction as the release, so a crash leaves neither or both; without
+    transactions it is set first, and a crash in between loses tickets rather
+    than overselling them.
+    """
+    if not booking.get("slot_id") or booking.get("slot_released_at"):
+        return False
+
+    async def release_once(session):
+        result = await db.bookings.update_one(
+            {"_id": booking["_id"], "slot_released_at": None},
+            {"$set": {"slot_released_at": datetime.utcnow()}},
+            session=session,
+        )
+        if result.modified_count:
+            await release(db, booking["slot_id"], booking.get("quantity", 1), session=session)
+        return bool(result.modified_count)
+
+    return await outbox.run_transaction(db.client, release_once)
+
+
+async def transition(db, booking_id: str, from_statuses, update: dict, session=None):
+    """
+    Conditional state change: only applies when the booking is still in one of
+    `from_statuses`, so concurrent confirm/cancel/expire calls can't both win.
+    """
+    query = {"_id": ObjectId(booking_id), "status": {"$in": list(from_statuses)}}
+    if "pending" in from_statuses and update.get("status") == "confirmed":
+        # Bookings made before holds existed have no expiry
+        query["$or"] = [{"hold_expires_at": {"$gt": datetime.utcnow()}}, {"hold_expires_at": None}]
+    return await db.bookings.find_one_and_update(
+        query, {"$set": update}, return_document=ReturnDocument.BEFORE, session=session
+    )
+
+
+async def expire_holds(db) -> int:
+    """
+    Release tickets for pending bookings whose hold has lapsed. Expiring sets
+    slot_released_at to an explicit null until the release lands, so a
+    release interrupted by a crash is found again by the next pass. Bookings
+    expired before that have no such field and are never matched.
+    """
+    expired = 0
+    while True:
+        booking = await db.bookings.find_one_and_update(
+            {"status": "pending", "hold_expires_at": {"$lte": datetime.utcnow()}},
+            {"$set": {"status": "expired", "slot_released_at": None, "updated_at": datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if booking is None:
+            break
+        await release_booking(db, booking)
+        expired += 1
+    unreleased = db.bookings.find(
+        {"status": "expired", "slot_released_at": {"$type": "null"}, "slot_id": {"$exists": True}},
+        {"slot_id": 1, "quantity": 1, "slot_released_at": 1},
+    )
+    async for booking in unreleased:
+        await release_booking(db, booking)
+    return expired
+
+
+async def run_hold_reaper(db):
+    while True:
+        try:
+            expired = await expire_holds(db)
+            if expired:
+                logger.info("Released %d expired booking holds", expired)
+        except Exception:
+            logger.exception("Booking hold reaper failed")
+        await asyncio.sleep(REAPER_INTERVAL_SECONDS)
+
+
+def hold_expiry() -> datetime:
+    return datetime.utcnow() + timedelta(minutes=HOLD_MINUTES)
@@ -0,0 +1,34 @@
+#!/usr/bin/env bash
+# Starts a throwaway three-member replica set on localhost:27017-27019 for
+# testing secondary reads. Stop it with: ./local_replset.sh stop
+#
+# Then run the backend with:
+#   MONGO_URL="mongodb://localhost:27017,localhost:27018,localhost:27019/?replicaSet=rs0" \
+#   READ_FROM_SECONDARIES=true uvicorn server:app
+set -euo pipefail
+
+DATA_DIR="${REPLSET_DIR:-/tmp/famigo-rs0}"
+PORTS=(27017 27018 27019)
+
+if [[ "${1:-}" == "stop" ]]; then
+  for port in "${PORTS[@]}"; do
+    mongosh --quiet --port "$port" --eval 'db.getSiblingDB("admin").shutdownServer({force: true})' || true
+  done
+  exit 0
+fi
+
+for port in "${PORTS[@]}"; do
+  mkdir -p "$DATA_DIR/$port"
+  mongod --replSet rs0 --port "$port" --bind_ip localhost \
+    --dbpath "$DATA_DIR/$port" --logpath "$DATA_DIR/$port.log" --fork
+done
+
+mongosh --quiet --port 27017 --eval '
+  rs.initiate({_id: "rs0", members: [
+    {_id: 0, host: "localhost:27017", priority: 2},
+    {_id: 1, host: "localhost:27018"},
+    {_id: 2, host: "localhost:27019"}
+  ]});
+  while (!db.hello().isWritablePrimary) { sleep(200); }
+  print("rs0 ready");
+'
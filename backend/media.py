@@ -0,0 +1,203 @@
+import asyncio
+import base64
+import binascii
+import io
+import logging
+import multiprocessing
+import os
+import re
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+logger = logging.getLogger("famigo.media")
+
+MEDIA_ROOT = Path(os.getenv("MEDIA_ROOT", Path(__file__).parent / "media"))
+MEDIA_URL = "/api/media"
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", str(min(2, os.cpu_count() or 1))))
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(15 * 1024 * 1024)))
+# Decompression-bomb guard: a tiny file can still decode to gigabytes
+MAX_IMAGE_PIXELS = 50_000_000
+MAX_IMAGES = 10
+
+# Longest edge in pixels and WebP quality per variant
+VARIANTS = {
+    "thumb": (320, 70),
+    "medium": (960, 78),
+    "full": (2048, 82),
+}
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def decode_base64(data: str) -> bytes:
+    """Accepts bare base64 or a data: URI"""
+    if data.startswith("data:"):
+        data = data.partition(",")[2]
+    if len(data) * 3 // 4 > MAX_IMAGE_BYTES:
+        raise InvalidImage("Image is too large")
+    try:
+        return base64.b64decode(data, validate=False)
+    except (binascii.Error, ValueError):
+        raise InvalidImage("Image is not valid base64")
+
+
+def transcode(data: str, media_id: str, root: str) -> dict:
+    """Runs in a worker process: a base64 image in, stored variants out"""
+    return encode_variants(io.BytesIO(decode_base64(data)), media_id, root)
+
+
+def transcode_file(path: str, media_id: str, root: str) -> dict:
+    """Runs in a worker process: a streamed upload on disk in, stored variants out"""
+    with open(path, "rb") as f:
+        return encode_variants(f, media_id, root)
+
+
+def encode_variants(source, media_id: str, root: str) -> dict:
+    """
+    Decodes the image, applies and drops its EXIF orientation, and writes a
+    WebP per variant. Re-encoding from pixels drops EXIF, GPS and other
+    metadata. Returns the media document.
+    """
+    from PIL import Image, ImageOps
+
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    try:
+        with Image.open(source) as opened:
+            opened.load()
+            image = ImageOps.exif_transpose(opened)
+    except (Image.DecompressionBombError, OSError, SyntaxError) as e:
+        raise InvalidImage(f"Unsupported image: {e}")
+
+    image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+    directory = Path(root) / media_id[:2]
+    directory.mkdir(parents=True, exist_ok=True)
+
+    doc = {"id": media_id, "width": image.width, "height": image.height}
+    for name, (edge, quality) in VARIANTS.items():
+        variant = image.copy()
+        variant.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+        variant.save(directory / f"{media_id}_{name}.webp", "WEBP", quality=quality, method=4)
+        doc[name] = f"{MEDIA_URL}/{media_id[:2]}/{media_id}_{name}.webp"
+    return doc
+
+
+_executor = None
+
+
+def executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn, not fork: forking a process with Motor's threads running can deadlock
+        _executor = ProcessPoolExecutor(MEDIA_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def shutdown():
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+
+
+def variant_paths(media_id: str):
+    return [MEDIA_ROOT / media_id[:2] / f"{media_id}_{name}.webp" for name in VARIANTS]
+
+
+def is_media_url(value: str) -> bool:
+    return value.startswith(f"{MEDIA_URL}/")
+
+
+def is_remote_url(value: str) -> bool:
+    return value.startswith(("http://", "https://"))
+
+
+def is_inline(value: str) -> bool:
+    """A data: URI or bare base64 payload, as opposed to an image URL"""
+    return bool(value) and not is_media_url(value) and not is_remote_url(value)
+
+
+# Image entries that are URLs; anything else stored in images is an inline payload
+URL_IMAGE = re.compile(r"^(https?://|/)")
+
+
+def new_media_id() -> str:
+    return secrets.token_hex(12)
+
+
+async def run_in_pool(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor(), fn, *args)
+
+
+async def ingest_images(images) -> list:
+    """
+    Transcode a create call's base64 images into stored WebP variants, in
+    parallel across the process pool. Image URLs, ours or remote, are left
+    out: there is nothing to transcode.
+    """
+    uploads = [i for i in images if is_inline(i)]
+    if len(uploads) > MAX_IMAGES:
+        raise InvalidImage(f"At most {MAX_IMAGES} images are allowed")
+    if any(len(u) * 3 // 4 > MAX_IMAGE_BYTES for u in uploads):
+        # Checked here too so oversized payloads aren't shipped to a worker
+        raise InvalidImage("Image is too large")
+    return list(await asyncio.gather(*[
+        run_in_pool(transcode, upload, new_media_id(), str(MEDIA_ROOT)) for upload in uploads
+    ]))
+
+
+def resolve_images(images, transcoded) -> list:
+    """The stored images list: inline payloads replaced by their full variant, URLs kept as given"""
+    transcoded = iter(transcoded)
+    return [next(transcoded)["full"] if is_inline(i) else i for i in images if i]
+
+
+def thumb_url(url: str) -> str:
+    if is_media_url(url) and url.endswith("_full.webp"):
+        return url[:-len("_full.webp")] + "_thumb.webp"
+    return url
+
+
+def thumbnails_only(docs):
+    """
+    List endpoints: our images become thumbnail URLs and variant details are
+    dropped. Inline payloads not yet backfilled are left out rather than sent.
+    """
+    for doc in docs:
+        doc.pop("media", None)
+        doc["images"] = [thumb_url(i) for i in doc.get("images") or [] if not is_inline(i)]
+    return docs
+
+
+def list_projection(projection: dict) -> dict:
+    """A view's projection without variant details; thumbnails are derived from image URLs"""
+    return {k: v for k, v in projection.items() if k != "media"}
+
+
+async def backfill_inline_images(collection) -> int:
+    """
+    Transcode inline images stored before media variants existed, so list
+    endpoints stop carrying them. Payloads that don't decode are dropped.
+    """
+    converted = 0
+    cursor = collection.find({"media": {"$exists": False}, "images": {"$elemMatch": {"$not": URL_IMAGE}}},
+                             {"images": 1})
+    async for doc in cursor:
+        images, variants = [], []
+        for image in doc["images"]:
+            if not is_inline(image):
+                if image:
+                    images.append(image)
+                continue
+            try:
+                variant = await run_in_pool(transcode, image, new_media_id(), str(MEDIA_ROOT))
+            except InvalidImage as e:
+                logger.warning("Dropping undecodable image on %s %s: %s", collection.name, doc["_id"], e)
+                continue
+            variants.append(variant)
+            images.append(variant["full"])
+        await collection.update_one({"_id": doc["_id"]}, {"$set": {"media": variants, "images": images}})
+        converted += 1
+    if converted:
+        logger.info("Moved inline images of %d %s to media variants", converted, collection.name)
+    return converted
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import os
+import random
+import socket
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger("famigo.outbox")
+
+WORKER_CONCURRENCY = int(os.getenv("OUTBOX_WORKERS", "4"))
+LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+POLL_INTERVAL_SECONDS = 1.0
+BACKOFF_BASE_SECONDS = 2
+BACKOFF_MAX_SECONDS = 600
+
+# Set at startup; standalone servers can't run multi-document transactions
+supports_transactions = False
+
+
+class PermanentFailure(Exception):
+    """Raised by a handler when retrying can't help (e.g. card declined)"""
+
+
+async def ensure_outbox_indexes(db):
+    await db.outbox.create_index([("status", ASCENDING), ("available_at", ASCENDING)])
+    await db.outbox.create_index([("status", ASCENDING), ("lease_until", ASCENDING)])
+    # Finished messages only need to stick around long enough to debug
+    await db.outbox.create_index("completed_at", expireAfterSeconds=7 * 24 * 3600)
+
+
+async def detect_transaction_support(client):
+    global supports_transactions
+    hello = await client.admin.command("hello")
+    supports_transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+    if not supports_transactions:
+        logger.warning("MongoDB is not a replica set; outbox writes are not transactional")
+
+
+async def run_transaction(client, fn):
+    """
+    Returns await fn(session) inside a transaction, or fn(None) when the
+    deployment can't do transactions. The driver's with_transaction reruns fn
+    on TransientTransactionError (write conflicts with a concurrent confirm,
+    cancel or reaper) and retries an unknown commit result, for up to two
+    minutes, so fn must be safe to run more than once.
+    """
+    if not supports_transactions:
+        return await fn(None)
+    async with await client.start_session() as session:
+        return await session.with_transaction(fn)
+
+
+async def enqueue(db, message_type: str, payload: dict, idempotency_key: str, session=None, delay_seconds: int = 0):
+    """
+    Record a side effect to run later. The idempotency key is the document id, so
+    enqueueing the same effect twice is a no-op and handlers can pass it downstream.
+    """
+    now = datetime.utcnow()
+    if session is not None and session.in_transaction:
+        # A duplicate key error would abort the whole transaction, so look first.
+        # A concurrent insert of the same key is a write conflict, and the retry sees it.
+        if await db.outbox.find_one({"_id": idempotency_key}, {"_id": 1}, session=session):
+            return
+        await db.outbox.insert_one(message_doc(message_type, payload, idempotency_key, now, delay_seconds),
+                                   session=session)
+        return
+    try:
+        await db.outbox.insert_one(message_doc(message_type, payload, idempotency_key, now, delay_seconds),
+                                   session=session)
+    except DuplicateKeyError:
+        pass
+
+
+def message_doc(message_type: str, payload: dict, idempotency_key: str, now: datetime, delay_seconds: int) -> dict:
+    return {
+        "_id": idempotency_key,
+        "type": message_type,
+        "payload": payload,
+        "status": "pending",
+        "attempts": 0,
+        "available_at": now + timedelta(seconds=delay_seconds),
+        "lease_until": None,
+        "last_error": None,
+        "created_at": now,
+    }
+
+
+def backoff_seconds(attempts: int) -> float:
+    delay = min(BACKOFF_BASE_SECONDS * (2 ** (attempts - 1)), BACKOFF_MAX_SECONDS)
+    # Full jitter so retries from many workers don't line up
+    return random.uniform(delay / 2, delay)
+
+
+class OutboxWorkerPool:
+    """
+    Drains the outbox with a pool of asyncio workers. Messages are leased with a
+    conditional update, so several API processes can run pools side by side.
+    """
+
+    def __init__(self, db, handlers: dict, concurrency: int = WORKER_CONCURRENCY):
+        self.db = db
+        self.handlers = handlers
+        self.concurrency = concurrency
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._work(i)) for i in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _lease(self):
+        now = datetime.utcnow()
+        return await self.db.outbox.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "available_at": {"$lte": now}},
+                # A worker that died mid-message loses its lease
+                {"status": "processing", "lease_until": {"$lte": now}},
+            ]},
+            {"$set": {"status": "processing", "lease_owner": self.owner,
+                      "lease_until": now + timedelta(seconds=LEASE_SECONDS)},
+             "$inc": {"attempts": 1}},
+            sort=[("available_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def _work(self, worker_id: int):
+        while True:
+            try:
+                message = await self._lease()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Outbox worker %d failed to lease", worker_id)
+                message = None
+            if message is None:
+                await asyncio.sleep(POLL_INTERVAL_SECONDS)
+                continue
+            await self._process(message)
+
+    async def _process(self, message: dict):
+        handler = self.handlers.get(message["type"])
+        lease = {"_id": message["_id"], "lease_owner": self.owner, "status": "processing"}
+        if handler is None:
+            await self.db.outbox.update_one(lease, {"$set": {"status": "dead", "last_error": "no handler"}})
+            logger.error("No outbox handler for %s", message["type"])
+            return
+        try:
+            await asyncio.wait_for(handler(self.db, message["payload"], message["_id"]), timeout=LEASE_SECONDS)
+        except asyncio.CancelledError:
+            raise
+        except PermanentFailure as e:
+            await self.db.outbox.update_one(lease, {"$set": {"status": "dead", "last_error": str(e)}})
+            logger.warning("Outbox %s %s failed permanently: %s", message["type"], message["_id"], e)
+        except Exception as e:
+            if message["attempts"] >= MAX_ATTEMPTS:
+                await self.db.outbox.update_one(lease, {"$set": {"status": "dead", "last_error": repr(e)}})
+                logger.error("Outbox %s %s gave up after %d attempts: %r",
+                             message["type"], message["_id"], message["attempts"], e)
+            else:
+                retry_at = datetime.utcnow() + timedelta(seconds=backoff_seconds(message["attempts"]))
+                await self.db.outbox.update_one(lease, {"$set": {
+                    "status": "pending", "available_at": retry_at, "lease_until": None, "last_error": repr(e)
+                }})
+        else:
+            await self.db.outbox.update_one(lease, {"$set": {
+                "status": "done", "completed_at": datetime.utcnow(), "lease_until": None
+            }})
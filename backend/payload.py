@@ -0,0 +1,186 @@
+import gzip
+import os
+import time
+from collections import defaultdict
+
+import anyio.to_thread
+import orjson
+
+try:
+    import msgpack
+except ImportError:  # MessagePack is only offered when installed
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:  # gzip is always available
+    brotli = None
+
+# Smaller bodies cost more to compress than they save
+MIN_COMPRESS_BYTES = int(os.getenv("MIN_COMPRESS_BYTES", "1024"))
+# Bodies above this are compressed off the event loop at a cheaper level
+LARGE_BODY_BYTES = 256 * 1024
+# With this many responses being encoded at once, drop to the fastest level
+BUSY_ENCODES = 16
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+# Everything else (images, fonts, archives) is already compressed or binary
+COMPRESSIBLE_TYPES = ("application/json", "text/", *MSGPACK_TYPES)
+
+
+class RouteBytes:
+    def __init__(self):
+        self.responses = 0
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.encode_ms = 0.0
+        self.by_encoding = defaultdict(int)
+
+    def as_dict(self):
+        return {
+            "responses": self.responses,
+            "raw_bytes": self.raw_bytes,
+            "sent_bytes": self.sent_bytes,
+            "saved_pct": round(100 * (1 - self.sent_bytes / self.raw_bytes), 1) if self.raw_bytes else 0,
+            "avg_encode_ms": round(self.encode_ms / self.responses, 3) if self.responses else 0,
+            "by_encoding": dict(self.by_encoding),
+        }
+
+
+route_bytes = defaultdict(RouteBytes)
+
+
+def get_route_bytes():
+    return {route: stats.as_dict() for route, stats in sorted(route_bytes.items())}
+
+
+def accepts(header: str, token: str) -> bool:
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip() != token:
+            continue
+        q = params.replace(" ", "")
+        if q.startswith("q="):
+            try:
+                return float(q[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def compressible(content_type: str) -> bool:
+    return content_type.lower().startswith(COMPRESSIBLE_TYPES)
+
+
+def choose_encoding(accept_encoding: str):
+    if brotli is not None and accepts(accept_encoding, "br"):
+        return "br"
+    if accepts(accept_encoding, "gzip"):
+        return "gzip"
+    return None
+
+
+def compression_level(encoding: str, size: int, busy: bool) -> int:
+    """Spend CPU where it pays: best ratio for mid-size bodies, fastest when big or busy"""
+    if encoding == "br":
+        return 1 if busy or size > LARGE_BODY_BYTES else 5
+    return 1 if busy or size > LARGE_BODY_BYTES else 6
+
+
+def compress(body: bytes, encoding: str, level: int) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=level)
+    return gzip.compress(body, compresslevel=level)
+
+
+class PayloadMiddleware:
+    """
+    Re-encodes complete JSON responses as MessagePack when the client asks for it,
+    compresses JSON, MessagePack and text bodies over MIN_COMPRESS_BYTES with
+    brotli or gzip, and counts bytes per route. Streaming responses (SSE) and
+    binary bodies such as images pass through untouched and unbuffered.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._encoding_now = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]}
+        want_msgpack = msgpack is not None and any(accepts(headers.get("accept", ""), t) for t in MSGPACK_TYPES)
+        encoding = choose_encoding(headers.get("accept-encoding", ""))
+        start_message = None
+        passthrough = False
+
+        async def wrapped_send(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                content_type = dict(message["headers"]).get(b"content-type", b"").decode("latin-1")
+                if not compressible(content_type):
+                    # Static media and other binary bodies go out as they come, unbuffered
+                    passthrough = True
+                    await send(message)
+                    return
+                start_message = message
+                return
+            if message["type"] == "http.response.body":
+                if message.get("more_body", False):
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+                await self._finish(scope, start_message, message.get("body", b""), want_msgpack, encoding, send)
+
+        await self.app(scope, receive, wrapped_send)
+
+    async def _finish(self, scope, start_message, body, want_msgpack, encoding, send):
+        started = time.perf_counter()
+        vary = [v for k, v in start_message["headers"] if k.lower() == b"vary"]
+        headers = [(k, v) for k, v in start_message["headers"]
+                   if k.lower() not in (b"content-length", b"content-type", b"vary")]
+        content_type = dict(start_message["headers"]).get(b"content-type", b"").decode("latin-1")
+        already_encoded = any(k.lower() == b"content-encoding" for k, _ in headers)
+        raw_size = len(body)
+        label = "identity"
+
+        self._encoding_now += 1
+        try:
+            if want_msgpack and content_type.startswith("application/json") and body:
+                body = msgpack.packb(orjson.loads(body))
+                content_type = "application/msgpack"
+                label = "msgpack"
+
+            if encoding and not already_encoded and len(body) >= MIN_COMPRESS_BYTES:
+                level = compression_level(encoding, len(body), self._encoding_now > BUSY_ENCODES)
+                if len(body) > LARGE_BODY_BYTES:
+                    body = await anyio.to_thread.run_sync(compress, body, encoding, level)
+                else:
+                    body = compress(body, encoding, level)
+                headers.append((b"content-encoding", encoding.encode()))
+                label = f"{label}+{encoding}" if label != "identity" else encoding
+        finally:
+            self._encoding_now -= 1
+
+        headers.append((b"content-length", str(len(body)).encode()))
+        if content_type:
+            headers.append((b"content-type", content_type.encode("latin-1")))
+        headers.append((b"vary", b", ".join(vary + [b"Accept, Accept-Encoding"])))
+
+        route = scope.get("route")
+        stats = route_bytes[f"{scope['method']} {route.path if route is not None else 'unmatched'}"]
+        stats.responses += 1
+        stats.raw_bytes += raw_size
+        stats.sent_bytes += len(body)
+        stats.encode_ms += (time.perf_counter() - started) * 1000
+        stats.by_encoding[label] += 1
+
+        await send({**start_message, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import math
+import os
+import socket
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger("famigo.popularity")
+
+INTERVAL_SECONDS = int(os.getenv("POPULARITY_INTERVAL_SECONDS", "900"))
+HALF_LIFE_DAYS = float(os.getenv("POPULARITY_HALF_LIFE_DAYS", "30"))
+# Activity older than this many half-lives contributes under 2% and is skipped
+WINDOW_HALF_LIVES = 6
+BATCH_SIZE = int(os.getenv("POPULARITY_BATCH_SIZE", "500"))
+# Pause between batches so a recompute never saturates the primary
+BATCH_PAUSE_SECONDS = float(os.getenv("POPULARITY_BATCH_PAUSE", "0.2"))
+LEASE_SECONDS = 600
+JOB_ID = "venue_popularity"
+
+WEIGHTS = {"review": 3.0, "favorite": 2.0, "booking": 4.0, "event": 1.0}
+
+_decay_rate = math.log(2) / (HALF_LIFE_DAYS * 86400 * 1000)  # per millisecond
+
+
+async def ensure_popularity_indexes(db):
+    await db.venues.create_index([("popularity_score", -1)])
+    await db.venues.create_index([("category", 1), ("popularity_score", -1)])
+    await db.venues.create_index([("rating", -1), ("total_reviews", -1)])
+    await db.venues.create_index([("created_at", -1)])
+    # Batched lookups below are venue-first range scans
+    await db.bookings.create_index([("venue_id", 1), ("created_at", -1)])
+    await db.favorites.create_index([("item_id", 1), ("created_at", -1)])
+
+
+def decay(field: str, now: datetime, absolute: bool = False):
+    """exp(-λ·age) as an aggregation expression, halving every HALF_LIFE_DAYS"""
+    age = {"$subtract": [now, field]}
+    if absolute:
+        age = {"$abs": age}
+    return {"$exp": {"$multiply": [-_decay_rate, age]}}
+
+
+def batch_pipelines(venue_ids, now: datetime):
+    cutoff = now - timedelta(days=HALF_LIFE_DAYS * WINDOW_HALF_LIVES)
+    horizon = now + timedelta(days=HALF_LIFE_DAYS * WINDOW_HALF_LIVES)
+    return {
+        "reviews": [
+            {"$match": {"venue_id": {"$in": venue_ids}, "created_at": {"$gte": cutoff}}},
+            {"$group": {"_id": "$venue_id", "score": {"$sum": {"$multiply": [
+                WEIGHTS["review"], {"$divide": [{"$ifNull": ["$rating", 0]}, 5]}, decay("$created_at", now)
+            ]}}}},
+        ],
+        "favorites": [
+            {"$match": {"item_id": {"$in": venue_ids}, "created_at": {"$gte": cutoff}}},
+            {"$group": {"_id": "$item_id", "score": {"$sum": {"$multiply": [
+                WEIGHTS["favorite"], decay("$created_at", now)
+            ]}}}},
+        ],
+        "bookings": [
+            {"$match": {"venue_id": {"$in": venue_ids}, "created_at": {"$gte": cutoff},
+                        "status": {"$nin": ["cancelled", "expired"]}}},
+            {"$group": {"_id": "$venue_id", "score": {"$sum": {"$multiply": [
+                WEIGHTS["booking"], {"$ifNull": ["$quantity", 1]}, decay("$created_at", now)
+            ]}}}},
+        ],
+        # Events count both ways in time: a busy upcoming weekend makes a venue popular now
+        "events": [
+            {"$match": {"venue_id": {"$in": venue_ids}, "date": {"$gte": cutoff, "$lte": horizon}}},
+            {"$group": {"_id": "$venue_id", "score": {"$sum": {"$multiply": [
+                WEIGHTS["event"], {"$add": [1, {"$ifNull": ["$current_participants", 0]}]},
+                decay("$date", now, absolute=True)
+            ]}}}},
+        ],
+    }
+
+
+async def score_batch(db, venue_ids, now: datetime) -> dict:
+    pipelines = batch_pipelines(venue_ids, now)
+    results = await asyncio.gather(*[
+        db[collection].aggregate(pipeline).to_list(None) for collection, pipeline in pipelines.items()
+    ])
+    scores = dict.fromkeys(venue_ids, 0.0)
+    for rows in results:
+        for row in rows:
+            if row["_id"] in scores:
+                scores[row["_id"]] += row["score"]
+    return scores
+
+
+async def recompute(db) -> int:
+    """Score every venue in _id order, one batch at a time; returns venues scored"""
+    now = datetime.utcnow()
+    scored = 0
+    last_id = None
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id else {}
+        batch = await db.venues.find(query, {"_id": 1}).sort("_id", 1).limit(BATCH_SIZE).to_list(BATCH_SIZE)
+        if not batch:
+            return scored
+        last_id = batch[-1]["_id"]
+        scores = await score_batch(db, [str(v["_id"]) for v in batch], now)
+        await db.venues.bulk_write([
+            UpdateOne({"_id": v["_id"]}, {"$set": {
+                "popularity_score": round(scores[str(v["_id"])], 4), "popularity_updated_at": now
+            }}) for v in batch
+        ], ordered=False)
+        scored += len(batch)
+        await asyncio.sleep(BATCH_PAUSE_SECONDS)
+
+
+async def claim_run(db, owner: str, job_id: str = JOB_ID, interval_seconds: int = INTERVAL_SECONDS,
+                    lease_seconds: int = LEASE_SECONDS) -> bool:
+    """One worker per interval across the deployment runs the job"""
+    now = datetime.utcnow()
+    try:
+        await db.job_runs.find_one_and_update(
+            {"_id": job_id,
+             "last_run_at": {"$not": {"$gt": now - timedelta(seconds=interval_seconds)}},
+             "lease_until": {"$not": {"$gt": now}}},
+            {"$set": {"lease_owner": owner, "lease_until": now + timedelta(seconds=lease_seconds)}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # The job document exists and isn't due
+        return False
+    return True
+
+
+async def run_popularity_job(db):
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        try:
+            if await claim_run(db, owner):
+                started = datetime.utcnow()
+                scored = await recompute(db)
+                await db.job_runs.update_one(
+                    {"_id": JOB_ID},
+                    {"$set": {"last_run_at": started, "lease_until": None, "venues_scored": scored,
+                              "duration_seconds": (datetime.utcnow() - started).total_seconds()}},
+                )
+                logger.info("Scored popularity for %d venues", scored)
+        except Exception:
+            logger.exception("Venue popularity job failed")
+        await asyncio.sleep(60)
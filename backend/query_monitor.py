@@ -0,0 +1,226 @@
+import asyncio
+import contextvars
+import logging
+import os
+from collections import defaultdict
+
+from pymongo import monitoring
+
+logger = logging.getLogger("famigo.queries")
+
+# Commands slower than this are logged with their filter shape
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+# Run an explain for slow commands (costs an extra round trip, keep off by default)
+EXPLAIN_SLOW_QUERIES = os.getenv("EXPLAIN_SLOW_QUERIES", "false").lower() == "true"
+# Requests issuing more commands than this are flagged as likely N+1
+MAX_QUERIES_PER_REQUEST = int(os.getenv("MAX_QUERIES_PER_REQUEST", "10"))
+
+# Commands that are driver housekeeping rather than application queries
+IGNORED_COMMANDS = {"hello", "ismaster", "isMaster", "ping", "saslStart", "saslContinue",
+                    "endSessions", "buildInfo", "explain", "killCursors"}
+
+# Filter locations per command name
+FILTER_FIELDS = {
+    "find": "filter",
+    "count": "query",
+    "distinct": "query",
+    "findAndModify": "query",
+    "delete": "deletes",
+    "update": "updates",
+    "aggregate": "pipeline",
+}
+
+EXPLAINABLE_COMMANDS = {"find", "count", "distinct", "aggregate", "findAndModify"}
+
+
+class RequestQueryStats:
+    """Mongo round trips issued while serving a single HTTP request"""
+
+    def __init__(self, route: str):
+        self.route = route
+        self.count = 0
+        self.duration_ms = 0.0
+        self.docs_returned = 0
+        self.commands = []
+
+    def record(self, command_name: str, collection: str, duration_ms: float, docs: int):
+        self.count += 1
+        self.duration_ms += duration_ms
+        self.docs_returned += docs
+        self.commands.append((command_name, collection))
+
+
+class RouteQueryTotals:
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.duration_ms = 0.0
+        self.docs_returned = 0
+        self.max_queries = 0
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "queries": self.queries,
+            "avg_queries_per_request": round(self.queries / self.requests, 2) if self.requests else 0,
+            "max_queries_per_request": self.max_queries,
+            "db_time_ms": round(self.duration_ms, 2),
+            "docs_returned": self.docs_returned,
+        }
+
+
+# Set per request by the middleware. Motor copies the context into its executor
+# threads, so listener callbacks see the stats object of the request that issued
+# the command.
+current_request_stats: contextvars.ContextVar = contextvars.ContextVar("current_request_stats", default=None)
+
+route_totals = defaultdict(RouteQueryTotals)
+
+
+def filter_shape(value):
+    """Replace literal values with their type name so filters can be grouped and logged safely"""
+    if isinstance(value, dict):
+        return {k: filter_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(v, dict) for v in value):
+            return [filter_shape(v) for v in value]
+        return ["<array>"]
+    return f"<{type(value).__name__}>"
+
+
+def extract_filter(command_name: str, command: dict):
+    field = FILTER_FIELDS.get(command_name)
+    if not field or field not in command:
+        return None
+    value = command[field]
+    if command_name == "delete":
+        return [d.get("q") for d in value]
+    if command_name == "update":
+        return [u.get("q") for u in value]
+    return value
+
+
+def docs_in_reply(command_name: str, reply: dict) -> int:
+    cursor = reply.get("cursor")
+    if cursor:
+        return len(cursor.get("firstBatch") or cursor.get("nextBatch") or [])
+    if command_name == "findAndModify":
+        return 1 if reply.get("value") else 0
+    if command_name in ("count", "delete", "update", "insert"):
+        return int(reply.get("n", 0))
+    if command_name == "distinct":
+        return len(reply.get("values", []))
+    return 0
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Attributes every Mongo command to the HTTP request that issued it"""
+
+    def __init__(self):
+        self._pending = {}
+        self._loop = None
+        self._db = None
+
+    def enable_explain(self, loop, db):
+        """Slow-query explains are issued through the app's Motor database on its event loop"""
+        self._loop = loop
+        self._db = db
+
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+        stats = current_request_stats.get()
+        # getMore names its cursor id first; later batches count against the request too
+        collection = event.command.get("collection") if event.command_name == "getMore" \
+            else event.command.get(event.command_name)
+        self._pending[(event.connection_id, event.request_id)] = (
+            stats,
+            collection,
+            extract_filter(event.command_name, event.command),
+            event.command if event.command_name in EXPLAINABLE_COMMANDS else None,
+        )
+
+    def succeeded(self, event):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None:
+            return
+        stats, collection, query_filter, command = pending
+        duration_ms = event.duration_micros / 1000
+        docs = docs_in_reply(event.command_name, event.reply)
+        if stats is not None:
+            stats.record(event.command_name, collection, duration_ms, docs)
+        if duration_ms >= SLOW_QUERY_MS:
+            self._log_slow(event.command_name, collection, query_filter, duration_ms, docs, stats, command)
+
+    def failed(self, event):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None:
+            return
+        stats, collection, query_filter, _ = pending
+        duration_ms = event.duration_micros / 1000
+        if stats is not None:
+            stats.record(event.command_name, collection, duration_ms, 0)
+        logger.warning(
+            "Mongo %s on %s failed after %.1fms: %s (filter=%s)",
+            event.command_name, collection, duration_ms, event.failure, filter_shape(query_filter),
+        )
+
+    def _log_slow(self, command_name, collection, query_filter, duration_ms, docs, stats, command):
+        route = stats.route if stats else "-"
+        logger.warning(
+            "Slow Mongo %s on %s took %.1fms, returned %d docs (route=%s, filter=%s)",
+            command_name, collection, duration_ms, docs, route, filter_shape(query_filter),
+        )
+        if EXPLAIN_SLOW_QUERIES and command is not None and self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._explain(command_name, collection, command), self._loop)
+
+    async def _explain(self, command_name, collection, command):
+        explain_cmd = {k: v for k, v in command.items() if not k.startswith("$") and k != "lsid"}
+        try:
+            plan = await self._db.command({"explain": explain_cmd, "verbosity": "queryPlanner"})
+        except Exception as e:
+            logger.warning("Explain for slow %s on %s failed: %s", command_name, collection, e)
+            return
+        winning = plan.get("queryPlanner", {}).get("winningPlan", {})
+        logger.warning("Explain for slow %s on %s: %s", command_name, collection, summarize_plan(winning))
+
+
+def summarize_plan(plan: dict) -> str:
+    """Flatten a winning plan into e.g. 'FETCH <- IXSCAN(venue_id_1)' to spot collection scans"""
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if stage == "IXSCAN":
+            stage = f"IXSCAN({plan.get('indexName')})"
+        stages.append(stage)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return " <- ".join(stages)
+
+
+def start_request(route: str):
+    stats = RequestQueryStats(route)
+    token = current_request_stats.set(stats)
+    return stats, token
+
+
+def finish_request(stats: RequestQueryStats, token):
+    current_request_stats.reset(token)
+    totals = route_totals[stats.route]
+    totals.requests += 1
+    totals.queries += stats.count
+    totals.duration_ms += stats.duration_ms
+    totals.docs_returned += stats.docs_returned
+    totals.max_queries = max(totals.max_queries, stats.count)
+    if stats.count > MAX_QUERIES_PER_REQUEST:
+        logger.warning(
+            "%s issued %d Mongo commands (%.1fms): %s",
+            stats.route, stats.count, stats.duration_ms,
+            ", ".join(f"{name}:{coll}" for name, coll in stats.commands),
+        )
+
+
+def get_route_totals():
+    return {route: totals.as_dict() for route, totals in sorted(route_totals.items())}
+
+
+query_listener = MongoCommandListener()
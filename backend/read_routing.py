@@ -0,0 +1,124 @@
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import time
+from collections.abc import Mapping
+from contextlib import asynccontextmanager
+
+from bson import BSON
+from bson.timestamp import Timestamp
+from cachetools import TTLCache
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import SecondaryPreferred
+from pymongo.write_concern import WriteConcern
+
+# Browse traffic goes to secondaries only when this is on (needs a replica set)
+READ_FROM_SECONDARIES = os.getenv("READ_FROM_SECONDARIES", "false").lower() == "true"
+# Secondaries lagging more than this are skipped (MongoDB's minimum is 90)
+MAX_STALENESS_SECONDS = int(os.getenv("MAX_STALENESS_SECONDS", "90"))
+
+CAUSAL_HEADER = "x-causal-token"
+# Tokens are signed so clients can't hand the driver arbitrary cluster times.
+# Every worker needs the same secret to honour each other's tokens.
+TOKEN_SECRET = os.getenv("CAUSAL_TOKEN_SECRET", "").encode() or secrets.token_bytes(32)
+# Allowed drift between a token's operation time and this host's clock
+MAX_CLOCK_SKEW_SECONDS = 30
+
+logger = logging.getLogger("famigo.read_routing")
+if not os.getenv("CAUSAL_TOKEN_SECRET"):
+    logger.warning("CAUSAL_TOKEN_SECRET is not set; causal tokens are only honoured by the worker that issued them")
+
+
+def _sign(payload: bytes) -> bytes:
+    return hmac.new(TOKEN_SECRET, payload, hashlib.sha256).digest()[:16]
+
+
+def encode_token(cluster_time, operation_time) -> str:
+    payload = BSON.encode({"c": cluster_time, "o": operation_time})
+    return f"{base64.urlsafe_b64encode(payload).decode()}.{base64.urlsafe_b64encode(_sign(payload)).decode()}"
+
+
+def valid_times(cluster_time, operation_time) -> bool:
+    """The shapes the driver expects, and no operation time from the future"""
+    return (
+        isinstance(cluster_time, Mapping)
+        and isinstance(cluster_time.get("clusterTime"), Timestamp)
+        and "signature" in cluster_time
+        and isinstance(operation_time, Timestamp)
+        and operation_time <= cluster_time["clusterTime"]
+        and cluster_time["clusterTime"].time <= time.time() + MAX_CLOCK_SKEW_SECONDS
+    )
+
+
+def decode_token(token: str):
+    """(cluster_time, operation_time) from a token we issued, or None for anything else"""
+    try:
+        payload, _, signature = token.partition(".")
+        payload = base64.urlsafe_b64decode(payload.encode())
+        if not hmac.compare_digest(base64.urlsafe_b64decode(signature.encode()), _sign(payload)):
+            return None
+        doc = BSON(payload).decode()
+        times = doc["c"], doc["o"]
+    except Exception:
+        return None
+    return times if valid_times(*times) else None
+
+
+class ReadRouter:
+    """
+    Routes catalog and feed list reads to secondaries. A user who just wrote
+    reads through a causally consistent session that is advanced past their
+    write, so a lagging secondary waits until it has the write rather than
+    returning stale data. The write's times are kept per user in this worker
+    and also handed to the client as X-Causal-Token, so any worker can honour
+    them.
+    """
+
+    def __init__(self, client, db_name: str):
+        self.client = client
+        self.primary = client[db_name]
+        # Majority writes + majority reads are what make causal sessions read-your-writes
+        self.writes = client.get_database(db_name, write_concern=WriteConcern(w="majority"))
+        if READ_FROM_SECONDARIES:
+            self.catalog = client.get_database(
+                db_name,
+                read_preference=SecondaryPreferred(max_staleness=MAX_STALENESS_SECONDS),
+                read_concern=ReadConcern("majority"),
+            )
+        else:
+            self.catalog = self.primary
+        self._recent_writes = TTLCache(maxsize=100000, ttl=MAX_STALENESS_SECONDS * 2)
+
+    @asynccontextmanager
+    async def write_session(self, user_id: str = None):
+        """Yields a causal session for a user's write and remembers where it landed"""
+        async with await self.client.start_session(causal_consistency=True) as session:
+            yield session
+            # Standalone servers have no cluster time; reads there are from the primary anyway
+            if user_id and session.cluster_time and session.operation_time:
+                self._recent_writes[user_id] = (session.cluster_time, session.operation_time)
+
+    def token(self, user_id: str):
+        """X-Causal-Token for the user's last write in this worker, if it's recent"""
+        times = self._recent_writes.get(user_id)
+        return encode_token(*times) if times else None
+
+    @asynccontextmanager
+    async def read_session(self, user_id: str = None, token: str = None):
+        """
+        Yields a session advanced past the user's last write, or None when the
+        user hasn't written recently and any secondary will do.
+        """
+        times = decode_token(token) if token else None
+        if times is None and user_id:
+            times = self._recent_writes.get(user_id)
+        if times is None or not READ_FROM_SECONDARIES:
+            yield None
+            return
+        async with await self.client.start_session(causal_consistency=True) as session:
+            session.advance_cluster_time(times[0])
+            session.advance_operation_time(times[1])
+            yield session
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime
+
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger("famigo.realtime")
+
+# Messages a slow connection may have queued before it is told to resync
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv("REALTIME_QUEUE_SIZE", "100"))
+MAX_TOPICS_PER_CONNECTION = 50
+HEARTBEAT_SECONDS = 15
+TOPIC_PREFIXES = ("post:", "event:", "feed:")
+
+RESYNC = json.dumps({"type": "resync"})
+
+
+def valid_topic(topic: str) -> bool:
+    return topic.startswith(TOPIC_PREFIXES) and len(topic) < 100
+
+
+class Subscriber:
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.topics = set()
+
+    def deliver(self, payload: str):
+        """
+        Never blocks the publisher. When the client can't keep up, its backlog is
+        replaced by a single resync notice so it refetches instead of replaying.
+        """
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+
+class Broker:
+    """
+    Topic fan-out to local connections. Messages are published through the
+    realtime_events collection and picked up by every worker's change stream;
+    without a replica set they are delivered in-process only.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._topics = defaultdict(set)
+        self._task = None
+        self.use_change_stream = False
+        self.delivered = 0
+
+    def subscribe(self, subscriber: Subscriber, topic: str):
+        if len(subscriber.topics) >= MAX_TOPICS_PER_CONNECTION:
+            return False
+        subscriber.topics.add(topic)
+        self._topics[topic].add(subscriber)
+        return True
+
+    def unsubscribe(self, subscriber: Subscriber, topic: str = None):
+        topics = [topic] if topic else list(subscriber.topics)
+        for t in topics:
+            subscriber.topics.discard(t)
+            subs = self._topics.get(t)
+            if subs is not None:
+                subs.discard(subscriber)
+                if not subs:
+                    del self._topics[t]
+
+    def subscriber_count(self) -> int:
+        return sum(len(s) for s in self._topics.values())
+
+    def _fan_out(self, topic: str, payload: str):
+        # Encoded once, shared by every subscriber on the topic
+        for subscriber in tuple(self._topics.get(topic, ())):
+            subscriber.deliver(payload)
+            self.delivered += 1
+
+    async def publish(self, topic: str, message: dict):
+        if not self._topics.get(topic) and not self.use_change_stream:
+            return
+        payload = json.dumps({"topic": topic, **message}, default=str)
+        if self.use_change_stream:
+            await self.db.realtime_events.insert_one(
+                {"topic": topic, "payload": payload, "created_at": datetime.utcnow()}
+            )
+        else:
+            self._fan_out(topic, payload)
+
+    async def start(self):
+        await self.db.realtime_events.create_index("created_at", expireAfterSeconds=3600)
+        try:
+            hello = await self.db.client.admin.command("hello")
+        except Exception:
+            hello = {}
+        if "setName" in hello or hello.get("msg") == "isdbgrid":
+            self.use_change_stream = True
+            self._task = asyncio.create_task(self._watch())
+        else:
+            logger.warning("Change streams unavailable; realtime updates are delivered within this worker only")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _watch(self):
+        pipeline = [
+            {"$match": {"operationType": "insert"}},
+            {"$project": {"fullDocument.topic": 1, "fullDocument.payload": 1}},
+        ]
+        resume_token = None
+        while True:
+            try:
+                async with self.db.realtime_events.watch(pipeline, resume_after=resume_token) as stream:
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        doc = change["fullDocument"]
+                        if doc["topic"] in self._topics:
+                            self._fan_out(doc["topic"], doc["payload"])
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                # Resume token fell off the oplog; start from now
+                logger.warning("Realtime change stream restarted: %s", e)
+                resume_token = None
+                await asyncio.sleep(1)
+            except Exception:
+                logger.exception("Realtime change stream failed")
+                await asyncio.sleep(1)
@@ -4,6 +4,7 @@ import os
 from dotenv import load_dotenv
 from pathlib import Path
 from datetime import datetime, timedelta
+from geo import with_geo
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -146,7 +147,7 @@ async def seed_database():
         },
     ]
     
-    result = await db.venues.insert_many(venues)
+    result = await db.venues.insert_many([with_geo(v) for v in venues])
     venue_ids = [str(id) for id in result.inserted_ids]
     print(f"✓ Created {len(venues)} venues")
     
@@ -219,7 +220,7 @@ async def seed_database():
         },
     ]
     
-    await db.events.insert_many(events)
+    await db.events.insert_many([with_geo(e) for e in events])
     print(f"✓ Created {len(events)} events")
     
     # Sample Reviews
@@ -1,27 +1,62 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Query
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Request, Response, BackgroundTasks, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
-from datetime import datetime
+from typing import List, Optional, Literal
+from datetime import datetime, timezone
 from bson import ObjectId
-from emergentintegrations.llm.chat import LlmChat, UserMessage
+from cachetools import TTLCache
+from pymongo import UpdateOne, DeleteOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 import json
 from admin_routes import admin_router
+from query_monitor import query_listener, start_request, finish_request
+import feed
+import inventory
+import outbox
+import booking_effects
+import counters
+import realtime
+from fast_json import DocumentResponse, DocumentView
+from payload import PayloadMiddleware
+from admission import AdmissionMiddleware
+import startup
+from coherence import bus
+from singleflight import flight
+from read_routing import ReadRouter, CAUSAL_HEADER
+from geocluster import venue_grid
+from autocomplete import autocomplete
+import popularity
+from geo import with_geo, backfill_geo, InvalidLocation, distance_km, EARTH_RADIUS_METERS
+import media
+import uploads
+import archive
+import coherence
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[query_listener])
 db = client[os.environ['DB_NAME']]
+# Catalog and feed lists may be served by secondaries; see read_routing.py
+reads = ReadRouter(client, os.environ['DB_NAME'])
+
+# Hot counters (likes, comment counts, participants) are buffered and flushed in batches
+counter_buffer = counters.CounterBuffer(db)
+POST_COUNTERS = ("likes", "comment_count")
+EVENT_COUNTERS = ("current_participants",)
+
+# Pushes feed, reaction and RSVP changes to WebSocket/SSE subscribers
+broker = realtime.Broker(db)
 
 # Create the main app
 app = FastAPI()
@@ -34,6 +69,23 @@ def serialize_doc(doc):
         del doc["_id"]
     return doc
 
+async def with_live_counts(collection: str, docs, fields):
+    """Add counter deltas that haven't reached the document yet"""
+    await counter_buffer.merge_shards(collection, docs, fields)
+    for doc in docs:
+        counter_buffer.merge_pending(collection, doc, fields)
+    return docs
+
+def viewer_session(request: Request, user_id: Optional[str] = None):
+    """Causal session for a viewer who just wrote, so their own writes are visible"""
+    return reads.read_session(request.headers.get("x-user-id") or user_id, request.headers.get(CAUSAL_HEADER))
+
+def set_causal_token(response: Response, user_id: str):
+    token = reads.token(user_id)
+    if token:
+        # Sent back on the next read so any worker can make it causal
+        response.headers[CAUSAL_HEADER] = token
+
 # ==================== MODELS ====================
 
 class Venue(BaseModel):
@@ -42,14 +94,17 @@ class Venue(BaseModel):
     description: str
     category: str  # Indoor, Outdoor, Farm, Playground, Circus, Learning, Free
     location: dict  # {address, city, coordinates: {lat, lng}}
-    images: List[str] = []  # base64 images
+    images: List[str] = []  # full-size image URLs
+    media: List[dict] = []  # [{id, width, height, thumb, medium, full}] WebP variant URLs
     pricing: dict  # {type: 'free' | 'paid', amount: number, currency: 'AUD'}
     facilities: List[str] = []  # ["Parking", "Cafe", "Toilets"]
     age_range: dict  # {min: 0, max: 12}
     rating: float = 0.0
     total_reviews: int = 0
+    popularity_score: float = 0.0  # time-decayed, recomputed by popularity.run_popularity_job
     contact: dict = {}  # {phone, email, website}
     business_owner_id: Optional[str] = None
+    daily_capacity: Optional[int] = None  # tickets per day; defaults to DEFAULT_VENUE_DAILY_CAPACITY
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_verified: bool = False
 
@@ -59,10 +114,12 @@ class VenueCreate(BaseModel):
     category: str
     location: dict
     images: List[str] = []
+    media_ids: List[str] = Field([], max_length=10)  # handles from POST /api/uploads
     pricing: dict
     facilities: List[str] = []
     age_range: dict
     contact: dict = {}
+    daily_capacity: Optional[int] = None
 
 class Event(BaseModel):
     id: Optional[str] = None
@@ -112,6 +169,7 @@ class Review(BaseModel):
     rating: int  # 1-5
     comment: str
     images: List[str] = []
+    media: List[dict] = []
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class ReviewCreate(BaseModel):
@@ -122,6 +180,7 @@ class ReviewCreate(BaseModel):
     rating: int
     comment: str
     images: List[str] = []
+    media_ids: List[str] = Field([], max_length=10)  # handles from POST /api/uploads
 
 class Booking(BaseModel):
     id: Optional[str] = None
@@ -130,10 +189,12 @@ class Booking(BaseModel):
     venue_id: Optional[str] = None
     event_id: Optional[str] = None
     date: datetime
-    status: str  # 'pending' | 'confirmed' | 'cancelled'
+    status: str  # 'pending' | 'confirmed' | 'cancelled' | 'expired'
     payment_status: str  # 'pending' | 'paid' | 'refunded'
     amount: float
+    quantity: int = 1
     ticket_code: str
+    hold_expires_at: Optional[datetime] = None  # pending bookings are released after this
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class BookingCreate(BaseModel):
@@ -143,6 +204,7 @@ class BookingCreate(BaseModel):
     event_id: Optional[str] = None
     date: datetime
     amount: float
+    quantity: int = Field(1, ge=1, le=20)
 
 class Post(BaseModel):
     id: Optional[str] = None
@@ -152,8 +214,10 @@ class Post(BaseModel):
     post_type: str  # 'photo_share' | 'event_announcement' | 'recommendation' | 'invitation' | 'status'
     content: str
     images: List[str] = []
+    media: List[dict] = []
     related_venue_id: Optional[str] = None
     related_event_id: Optional[str] = None
+    city: Optional[str] = None
     is_public: bool = True
     likes: int = 0
     comment_count: int = 0
@@ -166,8 +230,10 @@ class PostCreate(BaseModel):
     post_type: str
     content: str
     images: List[str] = []
+    media_ids: List[str] = Field([], max_length=10)  # handles from POST /api/uploads
     related_venue_id: Optional[str] = None
     related_event_id: Optional[str] = None
+    city: Optional[str] = None  # falls back to the related venue/event city for feeds
     is_public: bool = True
 
 class Comment(BaseModel):
@@ -184,6 +250,11 @@ class CommentCreate(BaseModel):
     user_name: str
     comment: str
 
+class HydratedPost(Post):
+    latest_comments: List[Comment] = []
+    reaction_counts: dict = {}  # {reaction_type: count}
+    viewer_reaction: Optional[str] = None
+
 class Reaction(BaseModel):
     id: Optional[str] = None
     post_id: str
@@ -192,28 +263,95 @@ class Reaction(BaseModel):
     reaction_type: str  # 'like' | 'love' | 'celebrate' | 'support'
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+# Read handlers return trusted DB documents through DocumentResponse instead of
+# re-validating them with the models above
+venue_view = DocumentView(Venue)
+event_view = DocumentView(Event)
+review_view = DocumentView(Review)
+booking_view = DocumentView(Booking)
+post_view = DocumentView(Post)
+comment_view = DocumentView(Comment)
+
+# List endpoints send only thumbnail URLs; see media.thumbnails_only
+venue_list_projection = media.list_projection(venue_view.projection)
+review_list_projection = media.list_projection(review_view.projection)
+post_list_projection = media.list_projection(post_view.projection)
+
+async def store_images(doc: dict, owner_id: str = None):
+    """
+    Reference a create call's uploaded media handles, and transcode any inline
+    base64 images (still accepted for older clients) to WebP variants. Image
+    URLs are stored as given.
+    """
+    media_ids = doc.pop("media_ids", None) or []
+    inline = [i for i in doc.get("images") or [] if media.is_inline(i)]
+    if len(media_ids) + len(inline) > media.MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"At most {media.MAX_IMAGES} images are allowed")
+    try:
+        uploaded = await uploads.resolve_handles(db, media_ids, owner_id)
+        transcoded = await media.ingest_images(doc.get("images") or [])
+    except uploads.UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except media.InvalidImage as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    await uploads.attach(db, media_ids)
+    doc["images"] = [m["full"] for m in uploaded] + media.resolve_images(doc.get("images") or [], transcoded)
+    doc["media"] = uploaded + transcoded
+
+async def require_hot(collection: str, doc_id: str, label: str):
+    """
+    Archived events and posts are read-only: a new RSVP, comment or reaction
+    would land in the hot collections, apart from the archived thread
+    """
+    state = await archive.locate(db, collection, ObjectId(doc_id)) if ObjectId.is_valid(doc_id) else None
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"{label} not found")
+    if state == archive.ARCHIVED:
+        raise HTTPException(status_code=409, detail=f"{label} is archived")
+
+# ==================== UPLOADS ====================
+
+@api_router.post("/uploads")
+async def upload_media(request: Request):
+    """
+    Multipart image upload, streamed to disk and transcoded in the process
+    pool. Returns media handles for the media_ids field of create calls.
+    """
+    try:
+        files = await uploads.receive_files(request)
+    except uploads.UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    owner_id = request.headers.get("x-user-id")
+    results = await asyncio.gather(*[uploads.store_upload(db, f, owner_id) for f in files], return_exceptions=True)
+    for result in results:
+        if isinstance(result, media.InvalidImage):
+            # Handles already stored are unattached and left to the reaper
+            raise HTTPException(status_code=400, detail=str(result))
+        if isinstance(result, BaseException):
+            raise result
+    return {"media": results}
+
 # ==================== VENUE ENDPOINTS ====================
 
 @api_router.post("/venues", response_model=Venue)
-async def create_venue(venue: VenueCreate):
+async def create_venue(venue: VenueCreate, background_tasks: BackgroundTasks):
     venue_dict = venue.dict()
     venue_dict["created_at"] = datetime.utcnow()
     venue_dict["rating"] = 0.0
     venue_dict["total_reviews"] = 0
     venue_dict["is_verified"] = False
+    try:
+        with_geo(venue_dict)
+    except InvalidLocation as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    await store_images(venue_dict)
     
     result = await db.venues.insert_one(venue_dict)
     venue_dict["id"] = str(result.inserted_id)
+    background_tasks.add_task(bus.publish, "venues", venue_dict["id"])
     return Venue(**venue_dict)
 
-@api_router.get("/venues", response_model=List[Venue])
-async def get_venues(
-    category: Optional[str] = None,
-    min_age: Optional[int] = None,
-    max_age: Optional[int] = None,
-    price_type: Optional[str] = None,
-    search: Optional[str] = None
-):
+def venue_query(category=None, min_age=None, max_age=None, price_type=None, search=None):
     query = {}
     
     if category:
@@ -235,40 +373,266 @@ async def get_venues(
             {"name": {"$regex": search, "$options": "i"}},
             {"description": {"$regex": search, "$options": "i"}}
         ]
+    return query
+
+VENUE_SORTS = {
+    "popular": [("popularity_score", -1), ("_id", 1)],
+    "rating": [("rating", -1), ("total_reviews", -1)],
+    "newest": [("created_at", -1)],
+}
+
+@api_router.get("/venues", response_model=List[Venue])
+async def get_venues(
+    category: Optional[str] = None,
+    min_age: Optional[int] = None,
+    max_age: Optional[int] = None,
+    price_type: Optional[str] = None,
+    search: Optional[str] = None,
+    sort: Optional[Literal["popular", "rating", "newest", "distance"]] = None,
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lng: Optional[float] = Query(None, ge=-180, le=180)
+):
+    query = venue_query(category, min_age, max_age, price_type, search)
+    if sort == "distance" and (lat is None or lng is None):
+        raise HTTPException(status_code=400, detail="lat and lng are required for sort=distance")
+    
+    async def fetch():
+        if sort == "distance":
+            # $geoNear walks the geo 2dsphere index outward from the point
+            venues = await reads.catalog.venues.aggregate([
+                {"$geoNear": {"near": {"type": "Point", "coordinates": [lng, lat]}, "key": "geo",
+                              "distanceField": "distance", "distanceMultiplier": 0.001, "query": query}},
+                {"$limit": 100},
+                {"$project": {**venue_list_projection, "distance": 1}},
+            ]).to_list(100)
+            for v in venues:
+                v["distance"] = round(v["distance"], 2)
+        else:
+            cursor = reads.catalog.venues.find(query, venue_list_projection)
+            if sort:
+                cursor = cursor.sort(VENUE_SORTS[sort])
+            venues = await cursor.to_list(100)
+        return media.thumbnails_only(venue_view.many(venues))
     
-    venues = await db.venues.find(query).to_list(100)
-    return [Venue(**serialize_doc(v)) for v in venues]
+    key = ("venues", category, min_age, max_age, price_type, search, sort,
+           (lat, lng) if sort == "distance" else None)
+    return DocumentResponse(await flight.do(key, fetch))
+
+# Same bands as the app's age filter chips
+AGE_BANDS = [("0-2", 0, 2), ("3-5", 3, 5), ("6-8", 6, 8), ("9-12", 9, 12), ("13+", 13, 18)]
+
+# Facet counts per filter signature; any venue write clears them all
+venue_facets_cache = TTLCache(maxsize=2048, ttl=int(os.getenv("VENUE_FACETS_CACHE_TTL", "300")))
+bus.register("venues", venue_facets_cache, per_key=False)
+
+def venue_facets_pipeline(category, min_age, max_age, price_type, search):
+    """
+    One $facet pass. Each filter's own options are counted with every other
+    filter applied but not itself, so picking a category still shows what the
+    other categories would give. Facilities and the total use the full filter.
+    """
+    full = venue_query(category, min_age, max_age, price_type)
+    without_category = venue_query(None, min_age, max_age, price_type)
+    without_age = venue_query(category, None, None, price_type)
+    without_price = venue_query(category, min_age, max_age, None)
+    def overlaps(lo, hi):
+        return {"$and": [{"$lte": ["$age_range.min", hi]}, {"$gte": ["$age_range.max", lo]}]}
+    return [
+        {"$match": venue_query(search=search)},
+        {"$facet": {
+            "category": [
+                {"$match": without_category},
+                {"$group": {"_id": "$category", "count": {"$sum": 1}}},
+            ],
+            "price_type": [
+                {"$match": without_price},
+                {"$group": {"_id": "$pricing.type", "count": {"$sum": 1}}},
+            ],
+            "age_band": [
+                {"$match": without_age},
+                {"$group": {"_id": None, **{
+                    f"band{i}": {"$sum": {"$cond": [overlaps(lo, hi), 1, 0]}}
+                    for i, (_, lo, hi) in enumerate(AGE_BANDS)
+                }}},
+            ],
+            "facility": [
+                {"$match": full},
+                {"$unwind": "$facilities"},
+                {"$group": {"_id": "$facilities", "count": {"$sum": 1}}},
+            ],
+            "total": [{"$match": full}, {"$count": "count"}],
+        }},
+    ]
+
+def shape_facets(result: dict):
+    def counts(rows):
+        return {r["_id"]: r["count"] for r in sorted(rows, key=lambda r: -r["count"]) if r["_id"] is not None}
+    bands = result["age_band"][0] if result["age_band"] else {}
+    return {
+        "total": result["total"][0]["count"] if result["total"] else 0,
+        "category": counts(result["category"]),
+        "price_type": counts(result["price_type"]),
+        "age_band": {label: bands.get(f"band{i}", 0) for i, (label, _, _) in enumerate(AGE_BANDS)},
+        "facility": counts(result["facility"]),
+    }
+
+@api_router.get("/venues/facets")
+async def get_venue_facets(
+    category: Optional[str] = None,
+    min_age: Optional[int] = None,
+    max_age: Optional[int] = None,
+    price_type: Optional[str] = None,
+    search: Optional[str] = None
+):
+    """Result counts for every filter option under the current filters, for FilterModal"""
+    if search:
+        search = search.strip()
+    key = (category, min_age, max_age, price_type, search.lower() if search else None)
+    cacheable = bus.cache_allowed()
+    facets = venue_facets_cache.get(key) if cacheable else None
+    if facets is None:
+        async def fetch():
+            pipeline = venue_facets_pipeline(category, min_age, max_age, price_type, search)
+            # A cached result is only dropped by the next invalidation, so it must not come from a lagging secondary
+            source = db if cacheable else reads.catalog
+            result = await source.venues.aggregate(pipeline).to_list(1)
+            return shape_facets(result[0])
+        facets = await flight.do(("venue_facets",) + key, fetch)
+        if cacheable:
+            venue_facets_cache[key] = facets
+    return DocumentResponse(facets)
 
 @api_router.get("/venues/{venue_id}", response_model=Venue)
 async def get_venue(venue_id: str):
-    venue = await db.venues.find_one({"_id": ObjectId(venue_id)})
-    if not venue:
-        raise HTTPException(status_code=404, detail="Venue not found")
-    return Venue(**serialize_doc(venue))
+    async def fetch():
+        venue = await db.venues.find_one({"_id": ObjectId(venue_id)}, venue_view.projection)
+        if not venue:
+            raise HTTPException(status_code=404, detail="Venue not found")
+        return venue_view(venue)
+    
+    # A push notification can send hundreds of identical requests at once
+    return DocumentResponse(await flight.do(("venue", venue_id), fetch))
 
-@api_router.get("/venues/nearby/search")
+@api_router.get("/venues/nearby/search", response_model=List[Venue])
 async def get_nearby_venues(
-    lat: float = Query(...),
-    lng: float = Query(...),
-    radius: float = Query(50.0)  # km
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius: float = Query(50.0, gt=0)  # km
 ):
-    # Simple distance calculation (for MVP, in production use MongoDB geospatial queries)
-    venues = await db.venues.find().to_list(100)
-    nearby_venues = []
-    
-    for venue in venues:
-        if "coordinates" in venue.get("location", {}):
-            venue_lat = venue["location"]["coordinates"]["lat"]
-            venue_lng = venue["location"]["coordinates"]["lng"]
-            
-            # Simple distance calculation (not accurate for large distances)
-            distance = ((lat - venue_lat) ** 2 + (lng - venue_lng) ** 2) ** 0.5 * 111  # km
-            
-            if distance <= radius:
-                venue["distance"] = round(distance, 2)
-                nearby_venues.append(Venue(**serialize_doc(venue)))
+    """Venues within radius km, nearest first, each with its distance in km"""
+    # $geoNear walks the geo 2dsphere index outward and stops at the radius
+    venues = await reads.catalog.venues.aggregate([
+        {"$geoNear": {"near": {"type": "Point", "coordinates": [lng, lat]}, "key": "geo",
+                      "distanceField": "distance", "distanceMultiplier": 0.001, "maxDistance": radius * 1000}},
+        {"$limit": 100},
+        {"$project": {**venue_list_projection, "distance": 1}},
+    ]).to_list(100)
+    for v in venues:
+        v["distance"] = round(v["distance"], 2)
+    return DocumentResponse(media.thumbnails_only(venue_view.many(venues)))
+
+bus.register("venues", venue_grid)
+
+@api_router.get("/venues/map/clusters")
+async def get_map_clusters(
+    south: float = Query(..., ge=-90, le=90),
+    west: float = Query(..., ge=-180, le=180),
+    north: float = Query(..., ge=-90, le=90),
+    east: float = Query(..., ge=-180, le=180),
+    zoom: int = Query(..., ge=0, le=22)
+):
+    """
+    Markers for a map viewport: clusters {lat, lng, count, categories} below
+    zoom MAP_CLUSTER_MAX_ZOOM, individual venues from there on.
+    """
+    if south > north:
+        raise HTTPException(status_code=400, detail="south must not be greater than north")
+    max_age = None if bus.cache_allowed() else coherence.MAX_STALENESS_SECONDS
+    # Built from the primary: a secondary behind the invalidation would keep the old venue until the next one
+    await venue_grid.ensure_built(db, max_age)
+    try:
+        markers = venue_grid.query(south, west, north, east, zoom)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return DocumentResponse({"zoom": zoom, "markers": markers})
+
+@api_router.get("/venues/{venue_id}/full")
+async def get_venue_full(
+    venue_id: str,
+    viewer_id: Optional[str] = None,
+    reviews_limit: int = Query(5, ge=0, le=20),
+    events_limit: int = Query(5, ge=0, le=20)
+):
+    """
+    Everything the venue screen needs in one call: venue, rating histogram, latest
+    reviews, upcoming events and (with viewer_id) favorite and booking state.
+    All lookups run concurrently.
+    """
+    if not ObjectId.is_valid(venue_id):
+        raise HTTPException(status_code=404, detail="Venue not found")
+    
+    async def no_result():
+        return None
     
-    return sorted(nearby_venues, key=lambda x: x.dict().get("distance", 999))
+    venue, histogram, reviews, events, favorite, booking = await asyncio.gather(
+        db.venues.find_one({"_id": ObjectId(venue_id)}, venue_view.projection),
+        db.reviews.aggregate([
+            {"$match": {"venue_id": venue_id}},
+            {"$group": {"_id": "$rating", "count": {"$sum": 1}}},
+        ]).to_list(10),
+        # Lean review cards: no images, just how many there are
+        db.reviews.find(
+            {"venue_id": venue_id},
+            {"user_id": 1, "user_name": 1, "rating": 1, "comment": 1, "created_at": 1,
+             "image_count": {"$size": {"$ifNull": ["$images", []]}}}
+        ).sort("created_at", -1).limit(reviews_limit).to_list(reviews_limit),
+        db.events.find(
+            {"venue_id": venue_id, "date": {"$gte": datetime.utcnow()}},
+            {"title": 1, "event_type": 1, "date": 1, "age_range": 1, "max_participants": 1,
+             "current_participants": 1, "is_public": 1}
+        ).sort("date", 1).limit(events_limit).to_list(events_limit),
+        db.favorites.find_one({"user_id": viewer_id, "item_id": venue_id}, {"_id": 1}) if viewer_id else no_result(),
+        db.bookings.find_one(
+            {"user_id": viewer_id, "venue_id": venue_id, "status": {"$in": list(inventory.ACTIVE_STATUSES)}},
+            {"status": 1, "payment_status": 1, "date": 1, "ticket_code": 1},
+            sort=[("date", -1)]
+        ) if viewer_id else no_result(),
+    )
+    if not venue:
+        raise HTTPException(status_code=404, detail="Venue not found")
+    
+    rating_histogram = {str(star): 0 for star in range(1, 6)}
+    for row in histogram:
+        if row["_id"] is not None:
+            rating_histogram[str(row["_id"])] = row["count"]
+    
+    result = {
+        "venue": venue_view(venue),
+        "rating_histogram": rating_histogram,
+        "latest_reviews": [serialize_doc(r) for r in reviews],
+        "upcoming_events": [serialize_doc(e) for e in events],
+    }
+    if viewer_id:
+        result["viewer"] = {
+            "is_favorited": favorite is not None,
+            "booking": serialize_doc(booking) if booking else None,
+        }
+    return DocumentResponse(result)
+
+# ==================== SEARCH ====================
+
+bus.register("venues", autocomplete.watcher("venues"))
+bus.register("events", autocomplete.watcher("events"))
+
+@api_router.get("/search/suggest")
+async def search_suggest(
+    q: str = Query(..., max_length=100),
+    limit: int = Query(8, ge=1, le=20),
+    kinds: Optional[str] = None  # comma separated: venue,event,category,city
+):
+    """Keystroke autocomplete from the in-memory index; typo tolerant, never queries Mongo"""
+    kind_set = {k for k in (kinds or "").split(",") if k} or None
+    return DocumentResponse(autocomplete.suggest(q, limit, kind_set))
 
 # ==================== AI RECOMMENDATIONS ====================
 
@@ -296,8 +660,9 @@ async def get_recommendations(request: dict):
             })
         
         # Create LLM chat
+        llm = await startup.load_llm()
         llm_key = os.getenv("EMERGENT_LLM_KEY")
-        chat = LlmChat(
+        chat = llm.LlmChat(
             api_key=llm_key,
             session_id="famigo-recommendations",
             system_message="You are a helpful family activity recommendation assistant for Famigo app. Recommend the best activities based on user context."
@@ -327,7 +692,7 @@ async def get_recommendations(request: dict):
         }}]
         """
         
-        message = UserMessage(text=user_msg)
+        message = llm.UserMessage(text=user_msg)
         response = await chat.send_message(message)
         
         # Parse response
@@ -343,13 +708,18 @@ async def get_recommendations(request: dict):
 # ==================== EVENT ENDPOINTS ====================
 
 @api_router.post("/events", response_model=Event)
-async def create_event(event: EventCreate):
+async def create_event(event: EventCreate, background_tasks: BackgroundTasks):
     event_dict = event.dict()
     event_dict["current_participants"] = 0
     event_dict["created_at"] = datetime.utcnow()
+    try:
+        with_geo(event_dict)
+    except InvalidLocation as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     result = await db.events.insert_one(event_dict)
     event_dict["id"] = str(result.inserted_id)
+    background_tasks.add_task(bus.publish, "events", event_dict["id"])
     return Event(**event_dict)
 
 @api_router.get("/events", response_model=List[Event])
@@ -367,62 +737,269 @@ async def get_events(
     if host_id:
         query["host_id"] = host_id
     
-    events = await db.events.find(query).sort("date", 1).to_list(100)
-    return [Event(**serialize_doc(e)) for e in events]
+    async def fetch():
+        events = await reads.catalog.events.find(query, event_view.projection).sort("date", 1).to_list(100)
+        await with_live_counts("events", events, EVENT_COUNTERS)
+        return event_view.many(events)
+    
+    key = ("events", event_type, is_public, host_id)
+    return DocumentResponse(await flight.do(key, fetch))
+
+def naive_utc(value: datetime) -> datetime:
+    """Query datetimes may carry an offset; stored dates are naive UTC"""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+@api_router.get("/events/nearby", response_model=List[Event])
+async def get_nearby_events(
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(25.0, gt=0, le=200),
+    start: Optional[datetime] = None,  # defaults to now: upcoming only
+    end: Optional[datetime] = None,
+    min_age: Optional[int] = None,
+    max_age: Optional[int] = None,
+    event_type: Optional[str] = None,
+    sort: Literal["date", "distance"] = "date",
+    limit: int = Query(50, ge=1, le=100)
+):
+    """
+    Public events within radius_km of a point in a date window whose age range
+    overlaps the children's ages, e.g. "playdates near me this weekend". Served
+    by the (geo 2dsphere, date) index; each event carries its distance in km.
+    """
+    start = naive_utc(start) if start else datetime.utcnow()
+    end = naive_utc(end) if end else None
+    if end is not None and end < start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+    
+    query = {"is_public": True, "date": {"$gte": start, **({"$lte": end} if end else {})}}
+    if min_age is not None:
+        query["age_range.max"] = {"$gte": min_age}
+    if max_age is not None:
+        query["age_range.min"] = {"$lte": max_age}
+    if event_type:
+        query["event_type"] = event_type
+    
+    if sort == "distance":
+        events = await reads.catalog.events.aggregate([
+            {"$geoNear": {"near": {"type": "Point", "coordinates": [lng, lat]}, "key": "geo",
+                          "distanceField": "distance", "distanceMultiplier": 0.001,
+                          "maxDistance": radius_km * 1000, "query": query}},
+            {"$limit": limit},
+            {"$project": {**event_view.projection, "distance": 1}},
+        ]).to_list(limit)
+    else:
+        query["geo"] = {"$geoWithin": {"$centerSphere": [[lng, lat], radius_km * 1000 / EARTH_RADIUS_METERS]}}
+        events = await reads.catalog.events.find(query, {**event_view.projection, "geo": 1}) \
+            .sort("date", 1).limit(limit).to_list(limit)
+        for e in events:
+            point = e.pop("geo")["coordinates"]
+            e["distance"] = distance_km(lat, lng, point[1], point[0])
+    for e in events:
+        e["distance"] = round(e["distance"], 2)
+    
+    await with_live_counts("events", events, EVENT_COUNTERS)
+    return DocumentResponse(event_view.many(events))
 
 @api_router.get("/events/{event_id}", response_model=Event)
 async def get_event(event_id: str):
-    event = await db.events.find_one({"_id": ObjectId(event_id)})
-    if not event:
-        raise HTTPException(status_code=404, detail="Event not found")
-    return Event(**serialize_doc(event))
+    async def fetch():
+        event, _ = await archive.find_one(db, "events", {"_id": ObjectId(event_id)}, event_view.projection)
+        if not event:
+            raise HTTPException(status_code=404, detail="Event not found")
+        await with_live_counts("events", [event], EVENT_COUNTERS)
+        return event_view(event)
+    
+    return DocumentResponse(await flight.do(("event", event_id), fetch))
 
 @api_router.post("/events/{event_id}/rsvp")
-async def rsvp_event(event_id: str, rsvp: dict):
-    # Check if already RSVP'd
-    existing = await db.rsvps.find_one({"event_id": event_id, "user_id": rsvp["user_id"]})
-    
-    if existing:
-        # Update existing RSVP
-        await db.rsvps.update_one(
-            {"_id": existing["_id"]},
-            {"$set": {"status": rsvp["status"]}}
-        )
-    else:
-        # Create new RSVP
-        rsvp_doc = {
-            "event_id": event_id,
-            "user_id": rsvp["user_id"],
-            "user_name": rsvp["user_name"],
-            "status": rsvp["status"],
-            "created_at": datetime.utcnow()
-        }
-        await db.rsvps.insert_one(rsvp_doc)
+async def rsvp_event(event_id: str, rsvp: dict, background_tasks: BackgroundTasks):
+    await require_hot("events", event_id, "Event")
+    # Upsert and read the previous status in one round trip
+    previous = await db.rsvps.find_one_and_update(
+        {"event_id": event_id, "user_id": rsvp["user_id"]},
+        {"$set": {"status": rsvp["status"]},
+         "$setOnInsert": {"user_name": rsvp["user_name"], "created_at": datetime.utcnow()}},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
     
     # Update event participant count
-    if rsvp["status"] == "accepted":
-        accepted_count = await db.rsvps.count_documents({"event_id": event_id, "status": "accepted"})
-        await db.events.update_one(
-            {"_id": ObjectId(event_id)},
-            {"$set": {"current_participants": accepted_count}}
-        )
+    was_accepted = previous is not None and previous.get("status") == "accepted"
+    is_accepted = rsvp["status"] == "accepted"
+    if was_accepted != is_accepted:
+        counter_buffer.incr("events", event_id, "current_participants", 1 if is_accepted else -1)
     
+    background_tasks.add_task(bus.publish, "events", event_id)
+    background_tasks.add_task(broker.publish, f"event:{event_id}", {
+        "type": "rsvp",
+        "user_id": rsvp["user_id"],
+        "user_name": rsvp["user_name"],
+        "status": rsvp["status"],
+        "participants_delta": (1 if is_accepted else -1) if was_accepted != is_accepted else 0
+    })
     return {"success": True, "message": "RSVP updated"}
 
 @api_router.get("/events/{event_id}/attendees")
 async def get_event_attendees(event_id: str):
-    rsvps = await db.rsvps.find({"event_id": event_id, "status": "accepted"}).to_list(100)
-    return [serialize_doc(r) for r in rsvps]
+    if not ObjectId.is_valid(event_id):
+        raise HTTPException(status_code=404, detail="Event not found")
+    query = {"event_id": event_id, "status": "accepted"}
+    hot_event, rsvps = await asyncio.gather(
+        db.events.find_one({"_id": ObjectId(event_id)}, {"_id": 1}),
+        db.rsvps.find(query).to_list(100),
+    )
+    if hot_event is None:
+        # Past the archive horizon the event's RSVPs moved with it
+        rsvps = await db[archive.archive_of("rsvps")].find(query).to_list(100)
+    return DocumentResponse([serialize_doc(r) for r in rsvps])
+
+# Viewer-independent part of /events/{id}/full for the first attendee page, keyed by event id
+event_detail_cache = TTLCache(maxsize=1024, ttl=int(os.getenv("EVENT_DETAIL_CACHE_TTL", "30")))
+bus.register("events", event_detail_cache)
+
+def event_detail_pipeline(event_id: str, attendees_offset: int, attendees_limit: int, viewer_id: Optional[str],
+                          rsvps: str = "rsvps"):
+    pipeline = [
+        {"$match": {"_id": ObjectId(event_id)}},
+        {"$set": {"_event_id": {"$toString": "$_id"}}},
+        {"$lookup": {
+            "from": "venues",
+            "let": {"venue_id": {"$convert": {"input": "$venue_id", "to": "objectId", "onError": None, "onNull": None}}},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$_id", "$$venue_id"]}}},
+                # Venue images are only needed on the venue screen
+                {"$project": {"images": {"$slice": ["$images", 1]}, "name": 1, "description": 1, "category": 1,
+                              "location": 1, "pricing": 1, "facilities": 1, "age_range": 1, "rating": 1,
+                              "total_reviews": 1, "contact": 1, "business_owner_id": 1, "created_at": 1,
+                              "is_verified": 1}},
+            ],
+            "as": "venue",
+        }},
+        {"$lookup": {
+            "from": rsvps,
+            "let": {"event_id": "$_event_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$and": [{"$eq": ["$event_id", "$$event_id"]}, {"$eq": ["$status", "accepted"]}]}}},
+                {"$facet": {
+                    "page": [
+                        {"$sort": {"created_at": 1}},
+                        {"$skip": attendees_offset},
+                        {"$limit": attendees_limit},
+                        {"$project": {"event_id": 0}},
+                    ],
+                    "total": [{"$count": "n"}],
+                }},
+            ],
+            "as": "attendees",
+        }},
+    ]
+    if viewer_id:
+        # viewer_id stays out of $expr, where a value starting with "$" would be read as a field path
+        pipeline += [
+            {"$lookup": {
+                "from": rsvps,
+                "let": {"event_id": "$_event_id"},
+                "pipeline": [
+                    {"$match": {"user_id": viewer_id, "$expr": {"$eq": ["$event_id", "$$event_id"]}}},
+                    {"$project": {"_id": 0, "status": 1}},
+                ],
+                "as": "viewer_rsvp",
+            }},
+            {"$lookup": {
+                "from": "favorites",
+                "let": {"event_id": "$_event_id"},
+                "pipeline": [
+                    {"$match": {"user_id": viewer_id, "$expr": {"$eq": ["$item_id", "$$event_id"]}}},
+                    {"$project": {"_id": 1}},
+                ],
+                "as": "viewer_favorite",
+            }},
+        ]
+    return pipeline
+
+async def fetch_viewer_event_state(event_id: str, viewer_id: str):
+    rsvp, favorite = await asyncio.gather(
+        db.rsvps.find_one({"event_id": event_id, "user_id": viewer_id}, {"status": 1}),
+        db.favorites.find_one({"user_id": viewer_id, "item_id": event_id}, {"_id": 1}),
+    )
+    return {"rsvp_status": rsvp["status"] if rsvp else None, "is_favorited": favorite is not None}
+
+@api_router.get("/events/{event_id}/full")
+async def get_event_full(
+    event_id: str,
+    viewer_id: Optional[str] = None,
+    attendees_offset: int = Query(0, ge=0),
+    attendees_limit: int = Query(20, ge=1, le=100)
+):
+    """
+    Everything the event screen needs in one call: event, linked venue, a page of
+    attendees and (with viewer_id) the viewer's RSVP and favorite state.
+    """
+    if not ObjectId.is_valid(event_id):
+        raise HTTPException(status_code=404, detail="Event not found")
+    
+    cacheable = attendees_offset == 0 and attendees_limit == 20 and bus.cache_allowed()
+    shared = event_detail_cache.get(event_id) if cacheable else None
+    if shared is not None:
+        result = dict(shared)
+        if viewer_id:
+            result["viewer"] = await fetch_viewer_event_state(event_id, viewer_id)
+        return DocumentResponse(result)
+    
+    docs = await db.events.aggregate(
+        event_detail_pipeline(event_id, attendees_offset, attendees_limit, viewer_id)
+    ).to_list(1)
+    if not docs:
+        # Archived events are rare reads and aren't cached: cached viewer state reads the hot rsvps
+        cacheable = False
+        docs = await db[archive.archive_of("events")].aggregate(event_detail_pipeline(
+            event_id, attendees_offset, attendees_limit, viewer_id, rsvps=archive.archive_of("rsvps")
+        )).to_list(1)
+    if not docs:
+        raise HTTPException(status_code=404, detail="Event not found")
+    doc = docs[0]
+    
+    attendees = doc.pop("attendees")[0]
+    venue = doc.pop("venue")
+    viewer_rsvp = doc.pop("viewer_rsvp", [])
+    viewer_favorite = doc.pop("viewer_favorite", [])
+    doc.pop("_event_id")
+    await with_live_counts("events", [doc], EVENT_COUNTERS)
+    
+    shared = {
+        "event": event_view(doc),
+        "venue": venue_view(venue[0]) if venue else None,
+        "attendees": [serialize_doc(a) for a in attendees["page"]],
+        "attendee_count": attendees["total"][0]["n"] if attendees["total"] else 0,
+        "attendees_offset": attendees_offset,
+        "attendees_limit": attendees_limit,
+    }
+    if cacheable:
+        event_detail_cache[event_id] = shared
+    
+    result = dict(shared)
+    if viewer_id:
+        result["viewer"] = {
+            "rsvp_status": viewer_rsvp[0]["status"] if viewer_rsvp else None,
+            "is_favorited": bool(viewer_favorite),
+        }
+    return DocumentResponse(result)
 
 # ==================== REVIEW ENDPOINTS ====================
 
 @api_router.post("/reviews", response_model=Review)
-async def create_review(review: ReviewCreate):
+async def create_review(review: ReviewCreate, response: Response):
     review_dict = review.dict()
     review_dict["created_at"] = datetime.utcnow()
+    await store_images(review_dict, review.user_id)
     
-    result = await db.reviews.insert_one(review_dict)
+    async with reads.write_session(review.user_id) as session:
+        result = await reads.writes.reviews.insert_one(review_dict, session=session)
     review_dict["id"] = str(result.inserted_id)
+    set_causal_token(response, review.user_id)
     
     # Update venue rating
     if review.venue_id:
@@ -436,54 +1013,145 @@ async def create_review(review: ReviewCreate):
     return Review(**review_dict)
 
 @api_router.get("/reviews/venue/{venue_id}", response_model=List[Review])
-async def get_venue_reviews(venue_id: str):
-    reviews = await db.reviews.find({"venue_id": venue_id}).sort("created_at", -1).to_list(100)
-    return [Review(**serialize_doc(r)) for r in reviews]
+async def get_venue_reviews(venue_id: str, request: Request):
+    async with viewer_session(request) as session:
+        reviews = await reads.catalog.reviews.find({"venue_id": venue_id}, review_list_projection, session=session) \
+            .sort("created_at", -1).to_list(100)
+    return DocumentResponse(media.thumbnails_only(review_view.many(reviews)))
 
 # ==================== BOOKING ENDPOINTS ====================
 
 @api_router.post("/bookings", response_model=Booking)
 async def create_booking(booking: BookingCreate):
-    import uuid
+    if not booking.venue_id and not booking.event_id:
+        raise HTTPException(status_code=400, detail="venue_id or event_id is required")
+    
+    try:
+        slot_id = await inventory.ensure_slot(db, booking.venue_id, booking.event_id, booking.date)
+    except inventory.UnknownListing:
+        raise HTTPException(status_code=404, detail="Venue or event not found")
     
     booking_dict = booking.dict()
     booking_dict["status"] = "pending"
     booking_dict["payment_status"] = "pending"
-    booking_dict["ticket_code"] = str(uuid.uuid4())[:8].upper()
+    booking_dict["slot_id"] = slot_id
+    booking_dict["hold_expires_at"] = inventory.hold_expiry()
     booking_dict["created_at"] = datetime.utcnow()
     
-    result = await db.bookings.insert_one(booking_dict)
+    async def reserve(session):
+        # Tickets are taken and the booking holding them written together, so a failed insert can't leak them
+        booking_dict.pop("_id", None)
+        await inventory.take(db, slot_id, booking.quantity, session=session)
+        try:
+            return await db.bookings.insert_one(booking_dict, session=session)
+        except Exception:
+            if session is None:
+                await inventory.release(db, slot_id, booking.quantity)
+            raise
+    
+    # Ticket codes are random; the unique index catches the rare collision
+    for _ in range(5):
+        booking_dict["ticket_code"] = inventory.new_ticket_code()
+        try:
+            result = await outbox.run_transaction(client, reserve)
+            break
+        except inventory.SoldOut:
+            raise HTTPException(status_code=409, detail="Sold out for this date")
+        except DuplicateKeyError:
+            continue
+    else:
+        raise HTTPException(status_code=503, detail="Could not allocate a ticket code, please retry")
+    
     booking_dict["id"] = str(result.inserted_id)
     return Booking(**booking_dict)
 
 @api_router.get("/bookings/user/{user_id}", response_model=List[Booking])
 async def get_user_bookings(user_id: str):
-    bookings = await db.bookings.find({"user_id": user_id}).sort("date", -1).to_list(100)
-    return [Booking(**serialize_doc(b)) for b in bookings]
+    bookings = await db.bookings.find({"user_id": user_id}, booking_view.projection).sort("date", -1).to_list(100)
+    return DocumentResponse(booking_view.many(bookings))
 
 @api_router.put("/bookings/{booking_id}/confirm")
 async def confirm_booking(booking_id: str):
-    await db.bookings.update_one(
-        {"_id": ObjectId(booking_id)},
-        {"$set": {"status": "confirmed", "payment_status": "paid"}}
-    )
+    """
+    Confirms the booking and queues payment capture; the ticket email follows
+    once payment succeeds. payment_status stays 'pending' until then.
+    """
+    if not ObjectId.is_valid(booking_id):
+        raise HTTPException(status_code=404, detail="Booking not found")
+    async def confirm(session):
+        previous = await inventory.transition(db, booking_id, ["pending"], {
+            "status": "confirmed",
+            "updated_at": datetime.utcnow()
+        }, session=session)
+        if previous is not None:
+            await outbox.enqueue(db, "payment.capture", {"booking_id": booking_id},
+                                 f"capture:{booking_id}", session=session)
+        return previous
+    
+    previous = await outbox.run_transaction(client, confirm)
+    if previous is None:
+        current = await db.bookings.find_one({"_id": ObjectId(booking_id)}, {"status": 1})
+        if not current:
+            raise HTTPException(status_code=404, detail="Booking not found")
+        if current["status"] == "pending":
+            detail = "Booking hold has expired"
+        else:
+            detail = f"Booking is already {current['status']}"
+        raise HTTPException(status_code=409, detail=detail)
+    return {"success": True, "status": "confirmed", "payment_status": "pending"}
+
+@api_router.put("/bookings/{booking_id}/cancel")
+async def cancel_booking(booking_id: str):
+    """Cancels the booking; capacity release and any refund run from the outbox"""
+    if not ObjectId.is_valid(booking_id):
+        raise HTTPException(status_code=404, detail="Booking not found")
+    async def cancel(session):
+        previous = await inventory.transition(db, booking_id, ["pending", "confirmed"], {
+            "status": "cancelled",
+            "updated_at": datetime.utcnow()
+        }, session=session)
+        if previous is not None:
+            await outbox.enqueue(db, "booking.cancelled", {
+                "booking_id": booking_id,
+                "release_slot": True,
+                "refund": previous.get("payment_status") == "paid",
+            }, f"cancel:{booking_id}", session=session)
+        return previous
+    
+    previous = await outbox.run_transaction(client, cancel)
+    if previous is None:
+        raise HTTPException(status_code=409, detail="Booking cannot be cancelled")
     return {"success": True}
 
 # ==================== SOCIAL FEED ENDPOINTS ====================
 
 @api_router.post("/posts", response_model=Post)
-async def create_post(post: PostCreate):
+async def create_post(post: PostCreate, response: Response, background_tasks: BackgroundTasks):
     post_dict = post.dict()
     post_dict["likes"] = 0
     post_dict["comment_count"] = 0
     post_dict["created_at"] = datetime.utcnow()
+    await store_images(post_dict, post.user_id)
     
-    result = await db.posts.insert_one(post_dict)
+    # The author's next list read is causally after this insert, even on a secondary
+    async with reads.write_session(post.user_id) as session:
+        result = await reads.writes.posts.insert_one(post_dict, session=session)
+    set_causal_token(response, post.user_id)
+    # Timelines are updated after the response is sent
+    background_tasks.add_task(feed.fan_out_post, db, dict(post_dict))
+    if post_dict["is_public"]:
+        background_tasks.add_task(broker.publish, "feed:public", {
+            "type": "post",
+            "post": {"id": str(result.inserted_id), "user_id": post_dict["user_id"],
+                     "user_name": post_dict["user_name"], "post_type": post_dict["post_type"],
+                     "created_at": post_dict["created_at"]}
+        })
     post_dict["id"] = str(result.inserted_id)
     return Post(**post_dict)
 
 @api_router.get("/posts", response_model=List[Post])
 async def get_posts(
+    request: Request,
     is_public: Optional[bool] = None,
     user_id: Optional[str] = None,
     limit: int = 50
@@ -495,31 +1163,121 @@ async def get_posts(
     if user_id:
         query["user_id"] = user_id
     
-    posts = await db.posts.find(query).sort("created_at", -1).limit(limit).to_list(limit)
-    return [Post(**serialize_doc(p)) for p in posts]
+    async with viewer_session(request, user_id) as session:
+        posts = await reads.catalog.posts.find(query, post_list_projection, session=session) \
+            .sort("created_at", -1).limit(limit).to_list(limit)
+    await with_live_counts("posts", posts, POST_COUNTERS)
+    return DocumentResponse(media.thumbnails_only(post_view.many(posts)))
+
+def resolve_timeline(scope: str, city: Optional[str], user_id: Optional[str]) -> str:
+    if scope == "public":
+        return feed.PUBLIC_TIMELINE
+    if scope == "city":
+        if not city:
+            raise HTTPException(status_code=400, detail="city is required for the city feed")
+        return feed.city_timeline(city)
+    if scope == "home":
+        if not user_id:
+            raise HTTPException(status_code=400, detail="user_id is required for the home feed")
+        return feed.home_timeline(user_id)
+    raise HTTPException(status_code=400, detail="scope must be 'public', 'city' or 'home'")
+
+@api_router.get("/feed", response_model=List[Post])
+async def get_feed(
+    scope: str = "public",  # 'public' | 'city' | 'home'
+    city: Optional[str] = None,
+    user_id: Optional[str] = None,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100)
+):
+    """Read a precomputed timeline: one slice read plus one $in hydration, regardless of post count"""
+    timeline_id = resolve_timeline(scope, city, user_id)
+    post_ids = await feed.read_timeline_ids(reads.catalog, timeline_id, offset, limit)
+    posts = await feed.hydrate_posts(reads.catalog, post_ids, public_only=scope != "home", projection=post_list_projection)
+    await with_live_counts("posts", posts, POST_COUNTERS)
+    return DocumentResponse(media.thumbnails_only(post_view.many(posts)))
+
+@api_router.get("/feed/hydrated", response_model=List[HydratedPost])
+async def get_hydrated_feed(
+    scope: str = "public",
+    city: Optional[str] = None,
+    user_id: Optional[str] = None,
+    viewer_id: Optional[str] = None,
+    comments: int = Query(3, ge=0, le=20),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=50)
+):
+    """
+    Feed page with comment previews, reaction counts and the viewer's reaction embedded.
+    Four DB round trips per page however many posts it holds.
+    """
+    timeline_id = resolve_timeline(scope, city, user_id)
+    post_ids = await feed.read_timeline_ids(reads.catalog, timeline_id, offset, limit)
+    posts = await feed.hydrate_posts(reads.catalog, post_ids, public_only=scope != "home", projection=post_list_projection)
+    
+    previews, (counts, viewer_reactions), _ = await asyncio.gather(
+        feed.attach_comment_previews(db, posts, comments),
+        feed.attach_reactions(db, posts, viewer_id or user_id),
+        with_live_counts("posts", posts, POST_COUNTERS),
+    )
+    
+    hydrated = []
+    for p in posts:
+        post_id = str(p["_id"])
+        post = post_view(p)
+        post["latest_comments"] = comment_view.many(previews.get(post_id, []))
+        post["reaction_counts"] = counts.get(post_id, {})
+        post["viewer_reaction"] = viewer_reactions.get(post_id)
+        hydrated.append(post)
+    return DocumentResponse(media.thumbnails_only(hydrated))
+
+@api_router.post("/users/{user_id}/follow")
+async def follow_user(user_id: str, data: dict, background_tasks: BackgroundTasks):
+    """data: {follower_id}"""
+    follower_id = data["follower_id"]
+    result = await db.follows.update_one(
+        {"follower_id": follower_id, "followee_id": user_id},
+        {"$setOnInsert": {"created_at": datetime.utcnow()}},
+        upsert=True
+    )
+    if result.upserted_id is None:
+        return {"success": False, "message": "Already following"}
+    background_tasks.add_task(feed.backfill_home_timeline, db, follower_id, user_id)
+    return {"success": True, "message": "Following"}
+
+@api_router.post("/users/{user_id}/unfollow")
+async def unfollow_user(user_id: str, data: dict, background_tasks: BackgroundTasks):
+    """data: {follower_id}"""
+    follower_id = data["follower_id"]
+    result = await db.follows.delete_one({"follower_id": follower_id, "followee_id": user_id})
+    if result.deleted_count == 0:
+        return {"success": False, "message": "Not following"}
+    background_tasks.add_task(feed.rebuild_timeline, db, feed.home_timeline(follower_id))
+    return {"success": True, "message": "Unfollowed"}
 
 @api_router.get("/posts/{post_id}", response_model=Post)
 async def get_post(post_id: str):
-    post = await db.posts.find_one({"_id": ObjectId(post_id)})
+    post, _ = await archive.find_one(db, "posts", {"_id": ObjectId(post_id)}, post_view.projection)
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
-    return Post(**serialize_doc(post))
+    await with_live_counts("posts", [post], POST_COUNTERS)
+    return DocumentResponse(post_view(post))
 
 @api_router.post("/posts/{post_id}/like")
-async def like_post(post_id: str, reaction: dict):
-    # Check if user already liked
-    existing = await db.reactions.find_one({
+async def like_post(post_id: str, reaction: dict, background_tasks: BackgroundTasks):
+    await require_hot("posts", post_id, "Post")
+    # Removing an existing reaction doubles as the "already liked" check
+    existing = await db.reactions.find_one_and_delete({
         "post_id": post_id,
         "user_id": reaction["user_id"]
     })
     
     if existing:
         # Unlike
-        await db.reactions.delete_one({"_id": existing["_id"]})
-        await db.posts.update_one(
-            {"_id": ObjectId(post_id)},
-            {"$inc": {"likes": -1}}
-        )
+        counter_buffer.incr("posts", post_id, "likes", -1)
+        background_tasks.add_task(broker.publish, f"post:{post_id}", {
+            "type": "reaction", "action": "unliked", "user_id": reaction["user_id"], "likes_delta": -1
+        })
         return {"success": True, "action": "unliked"}
     else:
         # Like
@@ -531,33 +1289,115 @@ async def like_post(post_id: str, reaction: dict):
             "created_at": datetime.utcnow()
         }
         await db.reactions.insert_one(reaction_doc)
-        await db.posts.update_one(
-            {"_id": ObjectId(post_id)},
-            {"$inc": {"likes": 1}}
-        )
+        counter_buffer.incr("posts", post_id, "likes", 1)
+        background_tasks.add_task(broker.publish, f"post:{post_id}", {
+            "type": "reaction", "action": "liked", "user_id": reaction["user_id"],
+            "reaction_type": reaction_doc["reaction_type"], "likes_delta": 1
+        })
         return {"success": True, "action": "liked"}
 
 @api_router.post("/posts/{post_id}/comments", response_model=Comment)
-async def create_comment(post_id: str, comment: CommentCreate):
+async def create_comment(post_id: str, comment: CommentCreate, response: Response, background_tasks: BackgroundTasks):
+    await require_hot("posts", post_id, "Post")
     comment_dict = comment.dict()
     comment_dict["created_at"] = datetime.utcnow()
     
-    result = await db.comments.insert_one(comment_dict)
+    async with reads.write_session(comment.user_id) as session:
+        result = await reads.writes.comments.insert_one(comment_dict, session=session)
     comment_dict["id"] = str(result.inserted_id)
+    set_causal_token(response, comment.user_id)
     
     # Update comment count
-    await db.posts.update_one(
-        {"_id": ObjectId(post_id)},
-        {"$inc": {"comment_count": 1}}
-    )
+    counter_buffer.incr("posts", post_id, "comment_count", 1)
+    background_tasks.add_task(broker.publish, f"post:{post_id}", {
+        "type": "comment",
+        "comment": {k: comment_dict[k] for k in ("id", "user_id", "user_name", "comment", "created_at")}
+    })
     
     return Comment(**comment_dict)
 
 @api_router.get("/posts/{post_id}/comments", response_model=List[Comment])
-async def get_post_comments(post_id: str):
-    comments = await db.comments.find({"post_id": post_id}).sort("created_at", 1).to_list(100)
-    return [Comment(**serialize_doc(c)) for c in comments]
+async def get_post_comments(post_id: str, request: Request):
+    if not ObjectId.is_valid(post_id):
+        raise HTTPException(status_code=404, detail="Post not found")
+    async with viewer_session(request) as session:
+        hot_post, comments = await asyncio.gather(
+            reads.catalog.posts.find_one({"_id": ObjectId(post_id)}, {"_id": 1}, session=session),
+            reads.catalog.comments.find({"post_id": post_id}, comment_view.projection, session=session)
+                .sort("created_at", 1).to_list(100),
+        )
+    if hot_post is None:
+        comments = await db[archive.archive_of("comments")].find({"post_id": post_id}, comment_view.projection) \
+            .sort("created_at", 1).to_list(100)
+    return DocumentResponse(comment_view.many(comments))
+
+
+# ==================== REALTIME ====================
+
+def parse_topics(topics: str):
+    return [t for t in (topics or "").split(",") if realtime.valid_topic(t)]
+
+@api_router.websocket("/ws")
+async def realtime_socket(websocket: WebSocket, topics: str = ""):
+    """
+    Topics: post:<id>, event:<id>, feed:public. Clients may also send
+    {"action": "subscribe" | "unsubscribe", "topic": ...} after connecting.
+    """
+    await websocket.accept()
+    subscriber = realtime.Subscriber()
+    for topic in parse_topics(topics):
+        broker.subscribe(subscriber, topic)
+    
+    async def send_loop():
+        while True:
+            await websocket.send_text(await subscriber.queue.get())
+    
+    sender = asyncio.create_task(send_loop())
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+            except json.JSONDecodeError:
+                message = None
+            if not isinstance(message, dict) or not isinstance(message.get("topic", ""), str):
+                # Goes through the send loop's queue so frames never interleave
+                subscriber.deliver(json.dumps({
+                    "type": "error", "detail": 'Expected {"action": "subscribe" | "unsubscribe", "topic": "..."}'
+                }))
+                continue
+            topic = message.get("topic", "")
+            if not realtime.valid_topic(topic):
+                continue
+            if message.get("action") == "subscribe":
+                broker.subscribe(subscriber, topic)
+            elif message.get("action") == "unsubscribe":
+                broker.unsubscribe(subscriber, topic)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        broker.unsubscribe(subscriber)
 
+@api_router.get("/stream")
+async def realtime_stream(request: Request, topics: str):
+    """Server-sent events for clients that can't hold a WebSocket open"""
+    subscriber = realtime.Subscriber()
+    for topic in parse_topics(topics):
+        broker.subscribe(subscriber, topic)
+    
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    payload = await asyncio.wait_for(subscriber.queue.get(), timeout=realtime.HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield f"data: {payload}\n\n"
+        finally:
+            broker.unsubscribe(subscriber)
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 # ==================== FAVORITES / WATCHLIST ====================
 
@@ -567,18 +1407,23 @@ class FavoriteItem(BaseModel):
     item_type: str  # 'venue', 'event', 'playground', 'childcare'
     item_data: dict  # Store basic info for quick display
 
+class FavoriteCheckBatch(BaseModel):
+    user_id: str
+    item_ids: List[str] = Field(..., max_length=500)
+
+class FavoriteOperation(BaseModel):
+    op: Literal["add", "remove"]
+    item_id: str
+    item_type: Optional[str] = None  # required for 'add'
+    item_data: dict = {}
+
+class FavoriteBatch(BaseModel):
+    user_id: str
+    operations: List[FavoriteOperation] = Field(..., max_length=500)
+
 @api_router.post("/favorites/add")
 async def add_to_favorites(favorite: FavoriteItem):
     """Add an item to user's favorites/watchlist"""
-    # Check if already favorited
-    existing = await db.favorites.find_one({
-        "user_id": favorite.user_id,
-        "item_id": favorite.item_id
-    })
-    
-    if existing:
-        return {"success": False, "message": "Already in favorites"}
-    
     favorite_doc = {
         "user_id": favorite.user_id,
         "item_id": favorite.item_id,
@@ -587,7 +1432,11 @@ async def add_to_favorites(favorite: FavoriteItem):
         "created_at": datetime.utcnow()
     }
     
-    await db.favorites.insert_one(favorite_doc)
+    # The unique (user_id, item_id) index rejects duplicates without a prior lookup
+    try:
+        await db.favorites.insert_one(favorite_doc)
+    except DuplicateKeyError:
+        return {"success": False, "message": "Already in favorites"}
     return {"success": True, "message": "Added to favorites"}
 
 @api_router.post("/favorites/remove")
@@ -602,6 +1451,55 @@ async def remove_from_favorites(data: dict):
         return {"success": True, "message": "Removed from favorites"}
     return {"success": False, "message": "Not in favorites"}
 
+@api_router.post("/favorites/check")
+async def check_favorites_batch(data: FavoriteCheckBatch):
+    """Check many items at once; answers {item_id: bool} from a single $in query"""
+    if not data.item_ids:
+        return {"favorites": {}}
+    found = await db.favorites.find(
+        {"user_id": data.user_id, "item_id": {"$in": data.item_ids}},
+        {"item_id": 1, "_id": 0}
+    ).to_list(len(data.item_ids))
+    favorited = {f["item_id"] for f in found}
+    return {"favorites": {item_id: item_id in favorited for item_id in data.item_ids}}
+
+@api_router.post("/favorites/batch")
+async def apply_favorites_batch(data: FavoriteBatch):
+    """Apply an ordered list of add/remove operations (e.g. replayed offline changes) in one bulk_write"""
+    writes = []
+    for operation in data.operations:
+        key = {"user_id": data.user_id, "item_id": operation.item_id}
+        if operation.op == "add":
+            if not operation.item_type:
+                raise HTTPException(status_code=400, detail=f"item_type is required to add {operation.item_id}")
+            writes.append(UpdateOne(key, {"$setOnInsert": {
+                "item_type": operation.item_type,
+                "item_data": operation.item_data,
+                "created_at": datetime.utcnow()
+            }}, upsert=True))
+        else:
+            writes.append(DeleteOne(key))
+    
+    added = removed = 0
+    start = 0
+    while start < len(writes):
+        try:
+            result = await db.favorites.bulk_write(writes[start:], ordered=True)
+        except BulkWriteError as e:
+            # A concurrent batch upserted the same favorite first: that add is already
+            # applied. An ordered write stops there, so resume after it.
+            errors = e.details.get("writeErrors", [])
+            if not errors or any(err.get("code") != 11000 for err in errors):
+                raise
+            added += e.details.get("nUpserted", 0)
+            removed += e.details.get("nRemoved", 0)
+            start += errors[0]["index"] + 1
+            continue
+        added += result.upserted_count
+        removed += result.deleted_count
+        break
+    return {"success": True, "added": added, "removed": removed}
+
 @api_router.get("/favorites/{user_id}")
 async def get_user_favorites(
     user_id: str,
@@ -613,7 +1511,7 @@ async def get_user_favorites(
         query["item_type"] = item_type
     
     favorites = await db.favorites.find(query).sort("created_at", -1).to_list(1000)
-    return [serialize_doc(f) for f in favorites]
+    return DocumentResponse([serialize_doc(f) for f in favorites])
 
 @api_router.get("/favorites/check/{user_id}/{item_id}")
 async def check_if_favorited(user_id: str, item_id: str):
@@ -638,16 +1536,32 @@ async def admin_panel():
 async def root():
     return {"message": "Famigo API - Discover. Connect. Play."}
 
+@api_router.get("/health/ready")
+async def readiness():
+    """Readiness probe: 503 until warm-up has opened the Mongo pool and primed caches"""
+    if not startup.ready:
+        raise HTTPException(status_code=503, detail="Warming up")
+    return {"ready": True, "timings": startup.timings}
+
 # Include routers
 app.include_router(api_router)
 app.include_router(admin_router)
 
+# Transcoded image variants, written by media.transcode
+media.MEDIA_ROOT.mkdir(parents=True, exist_ok=True)
+app.mount(media.MEDIA_URL, StaticFiles(directory=media.MEDIA_ROOT), name="media")
+
+app.add_middleware(PayloadMiddleware)
+# Inside CORS so 429/503 responses still carry CORS headers
+app.add_middleware(AdmissionMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[CAUSAL_HEADER],
 )
 
 logging.basicConfig(
@@ -656,6 +1570,116 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.middleware("http")
+async def track_db_queries(request: Request, call_next):
+    stats, token = start_request(f"{request.method} {request.url.path}")
+    try:
+        response = await call_next(request)
+    finally:
+        # Group by route template rather than raw path so IDs don't explode the stats
+        route = request.scope.get("route")
+        if route is not None:
+            stats.route = f"{request.method} {route.path}"
+        finish_request(stats, token)
+    response.headers["X-DB-Queries"] = str(stats.count)
+    response.headers["X-DB-Time-Ms"] = f"{stats.duration_ms:.1f}"
+    return response
+
+async def dedupe_favorites():
+    """Keep the oldest of any duplicate (user_id, item_id) favorites so the unique index can build"""
+    if "user_id_1_item_id_1" in await db.favorites.index_information():
+        return
+    duplicates = await db.favorites.aggregate([
+        {"$sort": {"created_at": 1}},
+        {"$group": {"_id": {"user_id": "$user_id", "item_id": "$item_id"}, "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ], allowDiskUse=True).to_list(None)
+    extra = [i for d in duplicates for i in d["ids"][1:]]
+    if extra:
+        await db.favorites.delete_many({"_id": {"$in": extra}})
+        logger.warning("Removed %d duplicate favorites", len(extra))
+
+@app.on_event("startup")
+async def create_indexes():
+    await feed.ensure_feed_indexes(db)
+    await inventory.ensure_inventory_indexes(db)
+    await outbox.ensure_outbox_indexes(db)
+    await db.counter_shards.create_index([("collection", 1), ("doc_id", 1)])
+    await db.rsvps.create_index([("event_id", 1), ("status", 1), ("created_at", 1)])
+    await db.rsvps.create_index([("event_id", 1), ("user_id", 1)])
+    await db.reviews.create_index([("venue_id", 1), ("created_at", -1)])
+    await db.events.create_index([("venue_id", 1), ("date", 1)])
+    await db.bookings.create_index([("user_id", 1), ("venue_id", 1), ("date", -1)])
+    await dedupe_favorites()
+    # No guard: without this index duplicate favorites would keep being accepted
+    await db.favorites.create_index([("user_id", 1), ("item_id", 1)], unique=True)
+    await db.favorites.create_index([("user_id", 1), ("created_at", -1)])
+    await popularity.ensure_popularity_indexes(db)
+    await backfill_geo(db.venues)
+    await db.venues.create_index([("geo", "2dsphere")])
+    await backfill_geo(db.events)
+    await db.events.create_index([("geo", "2dsphere"), ("date", 1)])
+    await uploads.ensure_upload_indexes(db)
+    await archive.ensure_archive_indexes(db)
+
+@app.on_event("startup")
+async def enable_slow_query_explain():
+    query_listener.enable_explain(asyncio.get_running_loop(), db)
+
+async def backfill_inline_media():
+    """Documents written before media variants may still hold base64 images"""
+    for collection in (db.venues, db.reviews, db.posts):
+        try:
+            await media.backfill_inline_images(collection)
+        except Exception:
+            logger.exception("Inline image backfill failed for %s", collection.name)
+
+@app.on_event("startup")
+async def start_background_workers():
+    await outbox.detect_transaction_support(client)
+    app.state.hold_reaper = asyncio.create_task(inventory.run_hold_reaper(db))
+    app.state.popularity_job = asyncio.create_task(popularity.run_popularity_job(db))
+    app.state.media_reaper = asyncio.create_task(uploads.run_orphan_reaper(db))
+    app.state.media_backfill = asyncio.create_task(backfill_inline_media())
+    app.state.archive_job = asyncio.create_task(archive.run_archive_job(client, db))
+    app.state.outbox_workers = booking_effects.create_worker_pool(db)
+    app.state.outbox_workers.start()
+    counter_buffer.start()
+    await broker.start()
+    await bus.start(db)
+    await autocomplete.start(db)
+
+async def prime_public_feed():
+    await feed.read_timeline_ids(db, feed.PUBLIC_TIMELINE, 0, 20)
+
+async def prime_upcoming_events():
+    upcoming = await db.events.find(
+        {"date": {"$gte": datetime.utcnow()}, "is_public": True}, {"_id": 1}
+    ).sort("date", 1).limit(10).to_list(10)
+    for e in upcoming:
+        await get_event_full(str(e["_id"]), viewer_id=None, attendees_offset=0, attendees_limit=20)
+
+@app.on_event("startup")
+async def warm_up():
+    # In the background, so /health/ready answers 503 while it runs instead of the worker not listening at all
+    app.state.warm_up = asyncio.create_task(startup.warm_up(db, [
+        ("public_feed", prime_public_feed),
+        ("upcoming_events", prime_upcoming_events),
+        ("map_grid", lambda: venue_grid.ensure_built(db)),
+    ]))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    app.state.warm_up.cancel()
+    app.state.hold_reaper.cancel()
+    app.state.popularity_job.cancel()
+    app.state.media_reaper.cancel()
+    app.state.media_backfill.cancel()
+    app.state.archive_job.cancel()
+    media.shutdown()
+    await app.state.outbox_workers.stop()
+    await counter_buffer.stop()
+    await broker.stop()
+    await bus.stop()
+    await autocomplete.stop()
     client.close()
\ No newline at end of file
@@ -0,0 +1,53 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Collapses identical concurrent reads: callers with the same key await one
+    in-flight call and share its result or exception. Results are shared, so
+    callers must treat them as read-only.
+    """
+
+    def __init__(self):
+        self._inflight = {}  # key -> [task, waiter count]
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(fn())
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda _: self._forget(key, task))
+            self.executed += 1
+        else:
+            self.coalesced += 1
+        task = entry[0]
+        entry[1] += 1
+        try:
+            # Shielded so one caller disconnecting doesn't cancel the others' query
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if entry[1] == 1 and not task.done():
+                # Last interested caller left; nobody needs the result
+                task.cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+    def _forget(self, key, task):
+        entry = self._inflight.get(key)
+        if entry is not None and entry[0] is task:
+            del self._inflight[key]
+
+    def stats(self):
+        total = self.executed + self.coalesced
+        return {
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "coalesced_pct": round(100 * self.coalesced / total, 1) if total else 0,
+            "in_flight": len(self._inflight),
+        }
+
+
+flight = SingleFlight()
@@ -0,0 +1,103 @@
+import asyncio
+import importlib
+import logging
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+logger = logging.getLogger("famigo.startup")
+
+# Connections opened before the worker takes traffic
+WARM_CONNECTIONS = int(os.getenv("MONGO_WARM_CONNECTIONS", "10"))
+# Load the LLM stack during warm-up instead of on the first recommendation
+PRELOAD_LLM = os.getenv("PRELOAD_LLM", "false").lower() == "true"
+
+LLM_MODULE = "emergentintegrations.llm.chat"
+
+_llm_module = None
+_llm_lock = asyncio.Lock()
+
+timings = {}
+ready = False
+
+
+async def load_llm():
+    """
+    Import the LLM integration on first use. It drags in the google-genai,
+    grpcio and boto3 stacks, so importing it at module load slowed every
+    worker's cold start for the sake of one endpoint.
+    """
+    global _llm_module
+    if _llm_module is not None:
+        return _llm_module
+    async with _llm_lock:
+        if _llm_module is None:
+            started = time.perf_counter()
+            # Off the event loop so in-flight requests keep being served
+            _llm_module = await asyncio.to_thread(importlib.import_module, LLM_MODULE)
+            timings["llm_import_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            logger.info("Loaded %s in %.0fms", LLM_MODULE, timings["llm_import_ms"])
+    return _llm_module
+
+
+async def warm_up(db, steps):
+    """
+    Runs in the background once the worker is serving: opens Mongo
+    connections, then runs each (name, coroutine function) warm-up step, and
+    only then marks the worker ready for the readiness probe. Failures are
+    logged, not fatal, so a cold cache never keeps a worker down.
+    """
+    global ready
+    started = time.perf_counter()
+
+    # Concurrent pings force the pool to open that many sockets
+    try:
+        await asyncio.gather(*[db.command("ping") for _ in range(WARM_CONNECTIONS)])
+    except Exception:
+        logger.exception("Warm-up could not open the Mongo pool")
+    timings["mongo_pool_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+    if PRELOAD_LLM:
+        steps = list(steps) + [("llm", load_llm)]
+    for name, step in steps:
+        step_started = time.perf_counter()
+        try:
+            await step()
+        except Exception:
+            logger.exception("Warm-up step %s failed", name)
+        timings[f"{name}_ms"] = round((time.perf_counter() - step_started) * 1000, 1)
+
+    timings["warm_up_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    ready = True
+    logger.info("Worker warm in %.0fms: %s", timings["warm_up_ms"], timings)
+
+
+def profile_imports(module: str = "server", top: int = 25):
+    """
+    Import-time report for a module using python -X importtime, sorted by
+    cumulative time. Run `python startup.py [module]` from backend/.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=Path(__file__).parent, capture_output=True, text=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+    # Only top-level packages, so nested imports don't double count
+    total = sum(c for c, _, name in rows if not name.startswith(" " * 2))
+    print(f"{'cumulative ms':>14} {'self ms':>8}  module")
+    for cumulative_us, self_us, name in sorted(rows, reverse=True)[:top]:
+        print(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>8.1f}  {name.strip()}")
+    print(f"\nTotal import time for {module}: {total / 1000:.0f}ms")
+    if result.returncode != 0:
+        print(result.stderr.splitlines()[-1] if result.stderr else "import failed", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    profile_imports(*sys.argv[1:2])
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import os
+import secrets
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+import media
+
+logger = logging.getLogger("famigo.uploads")
+
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", media.MEDIA_ROOT / "incoming"))
+MAX_FILE_BYTES = media.MAX_IMAGE_BYTES
+MAX_FILES = media.MAX_IMAGES
+MAX_REQUEST_BYTES = MAX_FILE_BYTES * MAX_FILES + 64 * 1024
+# Uploads never referenced by a create call are deleted after this long
+ORPHAN_HOURS = int(os.getenv("MEDIA_ORPHAN_HOURS", "24"))
+REAPER_INTERVAL_SECONDS = 600
+
+
+class UploadRejected(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class StreamedFile:
+    __slots__ = ("field", "filename", "content_type", "path", "size", "fd")
+
+    def __init__(self, field: str, filename: str, content_type: str):
+        self.field = field
+        self.filename = filename
+        self.content_type = content_type
+        self.path = UPLOAD_DIR / secrets.token_hex(12)
+        self.size = 0
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > MAX_FILE_BYTES:
+            raise UploadRejected(413, f"Each file must be under {MAX_FILE_BYTES // (1024 * 1024)}MB")
+        os.write(self.fd, data)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def discard(self):
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+
+async def receive_files(request) -> list:
+    """
+    Streams a multipart/form-data body straight to files under UPLOAD_DIR as
+    chunks arrive, so a request holds one network chunk in memory rather
+    than its whole body. Limits are enforced mid-stream: an oversized file or
+    body is cut off at the limit, not after it has been read. The caller owns
+    the returned files and must discard() them.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type"))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadRejected(415, "Expected multipart/form-data")
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > MAX_REQUEST_BYTES:
+        raise UploadRejected(413, "Upload is too large")
+
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    files = []
+    part = {"headers": {}, "field": b"", "value": b"", "file": None}
+
+    def on_part_begin():
+        part["headers"] = {}
+        part["file"] = None
+
+    def on_header_field(data, start, end):
+        part["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part["value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][part["field"].lower()] = part["value"]
+        part["field"] = part["value"] = b""
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(part["headers"].get(b"content-disposition"))
+        if b"filename" not in disposition:
+            return  # plain form fields carry nothing we need
+        if len(files) >= MAX_FILES:
+            raise UploadRejected(413, f"At most {MAX_FILES} files per upload")
+        part_type = part["headers"].get(b"content-type", b"").decode("latin-1")
+        if not (part_type.startswith("image/") or part_type == "application/octet-stream"):
+            raise UploadRejected(415, "Only image files can be uploaded")
+        part["file"] = StreamedFile(
+            disposition.get(b"name", b"").decode("utf-8", "replace"),
+            disposition[b"filename"].decode("utf-8", "replace"),
+            part_type,
+        )
+        files.append(part["file"])
+
+    def on_part_data(data, start, end):
+        if part["file"] is not None:
+            part["file"].write(data[start:end])
+
+    def on_part_end():
+        if part["file"] is not None:
+            part["file"].close()
+
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    }, max_size=MAX_REQUEST_BYTES)
+
+    received = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > MAX_REQUEST_BYTES:
+                raise UploadRejected(413, "Upload is too large")
+            parser.write(chunk)
+        parser.finalize()
+    except UploadRejected:
+        for f in files:
+            f.discard()
+        raise
+    except Exception as e:
+        for f in files:
+            f.discard()
+        raise UploadRejected(400, f"Malformed multipart body: {e}")
+    if not files:
+        raise UploadRejected(400, "No files in upload")
+    return files
+
+
+async def store_upload(db, streamed: StreamedFile, owner_id: str = None) -> dict:
+    """Transcodes one streamed file in the process pool and records its handle"""
+    media_id = media.new_media_id()
+    try:
+        doc = await media.run_in_pool(media.transcode_file, str(streamed.path), media_id, str(media.MEDIA_ROOT))
+    finally:
+        streamed.discard()
+    await db.media.insert_one({
+        "_id": media_id,
+        **{k: v for k, v in doc.items() if k != "id"},
+        "owner_id": owner_id,
+        "filename": streamed.filename,
+        "bytes": streamed.size,
+        "attached": False,
+        "created_at": datetime.utcnow(),
+    })
+    return doc
+
+
+async def resolve_handles(db, media_ids, owner_id: str = None) -> list:
+    """
+    Media documents for the handles a create call references, in the order
+    given. Unknown handles, or handles uploaded by someone else, are rejected.
+    """
+    if not media_ids:
+        return []
+    found = {d["_id"]: d for d in await db.media.find({"_id": {"$in": list(media_ids)}}).to_list(len(media_ids))}
+    resolved = []
+    for media_id in media_ids:
+        doc = found.get(media_id)
+        if doc is None or (doc.get("owner_id") and owner_id and doc["owner_id"] != owner_id):
+            raise UploadRejected(400, f"Unknown media handle: {media_id}")
+        resolved.append({"id": media_id, **{k: doc[k] for k in ("width", "height", *media.VARIANTS)}})
+    return resolved
+
+
+async def attach(db, media_ids):
+    """Referenced uploads are kept; the reaper only deletes unattached ones"""
+    if media_ids:
+        await db.media.update_many({"_id": {"$in": list(media_ids)}}, {"$set": {"attached": True}})
+
+
+async def ensure_upload_indexes(db):
+    await db.media.create_index([("attached", 1), ("created_at", 1)])
+
+
+async def reap_orphans(db) -> int:
+    cutoff = datetime.utcnow() - timedelta(hours=ORPHAN_HOURS)
+    orphans = await db.media.find({"attached": False, "created_at": {"$lt": cutoff}}, {"_id": 1}).to_list(500)
+    for orphan in orphans:
+        for path in media.variant_paths(orphan["_id"]):
+            path.unlink(missing_ok=True)
+    if orphans:
+        await db.media.delete_many({"_id": {"$in": [o["_id"] for o in orphans]}, "attached": False})
+    return len(orphans)
+
+
+async def run_orphan_reaper(db):
+    while True:
+        try:
+            reaped = await reap_orphans(db)
+            if reaped:
+                logger.info("Deleted %d unattached uploads", reaped)
+        except Exception:
+            logger.exception("Upload orphan reaper failed")
+        await asyncio.sleep(REAPER_INTERVAL_SECONDS)
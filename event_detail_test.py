@@ -233,12 +233,45 @@ def test_event_detail_endpoints():
         print(f"❌ FAILED: Error testing event list API - {str(e)}")
         return False
     
+    # Step 10: Test GET /api/events/{id}/full - one-call event screen
+    print(f"\n10. Testing GET /events/{test_event_id}/full - Aggregated event detail...")
+    try:
+        response = requests.get(f"{BASE_URL}/events/{test_event_id}/full",
+                                params={"viewer_id": "emma_sydney_456", "attendees_limit": 5}, timeout=10)
+        if response.status_code != 200:
+            print(f"❌ FAILED: Event full endpoint - Status: {response.status_code}")
+            return False
+        
+        full = response.json()
+        missing_keys = [key for key in ['event', 'venue', 'attendees', 'attendee_count', 'viewer'] if key not in full]
+        if missing_keys:
+            print(f"❌ FAILED: Event full response missing keys: {missing_keys}")
+            return False
+        
+        if full['event']['id'] != test_event_id:
+            print(f"❌ FAILED: Event full returned wrong event")
+            return False
+        
+        if len(full['attendees']) > 5:
+            print(f"❌ FAILED: Attendees page not capped - got {len(full['attendees'])}")
+            return False
+        
+        print(f"✅ Event full endpoint working")
+        print(f"   Attendees: {len(full['attendees'])} of {full['attendee_count']}")
+        print(f"   Venue: {full['venue']['name'] if full['venue'] else 'None'}")
+        print(f"   Viewer RSVP: {full['viewer']['rsvp_status']}")
+        
+    except Exception as e:
+        print(f"❌ FAILED: Error testing event full endpoint - {str(e)}")
+        return False
+    
     print("\n" + "=" * 60)
     print("✅ ALL EVENT DETAIL API TESTS PASSED!")
     print("✅ Event detail endpoint working correctly")
     print("✅ Event attendees endpoint working correctly") 
     print("✅ RSVP functionality (join/cancel) working correctly")
     print("✅ Participant count updates working correctly")
+    print("✅ Aggregated event detail endpoint working correctly")
     print("✅ Existing venue and event APIs still functional")
     print("=" * 60)
     
@@ -0,0 +1,67 @@
+import pytest
+
+import admission
+from admission import TokenBucket, classify, client_key
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_bucket_admits_a_burst_then_refuses(clock):
+    bucket = TokenBucket(burst=3)
+    assert [bucket.take(rate=1, burst=3) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take(rate=1, burst=3) == pytest.approx(1.0)
+
+
+def test_bucket_refills_at_the_rate_up_to_the_burst(clock):
+    bucket = TokenBucket(burst=2)
+    bucket.take(rate=2, burst=2)
+    bucket.take(rate=2, burst=2)
+    clock[0] += 0.25
+    # Half a token back: the wait is for the other half
+    assert bucket.take(rate=2, burst=2) == pytest.approx(0.25)
+    clock[0] += 60
+    assert bucket.take(rate=2, burst=2) == 0.0
+    assert bucket.take(rate=2, burst=2) == 0.0
+    assert bucket.take(rate=2, burst=2) > 0
+
+
+def test_client_key_ignores_forwarded_for_from_an_untrusted_peer(monkeypatch):
+    monkeypatch.setattr(admission, "TRUSTED_PROXIES", {"10.0.0.1"})
+    scope = {"client": ("203.0.113.9", 5000)}
+    assert client_key(scope, {"x-forwarded-for": "198.51.100.1"}) == "ip:203.0.113.9"
+
+
+def test_client_key_takes_the_nearest_untrusted_hop_behind_a_proxy(monkeypatch):
+    monkeypatch.setattr(admission, "TRUSTED_PROXIES", {"10.0.0.1", "10.0.0.2"})
+    scope = {"client": ("10.0.0.1", 5000)}
+    # The client can prepend anything; only the hop our proxies saw counts
+    headers = {"x-forwarded-for": "1.2.3.4, 198.51.100.7, 10.0.0.2"}
+    assert client_key(scope, headers) == "ip:198.51.100.7"
+
+
+def test_client_key_ignores_user_id_headers():
+    scope = {"client": ("203.0.113.9", 5000)}
+    assert client_key(scope, {"x-user-id": "someone"}) == client_key(scope, {"x-user-id": "someone-else"})
+
+
+def test_client_key_without_a_peer():
+    assert client_key({}, {}) == "ip:unknown"
+
+
+@pytest.mark.parametrize("method, path, query, expected", [
+    ("POST", "/api/recommendations", b"", "llm"),
+    ("GET", "/admin/bookings/all", b"", "admin_export"),
+    ("GET", "/api/venues/nearby/search", b"lat=1&lng=2", "nearby"),
+    ("GET", "/api/venues", b"sort=distance&lat=1&lng=2", "nearby"),
+    ("GET", "/api/venues", b"sort=rating&search=distance", "default"),
+    ("POST", "/api/uploads", b"", "upload"),
+    ("GET", "/api/posts/abc/comments", b"", "feed"),
+    ("POST", "/api/posts", b"", "default"),
+])
+def test_classify(method, path, query, expected):
+    assert classify(method, path, query) == expected
@@ -0,0 +1,100 @@
+import pytest
+
+import autocomplete
+from autocomplete import AutocompleteIndex, Entry, normalize, tokenize
+
+
+def venue_index(*names_and_popularity):
+    index = AutocompleteIndex()
+    for i, (name, popularity) in enumerate(names_and_popularity):
+        index.upsert(Entry("venue", str(i), name, popularity))
+    return index
+
+
+def texts(suggestions):
+    return [s["text"] for s in suggestions]
+
+
+def test_normalize_strips_accents_and_case():
+    assert normalize("Café Élan") == "cafe elan"
+    assert tokenize("Kids' Café & Play-Zone") == ["kids", "cafe", "play", "zone"]
+
+
+def test_prefix_returns_the_most_popular_first():
+    index = venue_index(("Farm Stay", 5), ("Farmers Market", 50), ("Fairy Garden", 20))
+    assert texts(index.suggest("fa")) == ["Farmers Market", "Fairy Garden", "Farm Stay"]
+    assert texts(index.suggest("farm", limit=1)) == ["Farmers Market"]
+
+
+def test_any_word_of_a_name_is_a_prefix():
+    index = venue_index(("Sunny Farm", 1))
+    assert texts(index.suggest("far")) == ["Sunny Farm"]
+
+
+def test_top_k_is_capped_per_node(monkeypatch):
+    monkeypatch.setattr(autocomplete, "TOP_PER_NODE", 3)
+    index = venue_index(*[(f"Park {i}", i) for i in range(10)])
+    assert texts(index.suggest("park", limit=10)) == ["Park 9", "Park 8", "Park 7"]
+
+
+def test_removing_a_top_entry_refills_from_the_subtree(monkeypatch):
+    monkeypatch.setattr(autocomplete, "TOP_PER_NODE", 2)
+    index = venue_index(("Zoo A", 3), ("Zoo B", 2), ("Zoo C", 1))
+    index.remove(("venue", "0"))
+    assert texts(index.suggest("zoo")) == ["Zoo B", "Zoo C"]
+
+
+def test_upsert_replaces_the_old_rank():
+    index = venue_index(("Pool", 1), ("Pond", 2))
+    index.upsert(Entry("venue", "0", "Pool", 10))
+    assert texts(index.suggest("po")) == ["Pool", "Pond"]
+
+
+@pytest.mark.parametrize("typed", [
+    "fram",   # adjacent swap, one edit
+    "farn",   # substitution
+    "fam",    # deletion
+    "faarm",  # insertion
+])
+def test_one_typo_still_finds_the_word(typed):
+    index = venue_index(("Farm", 1))
+    assert texts(index.suggest(typed)) == ["Farm"]
+
+
+def test_typo_budget_grows_with_length():
+    index = venue_index(("Playground", 1))
+    # Two edits are only allowed past five characters
+    assert texts(index.suggest("plyagrond")) == ["Playground"]
+    assert index.suggest("pxyz") == []
+
+
+def test_first_letter_is_taken_as_typed():
+    index = venue_index(("Farm", 1))
+    assert index.suggest("darm") == []
+
+
+def test_exact_matches_rank_above_typo_matches():
+    index = venue_index(("Farm", 1), ("Fram Gallery", 1))
+    assert texts(index.suggest("fram")) == ["Fram Gallery", "Farm"]
+
+
+def test_earlier_words_must_all_match():
+    index = venue_index(("Sunny Farm Cafe", 1), ("Sunny Beach", 1), ("Farm Cafe", 1))
+    assert texts(index.suggest("sunny farm c")) == ["Sunny Farm Cafe"]
+    # A misspelt earlier word is matched as a whole word within the budget
+    assert texts(index.suggest("suny farm c")) == ["Sunny Farm Cafe"]
+
+
+def test_kinds_filter():
+    index = AutocompleteIndex()
+    index.put_venue({"_id": "v1", "name": "Outdoor Fun", "category": "Outdoor", "location": {"city": "Perth"}})
+    kinds = {s["kind"] for s in index.suggest("out")}
+    assert kinds == {"venue", "category"}
+    assert texts(index.suggest("out", kinds={"category"})) == ["Outdoor"]
+
+
+def test_dropping_the_last_venue_of_a_category_drops_the_category():
+    index = AutocompleteIndex()
+    index.put_venue({"_id": "v1", "name": "Barn", "category": "Farm"})
+    index.drop_venue("v1")
+    assert index.suggest("farm") == []
@@ -0,0 +1,91 @@
+import pytest
+
+from geocluster import CLUSTER_MAX_ZOOM, VenueGrid, build_levels, tile_xy
+
+
+def venue(venue_id, lat, lng, category="Outdoor"):
+    return {"_id": venue_id, "name": f"Venue {venue_id}", "category": category,
+            "location": {"coordinates": {"lat": lat, "lng": lng}}}
+
+
+# Two venues a few hundred metres apart in Perth, one in Sydney
+VENUES = [
+    venue("a", -31.9505, 115.8605, "Outdoor"),
+    venue("b", -31.9520, 115.8620, "Farm"),
+    venue("c", -33.8688, 151.2093, "Indoor"),
+]
+
+
+def grid(venues=VENUES):
+    g = VenueGrid()
+    g.levels, g.points = build_levels(venues)
+    g.dirty = False
+    return g
+
+
+def test_tile_xy_clamps_to_the_mercator_range():
+    assert tile_xy(90, 180, 2) == (3, 0)
+    assert tile_xy(-90, -180, 2) == (0, 3)
+
+
+def test_levels_are_built_by_merging_children():
+    levels, _ = build_levels(VENUES)
+    assert sum(cell.count for cell in levels[0].values()) == 3
+    for level in levels:
+        assert sum(cell.count for cell in level.values()) == 3
+
+
+def test_whole_world_at_zoom_zero_is_one_cluster():
+    markers = grid().query(-85, -180, 85, 180, 0)
+    assert [m["count"] for m in markers] == [3]
+
+
+def test_nearby_venues_cluster_and_distant_ones_do_not():
+    markers = grid().query(-40, 110, -10, 155, 4)
+    assert sum(m.get("count", 1) for m in markers) == 3
+    perth = [m for m in markers if m["type"] == "cluster"]
+    assert len(perth) == 1
+    assert perth[0]["count"] == 2
+    assert perth[0]["categories"] == {"Outdoor": 1, "Farm": 1}
+    assert perth[0]["lat"] == pytest.approx((-31.9505 - 31.9520) / 2)
+
+
+def test_a_lone_venue_is_returned_as_itself():
+    markers = grid().query(-34, 151, -33, 152, 4)
+    assert markers == [{"type": "venue", "id": "c", "name": "Venue c", "category": "Indoor",
+                        "lat": -33.8688, "lng": 151.2093}]
+
+
+def test_individual_venues_from_the_cluster_zoom_on():
+    g = grid()
+    z = CLUSTER_MAX_ZOOM
+    markers = g.query(-31.96, 115.85, -31.94, 115.87, z)
+    assert sorted(m["id"] for m in markers) == ["a", "b"]
+    assert all(m["type"] == "venue" for m in markers)
+    # Deeper than the point buckets, tiles filter their parent bucket
+    x, y = tile_xy(-31.9505, 115.8605, 20)
+    assert [m["id"] for m in g.tile(20, x, y)] == ["a"]
+
+
+def test_viewport_across_the_antimeridian_wraps():
+    g = grid([venue("fiji", -17.7, 178.0), venue("samoa", -13.8, -171.8)])
+    markers = g.query(-20, 170, -10, -170, 3)
+    assert sum(m.get("count", 1) for m in markers) == 2
+
+
+def test_tiles_are_cached_until_the_grid_is_rebuilt():
+    g = grid()
+    g.query(-85, -180, 85, 180, 0)
+    g.query(-85, -180, 85, 180, 0)
+    assert g.stats()["tile_hit_pct"] == 50.0
+
+
+def test_too_many_tiles_is_refused():
+    with pytest.raises(ValueError):
+        grid().query(-80, -170, 80, 170, 10)
+
+
+def test_any_invalidation_marks_the_grid_dirty():
+    g = grid()
+    g.pop("some-venue-id")
+    assert g.dirty
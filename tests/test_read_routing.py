@@ -0,0 +1,56 @@
+import base64
+import time
+
+from bson import BSON
+from bson.timestamp import Timestamp
+
+import read_routing
+from read_routing import decode_token, encode_token
+
+
+def times(seconds=None, operation_offset=0):
+    now = int(time.time() if seconds is None else seconds)
+    cluster_time = {"clusterTime": Timestamp(now, 1), "signature": {"hash": b"\0" * 20, "keyId": 0}}
+    return cluster_time, Timestamp(now - operation_offset, 1)
+
+
+def test_token_round_trips():
+    cluster_time, operation_time = times()
+    assert decode_token(encode_token(cluster_time, operation_time)) == (cluster_time, operation_time)
+
+
+def test_tampered_payload_is_rejected():
+    token = encode_token(*times())
+    payload, _, signature = token.partition(".")
+    forged = BSON.encode({"c": times(time.time() + 5)[0], "o": Timestamp(int(time.time()) + 5, 1)})
+    assert decode_token(f"{base64.urlsafe_b64encode(forged).decode()}.{signature}") is None
+    assert decode_token(f"{payload}.{base64.urlsafe_b64encode(b'x' * 16).decode()}") is None
+
+
+def test_token_signed_with_another_secret_is_rejected(monkeypatch):
+    token = encode_token(*times())
+    monkeypatch.setattr(read_routing, "TOKEN_SECRET", b"another worker's secret")
+    assert decode_token(token) is None
+
+
+def test_operation_time_from_the_future_is_rejected():
+    far_future = time.time() + read_routing.MAX_CLOCK_SKEW_SECONDS + 3600
+    assert decode_token(encode_token(*times(far_future))) is None
+
+
+def test_operation_time_after_the_cluster_time_is_rejected():
+    cluster_time, _ = times()
+    later = Timestamp(cluster_time["clusterTime"].time + 1, 1)
+    assert decode_token(encode_token(cluster_time, later)) is None
+
+
+def test_wrong_shapes_are_rejected():
+    assert decode_token(encode_token({"clusterTime": 5}, Timestamp(1, 1))) is None
+    cluster_time, operation_time = times()
+    del cluster_time["signature"]
+    assert decode_token(encode_token(cluster_time, operation_time)) is None
+
+
+def test_garbage_is_rejected():
+    for token in ("", ".", "not-a-token", "%%%.%%%", base64.urlsafe_b64encode(b"{}").decode()):
+        assert decode_token(token) is None
@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_concurrent_callers_share_one_call():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+        release = asyncio.Event()
+
+        async def fetch():
+            calls.append(1)
+            await release.wait()
+            return {"n": 1}
+
+        callers = [asyncio.create_task(flight.do("k", fetch)) for _ in range(5)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*callers)
+        return flight, calls, results
+
+    flight, calls, results = run(scenario())
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+    assert flight.stats()["executed"] == 1
+    assert flight.stats()["coalesced"] == 4
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_leader_error_reaches_every_follower_and_is_not_cached():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+        attempts = []
+
+        async def failing():
+            attempts.append(1)
+            await release.wait()
+            raise RuntimeError("primary stepped down")
+
+        callers = [asyncio.create_task(flight.do("k", failing)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+
+        async def ok():
+            return "fresh"
+
+        # A failure is forgotten with its call, so the next caller runs a new one
+        return attempts, results, await flight.do("k", ok)
+
+    attempts, results, retried = run(scenario())
+    assert len(attempts) == 1
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert retried == "fresh"
+
+
+def test_a_follower_leaving_does_not_cancel_the_shared_call():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def fetch():
+            await release.wait()
+            return "done"
+
+        leader = asyncio.create_task(flight.do("k", fetch))
+        follower = asyncio.create_task(flight.do("k", fetch))
+        await asyncio.sleep(0)
+        follower.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await leader, follower
+
+    result, follower = run(scenario())
+    assert result == "done"
+    assert follower.cancelled()
+
+
+def test_the_call_is_cancelled_once_every_caller_has_left():
+    async def scenario():
+        flight = SingleFlight()
+        started = asyncio.Event()
+        cancelled = []
+
+        async def fetch():
+            started.set()
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+
+        caller = asyncio.create_task(flight.do("k", fetch))
+        await started.wait()
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        await asyncio.sleep(0)
+        return flight, cancelled
+
+    flight, cancelled = run(scenario())
+    assert cancelled == [1]
+    assert flight.stats()["in_flight"] == 0